@@ -18,6 +18,9 @@ class AlgorithmSettings:
     - mod_render_frames_fn: (frame, last_obs, last_reward, **kwargs ->
       updated_frame) Render algorithm information on the render output. Must
       specify `--render-metric` for this to be called.
+    :property include_info_keys: List of (key, get_shape(envs)) or (key,
+        get_shape(envs), dtype) of the info keys that are saved in the storage.
+        The dtype defaults to float32.
     :property on_traj_finished: Called whenever a trajectory is finished in the
         evaluation, None means nothing is called. Takes as input a list of state,
         next_state, action tuples. Returns any metrics for the environment, you
@@ -185,6 +188,13 @@ class BaseAlgo(object):
         """
         pass
 
+    def uses_traj_finished(self) -> bool:
+        """
+        Whether `on_traj_finished` is implemented. The trajectories of the
+        environments are only tracked by the storage if they are used.
+        """
+        return type(self).on_traj_finished is not BaseAlgo.on_traj_finished
+
     def get_add_args(self, parser):
         pass
 
@@ -34,7 +34,7 @@ class OptionCritic(BaseNetAlgo):
         sel_option = exp.hidden_states['option'][1:].view(-1, 1).long()
         rewards = exp.rewards.view(-1,1)
         hxs = exp.hidden_states
-        masks = exp.masks[1:].view(-1, 1)
+        masks = exp.masks[1:].view(-1, 1).float()
 
         _, log_probs, ent = self.policy.get_actions(state, hxs, masks, sel_option)
 
@@ -140,9 +140,9 @@ class AirlDiscrim(GailDiscrim):
         for i in finished_episodes:
             next_state[i] = add_inputs["final_obs"][i]
             if obsfilt is not None:
-                next_state[i] = torch.FloatTensor(
-                    obsfilt(next_state[i].cpu().numpy(), update=False)
-                ).to(self.args.device)
+                next_state[i] = obsfilt(
+                    next_state[i].to(self.args.device), update=False
+                )
 
         return self.discrim_net.reward_forward(state, action, mask, next_state)
 
@@ -8,6 +8,7 @@ import rlf.rl.utils as rutils
 import torch
 from rlf.algos.il.base_il import BaseILAlgo
 from rlf.storage import RolloutStorage
+from rlf.storage.memory_planner import from_storage_dtype
 
 
 class BaseIRLAlgo(BaseILAlgo):
@@ -39,13 +40,13 @@ class BaseIRLAlgo(BaseILAlgo):
         add_info = {k: storage.get_add_info(k) for k in storage.get_extract_info_keys()}
         for k in storage.ob_keys:
             if k is not None:
-                add_info[k] = storage.obs[k]
+                add_info[k] = from_storage_dtype(storage.obs[k])
 
         for step in range(self.args.num_steps):
-            mask = storage.masks[step]
+            mask = storage.get_masks(step)
             state = self._trans_agent_state(storage.get_obs(step))
             next_state = self._trans_agent_state(storage.get_obs(step + 1))
-            action = storage.actions[step]
+            action = from_storage_dtype(storage.actions[step])
             add_inputs = {k: v[(step + 1) - 1] for k, v in add_info.items()}
 
             rewards, ep_log_vals = self._get_reward(
@@ -59,7 +60,7 @@ class BaseIRLAlgo(BaseILAlgo):
                 for k in ep_log_vals:
                     self.culm_log_vals[k][i] += ep_log_vals[k][i].item()
 
-                if storage.masks[step, i] == 0.0:
+                if not storage.masks[step, i]:
                     for k in ep_log_vals:
                         self.ep_log_vals[k].append(self.culm_log_vals[k][i])
                         self.culm_log_vals[k][i] = 0.0
@@ -87,6 +88,3 @@ class BaseIRLAlgo(BaseILAlgo):
             storage.set_modify_reward_fn(get_reward)
 
         return log_vals
-
-    def on_traj_finished(self, trajs):
-        pass
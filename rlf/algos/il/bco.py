@@ -331,7 +331,7 @@ class BehavioralCloningFromObs(BehavioralCloning):
 
     def update(self, storage):
         masks = storage.masks.view(-1, 1)
-        actions = storage.actions.view(-1, storage.actions.shape[-1])
+        actions = storage.get_actions()
         obs = storage.get_def_obs_seq()
         obs = obs.view(-1, *obs.shape[2:])
         # Update based on collected experience from environment
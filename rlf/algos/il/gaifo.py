@@ -122,7 +122,7 @@ class GaifoDiscrim(GailDiscrim):
             self._agent_obs_pairs = {
                 "state": obs[:-1].view(-1, *ob_shape),
                 "next_state": obs[1:].view(-1, *ob_shape),
-                "mask": storage.masks[:-1].view(-1, 1),
+                "mask": storage.masks[:-1].view(-1, 1).float(),
             }
         elif isinstance(storage, TransitionStorage):
             raise NotImplementedError("GAIfO+SAC not yet implemented")
@@ -149,9 +149,9 @@ class GaifoDiscrim(GailDiscrim):
         for i in finished_episodes:
             next_state[i] = add_inputs["final_obs"][i]
             if obsfilt is not None:
-                next_state[i] = torch.FloatTensor(
-                    obsfilt(next_state[i].cpu().numpy(), update=False)
-                ).to(self.args.device)
+                next_state[i] = obsfilt(
+                    next_state[i].to(self.args.device), update=False
+                )
 
         d_val = self.discrim_net(state, next_state)
         s = torch.sigmoid(d_val)
@@ -143,11 +143,10 @@ class GailDiscrim(BaseIRLAlgo):
     def _norm_expert_state(self, state, obsfilt):
         if not self.args.gail_state_norm:
             return state
-        state = state.cpu().numpy()
+        state = state.to(self.args.device)
 
         if obsfilt is not None:
             state = obsfilt(state, update=False)
-        state = torch.tensor(state).to(self.args.device)
         return state
 
     def _trans_agent_state(self, state, other_state=None):
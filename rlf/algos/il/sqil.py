@@ -62,6 +62,12 @@ class SqilTransitionStorage(TransitionStorage):
             dim=0,
         )
         actions = torch.cat([actions, expert_actions], dim=0)
+        if "sample_weights" in cur_add:
+            # The expert transitions are not prioritized.
+            weights = cur_add["sample_weights"]
+            cur_add["sample_weights"] = torch.cat(
+                [weights, torch.ones_like(weights)], dim=0
+            )
 
         return states, next_states, actions, rewards, cur_add, next_add
 
@@ -73,10 +79,7 @@ class SqilTransitionStorage(TransitionStorage):
         obsfilt = self.il_algo.get_env_ob_filt()
         if obsfilt is None:
             return state
-        state = state.cpu().numpy()
-        state = obsfilt(state, update=False)
-        state = torch.tensor(state).to(self.args.device)
-        return state
+        return obsfilt(state.to(self.args.device), update=False)
 
 
 class SQIL(SAC):
@@ -88,6 +88,9 @@ class NestedAlgo(BaseAlgo):
         for module in self.modules:
             module.on_traj_finished(traj)
 
+    def uses_traj_finished(self):
+        return any(module.uses_traj_finished() for module in self.modules)
+
     def first_train(self, log, eval_policy, env_interface):
         for module in self.modules:
             module.first_train(log, eval_policy, env_interface)
@@ -28,7 +28,11 @@ class DDPG(ActorCriticUpdater):
 
         avg_log_vals = defaultdict(list)
         for i in range(self.args.updates_per_batch):
-            log_vals = self._optimize(*self._sample_transitions(storage))
+            state, n_state, action, reward, add_info, n_add_info = self._sample_transitions(storage)
+            sample_info = self._pop_sample_info(add_info)
+            log_vals = self._optimize(state, n_state, action, reward,
+                    add_info, n_add_info, sample_info)
+            self._update_priorities(storage, sample_info)
             for k,v in log_vals.items():
                 avg_log_vals[k].append(v)
 
@@ -37,7 +41,8 @@ class DDPG(ActorCriticUpdater):
         return avg_log_vals
 
 
-    def _optimize(self, state, n_state, action, reward, add_info, n_add_info):
+    def _optimize(self, state, n_state, action, reward, add_info, n_add_info,
+            sample_info=None):
         n_masks = n_add_info['masks']
         n_masks = n_masks.to(self.args.device)
 
@@ -49,7 +54,7 @@ class DDPG(ActorCriticUpdater):
 
         # Compute the critic loss. (Just a TD loss)
         q = self.policy.get_value(state, action, **add_info)
-        critic_loss = F.mse_loss(q.view(-1), target.view(-1))
+        critic_loss = self._td_loss(q.view(-1), target.view(-1), sample_info)
         self._standard_step(critic_loss, 'critic_opt')
 
         # Compute the actor loss
@@ -1,6 +1,8 @@
 import rlf.rl.utils as rutils
 import torch
+import torch.nn.functional as F
 from rlf.algos.base_net_algo import BaseNetAlgo
+from rlf.args import str2bool
 from rlf.storage.transition_storage import TransitionStorage
 
 
@@ -30,6 +32,47 @@ class OffPolicy(BaseNetAlgo):
     def _sample_transitions(self, storage):
         return storage.sample_tensors(self.args.batch_size)
 
+    def _pop_sample_info(self, add_info):
+        """
+        Removes the importance weights and the indices of the transitions
+        sampled from a prioritized replay from `add_info`. Returns them as a
+        dict for `_td_loss` and `_update_priorities`, None with a uniform
+        replay.
+        """
+        if "sample_idxs" not in add_info:
+            return None
+        return {
+            "weights": add_info.pop("sample_weights"),
+            "idxs": add_info.pop("sample_idxs"),
+            "td_errors": [],
+        }
+
+    def _td_loss(self, pred, target, sample_info):
+        """
+        MSE loss between the Q estimates and their targets. With a
+        prioritized replay the squared errors are weighted by the importance
+        weights and the TD errors are kept for `_update_priorities`.
+        """
+        if sample_info is None:
+            return F.mse_loss(pred, target)
+        td_error = pred - target
+        sample_info["td_errors"].append(td_error.detach())
+        weights = sample_info["weights"].view(-1, *([1] * (td_error.dim() - 1)))
+        return (weights * td_error.pow(2)).mean()
+
+    def _update_priorities(self, storage, sample_info):
+        """
+        Writes the mean absolute TD errors of the losses of the batch back
+        to the prioritized replay. Only the first `len(idxs)` transitions of
+        the batch are from the replay.
+        """
+        if sample_info is None:
+            return
+        idxs = sample_info["idxs"]
+        td_errors = torch.stack(sample_info["td_errors"]).abs().mean(0)
+        td_errors = td_errors.view(td_errors.shape[0], -1).mean(-1)
+        storage.update_priorities(idxs, td_errors[: len(idxs)].cpu().numpy())
+
     def get_add_args(self, parser):
         super().get_add_args(parser)
         #########################################
@@ -46,6 +89,106 @@ class OffPolicy(BaseNetAlgo):
         # New args
         parser.add_argument("--trans-buffer-size", type=float, default=10000)
         parser.add_argument("--batch-size", type=int, default=128)
+        parser.add_argument(
+            "--replay-backend",
+            type=str,
+            default="ram",
+            choices=["ram", "memmap"],
+            help="""
+                Where the replay buffer is stored. "memmap" puts each field in
+                a memory-mapped file of `--replay-dir`, which is reopened when
+                the run restarts.
+                """,
+        )
+        parser.add_argument(
+            "--replay-dir",
+            type=str,
+            default="",
+            help="""
+                Directory of the "memmap" replay buffer. Defaults to "replay"
+                in the model directory of the run.
+                """,
+        )
+        parser.add_argument(
+            "--replay-sample-chunk",
+            type=int,
+            default=1,
+            help="""
+                Sample the uniform batches as runs of this many consecutive
+                transitions, which is faster for a "memmap" buffer larger
+                than the page cache.
+                """,
+        )
+        parser.add_argument(
+            "--replay-prefetch",
+            type=int,
+            default=0,
+            help="""
+                Number of batches sampled ahead on a background thread while
+                the networks update, 0 samples on the learner thread. With a
+                prioritized replay the prefetched batches do not see the
+                priority updates made after they were sampled.
+                """,
+        )
+        parser.add_argument(
+            "--replay-packed",
+            type=str2bool,
+            default=False,
+            help="""
+                Store all the fields but the pixel observations as the
+                float32 columns of one array, so a batch is sampled with a
+                single gather and transfer. Ignores `--storage-ob-dtype`.
+                """,
+        )
+        parser.add_argument(
+            "--replay-dedup-obs",
+            type=str2bool,
+            default=False,
+            help="""
+                Do not store the next observations, which are read from the
+                observation of the next transition of the same environment.
+                Only the next observations of terminal transitions that
+                differ from it are kept. Halves the observation memory, not
+                supported with the "memmap" backend.
+                """,
+        )
+        parser.add_argument(
+            "--save-replay",
+            type=str2bool,
+            default=False,
+            help="""
+                Save the replay buffer with the checkpoints to resume
+                training with it. Each checkpoint only writes the transitions
+                inserted since the previous one.
+                """,
+        )
+        parser.add_argument(
+            "--prioritized-replay",
+            type=str2bool,
+            default=False,
+            help="""
+                Sample the transitions proportionally to their TD errors
+                rather than uniformly.
+                """,
+        )
+        parser.add_argument(
+            "--per-alpha",
+            type=float,
+            default=0.6,
+            help="How much the priorities are used, 0 is uniform sampling",
+        )
+        parser.add_argument(
+            "--per-beta",
+            type=float,
+            default=0.4,
+            help="Importance sampling correction, 1 fully corrects the bias",
+        )
+        parser.add_argument(
+            "--per-eps",
+            type=float,
+            default=1e-6,
+            help="Added to the TD errors so all transitions can be sampled",
+        )
 
         #########################################
         # HER related. Ideally they would be in the `HerStorage` object. This is
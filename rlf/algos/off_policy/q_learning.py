@@ -20,15 +20,17 @@ class QLearning(OffPolicy):
             return {}
 
         for update_i in range(self.args.updates_per_batch):
-            state, n_state, action, reward, _, n_add_info = self._sample_transitions(storage)
+            state, n_state, action, reward, add_info, n_add_info = self._sample_transitions(storage)
+            sample_info = self._pop_sample_info(add_info)
 
             next_q_vals = self.target_policy(n_state).max(1)[0].detach().unsqueeze(-1) * n_add_info['masks']
             target = reward + (next_q_vals * self.args.gamma)
 
             cur_q_vals = self.policy(state).gather(1, action)
-            loss = F.mse_loss(cur_q_vals.view(-1), target.view(-1))
+            loss = self._td_loss(cur_q_vals.view(-1), target.view(-1), sample_info)
 
             self._standard_step(loss)
+            self._update_priorities(storage, sample_info)
 
         autils.soft_update(self.policy, self.target_policy, self.args.tau)
 
@@ -62,7 +62,7 @@ class SAC(OffPolicy):
         )
         return opts
 
-    def update_critic(self, state, n_state, action, reward, not_done):
+    def update_critic(self, state, n_state, action, reward, not_done, sample_info=None):
 
         dist = self.policy(n_state, None, None, None)
         # not_done = n_add_info["masks"]
@@ -76,8 +76,8 @@ class SAC(OffPolicy):
 
         # get current Q estimates
         current_Q1, current_Q2 = self.policy.critic(state, action)
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(
-            current_Q2, target_Q
+        critic_loss = self._td_loss(current_Q1, target_Q, sample_info) + self._td_loss(
+            current_Q2, target_Q, sample_info
         )
 
         # Optimize the critic
@@ -132,11 +132,15 @@ class SAC(OffPolicy):
             storage
         )
         not_done = n_add_info["mask"]
+        sample_info = self._pop_sample_info(add_info)
 
         all_log = {}
 
-        critic_log = self.update_critic(state, n_state, action, reward, not_done)
+        critic_log = self.update_critic(
+            state, n_state, action, reward, not_done, sample_info
+        )
         all_log.update(critic_log)
+        self._update_priorities(storage, sample_info)
 
         if self.update_i % self.args.actor_update_freq == 0:
             actor_log = self.update_actor_and_alpha(state)
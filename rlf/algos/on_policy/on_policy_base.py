@@ -30,7 +30,7 @@ class OnPolicy(BaseNetAlgo):
                 rutils.get_def_obs(rollouts.get_obs(-1), self.args.policy_ob_key),
                 rutils.get_other_obs(rollouts.get_obs(-1), self.args.policy_ob_key),
                 rollouts.get_hidden_state(-1),
-                rollouts.masks[-1]).detach()
+                rollouts.get_masks(-1)).detach()
         return next_value
 
     def _compute_returns(self, rollouts):
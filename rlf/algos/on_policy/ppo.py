@@ -6,6 +6,19 @@ import torch.nn.functional as F
 import torch.optim as optim
 from rlf.algos.on_policy.on_policy_base import OnPolicy
 
+# The minibatch keys read by the update.
+PPO_BATCH_KEYS = [
+    "state",
+    "other_state",
+    "hxs",
+    "mask",
+    "action",
+    "prev_log_prob",
+    "adv",
+    "value",
+    "return",
+]
+
 
 class PPO(OnPolicy):
     def update(self, rollouts):
@@ -18,7 +31,7 @@ class PPO(OnPolicy):
 
         for e in range(self._arg("num_epochs")):
             data_generator = rollouts.get_generator(
-                advantages, self._arg("num_mini_batch")
+                advantages, self._arg("num_mini_batch"), keys=PPO_BATCH_KEYS
             )
 
             for sample in data_generator:
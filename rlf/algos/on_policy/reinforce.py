@@ -13,7 +13,9 @@ class REINFORCE(OnPolicy):
 
         for e in range(self._arg("num_epochs")):
             data_generator = rollouts.get_generator(
-                advantages, self._arg("num_mini_batch")
+                advantages,
+                self._arg("num_mini_batch"),
+                keys=["state", "other_state", "hxs", "mask", "action", "return"],
             )
             for sample in data_generator:
                 ac_eval = self.policy.evaluate_actions(
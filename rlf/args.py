@@ -5,6 +5,28 @@ def str2bool(v):
     return v.lower() == "true"
 
 
+def check_args(args):
+    """
+    Raises a `ValueError` for the combinations of the vectorized env settings
+    that would split the environments of a worker process.
+    """
+    if args.async_batch_size is not None and (
+        args.async_batch_size % args.envs_per_worker != 0
+    ):
+        raise ValueError(
+            f"--async-batch-size {args.async_batch_size} is not a multiple of "
+            f"--envs-per-worker {args.envs_per_worker}"
+        )
+    if args.rollout_double_buffer and (
+        args.num_processes % (2 * args.envs_per_worker) != 0
+    ):
+        raise ValueError(
+            f"--rollout-double-buffer splits the workers in two halves, "
+            f"--num-processes {args.num_processes} must be a multiple of "
+            f"2 * --envs-per-worker {args.envs_per_worker}"
+        )
+
+
 def get_default_parser():
     parser = argparse.ArgumentParser(description="RL", conflict_handler="resolve")
     add_args(parser)
@@ -118,6 +140,17 @@ def add_args(parser):
         default=128,
         help="number of forward steps in A2C/PPO (old default: 128)",
     )
+    parser.add_argument(
+        "--bptt-chunk-len",
+        type=int,
+        default=0,
+        help="""
+            With a recurrent policy, the rollouts are split into chunks of
+            this many steps which are sampled independently in the
+            minibatches, starting from the stored hidden states. Must divide
+            `--num-steps`. 0 uses the whole rollout of each environment.
+            """,
+    )
 
     parser.add_argument(
         "--seed", type=int, default=31, help="random seed (default: 31)"
@@ -213,6 +246,15 @@ def add_args(parser):
     # ENV
     #############################
     parser.add_argument("--normalize-env", type=str2bool, default=True)
+    parser.add_argument(
+        "--env-norm-float64",
+        type=str2bool,
+        default=False,
+        help="""
+            Accumulate the observation and return normalization statistics in
+            float64.
+            """,
+    )
     parser.add_argument("--clip-actions", type=str2bool, default=False)
     parser.add_argument("--frame-stack", type=str2bool, default=True)
     parser.add_argument("--policy-ob-key", type=str, default="observation")
@@ -227,6 +269,131 @@ def add_args(parser):
             rendering in MuJoCo.
             """,
     )
+    parser.add_argument(
+        "--vec-monitor",
+        type=str2bool,
+        default=None,
+        help="""
+            Track the episode statistics of all the environments at once with
+            a `VecMonitor` rather than with a `Monitor` per environment.
+            Atari environments always use a `Monitor`. The `Monitor` records
+            the rewards and dones of the environment before the frame
+            wrappers and `final_trans_fn` of the env interface, the
+            `VecMonitor` after them, so the logged returns differ when
+            `final_trans_fn` changes the rewards or the episode ends. By
+            default the `VecMonitor` is used when the env interface has no
+            `final_trans_fn`, the frame wrappers only change observations.
+            """,
+    )
+    parser.add_argument(
+        "--vec-env-backend",
+        type=str,
+        default="auto",
+        choices=["dummy", "shmem", "thread", "auto"],
+        help="""
+            How the environments are vectorized. "dummy" steps them
+            sequentially in this process, "shmem" in worker processes and
+            "thread" on a thread pool of this process, which only runs in
+            parallel for environments that release the GIL. "auto" uses
+            "dummy" for a single environment, "thread" if the env interface
+            releases the GIL and "shmem" otherwise.
+            """,
+    )
+    parser.add_argument(
+        "--vec-env-threads",
+        type=int,
+        default=None,
+        help="""
+            The number of threads of the "thread" vectorized env backend.
+            Defaults to the number of CPUs.
+            """,
+    )
+    parser.add_argument(
+        "--vec-env-double-buffer",
+        type=str2bool,
+        default=True,
+        help="""
+            If True, the vectorized env alternates between two observation
+            buffers. Observations are returned without copying, so if False
+            the observations returned by a step are overwritten by the next
+            step.
+            """,
+    )
+    parser.add_argument(
+        "--envs-per-worker",
+        type=int,
+        default=1,
+        help="""
+            The number of environments stepped by each worker process of the
+            multi-process vectorized env. Useful for cheap environments where
+            the inter-process communication dominates.
+            """,
+    )
+    parser.add_argument(
+        "--vec-env-protocol",
+        type=str,
+        default="pipe",
+        help="""
+            How the multi-process vectorized env sends the step commands to
+            its workers. Valid options are "pipe" and "shmem". "shmem"
+            exchanges the actions, rewards and dones through shared memory
+            instead of pickling them through pipes.
+            """,
+    )
+    parser.add_argument(
+        "--async-batch-size",
+        type=int,
+        default=None,
+        help="""
+            If specified, the on-policy rollouts step the environments
+            asynchronously and act on the first `async-batch-size`
+            environments that finish their step instead of waiting for all
+            the environments. Must be a multiple of `envs-per-worker`.
+            """,
+    )
+    parser.add_argument(
+        "--rollout-double-buffer",
+        type=str2bool,
+        default=False,
+        help="""
+            If True, the on-policy rollouts split the environments in two
+            halves. One half steps in the worker processes while the policy
+            acts on the other one. `num-processes / 2` must be a multiple of
+            `envs-per-worker`.
+            """,
+    )
+    parser.add_argument(
+        "--forkserver-preload",
+        type=str,
+        default="gym,rlf.rl.envs",
+        help="""
+            Comma separated modules imported once by the forkserver process
+            with `--context-mode forkserver`. The workers are forked from it
+            so they do not import these modules again.
+            """,
+    )
+    parser.add_argument(
+        "--share-eval-workers",
+        type=str2bool,
+        default=False,
+        help="""
+            If True, the evaluation environments are hosted by the worker
+            processes of the training environments when they have the same
+            number of environments, instead of starting other processes.
+            """,
+    )
+    parser.add_argument(
+        "--spare-reset",
+        type=str2bool,
+        default=False,
+        help="""
+            If True, each environment has a second instance that is reset in
+            the background while the first one is stepped, so the steps that
+            end an episode do not wait for the reset. Doubles the memory used
+            by the environments, the memory of the spare instances is logged
+            at startup.
+            """,
+    )
     parser.add_argument("--transpose-frame", type=str2bool, default=True)
     parser.add_argument(
         "--warp-frame",
@@ -271,3 +438,36 @@ def add_args(parser):
         default=0.95,
         help="gae lambda parameter (default: 0.95)",
     )
+    parser.add_argument(
+        "--returns-float64",
+        type=str2bool,
+        default=False,
+        help="""
+            Accumulate the returns and advantages in float64, for very long
+            horizons.
+            """,
+    )
+
+    #############################
+    # STORAGE
+    #############################
+    parser.add_argument(
+        "--storage-ob-dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "bfloat16"],
+        help="""
+            The dtype the 1D float observations are stored as in the rollout
+            and replay buffers. Images are always stored as uint8. The
+            numpy replay buffer does not support "bfloat16".
+            """,
+    )
+    parser.add_argument(
+        "--storage-mem-budget",
+        type=float,
+        default=0.0,
+        help="""
+            Memory budget in GB of each storage buffer. The storage refuses
+            to allocate its buffers if they need more. 0 places no limit.
+            """,
+    )
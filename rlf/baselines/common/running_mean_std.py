@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 class RunningMeanStd(object):
     # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
@@ -18,6 +19,19 @@ class RunningMeanStd(object):
         self.mean, self.var, self.count = update_mean_var_count_from_moments(
             self.mean, self.var, self.count, batch_mean, batch_var, batch_count)
 
+    def state_dict(self):
+        return {'mean': self.mean, 'var': self.var, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.mean = self._as_stat(state['mean'])
+        self.var = self._as_stat(state['var'])
+        self.count = state['count']
+
+    def _as_stat(self, x):
+        if isinstance(x, torch.Tensor):
+            x = x.cpu().numpy()
+        return np.asarray(x, dtype=self.mean.dtype)
+
     def __str__(self):
         return 'Mean: %s, Var: %s, Count: %i' % (str(list(self.mean)), str(list(self.var)), self.count)
 
@@ -33,3 +47,40 @@ def update_mean_var_count_from_moments(mean, var, count, batch_mean, batch_var,
     new_count = tot_count
 
     return new_mean, new_var, new_count
+
+class TorchRunningMeanStd(RunningMeanStd):
+    """
+    RunningMeanStd of tensors, the statistics stay on `device`. Use a
+    `torch.float64` `dtype` to accumulate the statistics in double precision.
+    """
+    def __init__(self, epsilon=1e-4, shape=(), device='cpu', dtype=torch.float32):
+        self.mean = torch.zeros(shape, dtype=dtype, device=device)
+        self.var = torch.ones(shape, dtype=dtype, device=device)
+        self.count = epsilon
+
+    def update(self, x):
+        x = x.to(self.mean)
+        batch_mean = x.mean(0)
+        batch_var = x.var(0, unbiased=False)
+        self.update_from_moments(batch_mean, batch_var, x.shape[0])
+
+    def update_from_moments(self, batch_mean, batch_var, batch_count):
+        delta = batch_mean - self.mean
+        tot_count = self.count + batch_count
+
+        self.mean = self.mean + delta * batch_count / tot_count
+        m_a = self.var * self.count
+        m_b = batch_var * batch_count
+        M2 = m_a + m_b + delta ** 2 * self.count * batch_count / tot_count
+        self.var = M2 / tot_count
+        self.count = tot_count
+
+    def state_dict(self):
+        # Saved on the CPU so a checkpoint loads without the training device.
+        return {'mean': self.mean.cpu(), 'var': self.var.cpu(), 'count': self.count}
+
+    def _as_stat(self, x):
+        return torch.as_tensor(x).to(self.mean)
+
+    def __str__(self):
+        return 'Mean: %s, Var: %s, Count: %i' % (str(self.mean.tolist()), str(self.var.tolist()), self.count)
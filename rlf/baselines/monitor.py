@@ -79,8 +79,8 @@ class Monitor(Wrapper):
         self.total_steps += 1
 
     def close(self):
-        if self.f is not None:
-            self.f.close()
+        if self.results_writer:
+            self.results_writer.close()
 
     def get_total_steps(self):
         return self.total_steps
@@ -94,31 +94,65 @@ class Monitor(Wrapper):
     def get_episode_times(self):
         return self.episode_times
 
+JSON_EXT = "monitor.json"
+
 class LoadMonitorResultsError(Exception):
     pass
 
 
 class ResultsWriter(object):
-    def __init__(self, filename, header='', extra_keys=()):
+    """
+    Writes the episode statistics as CSV rows or, with `fmt='json'`, as one
+    JSON dict per line. Rows are buffered and flushed to the file every
+    `buffer_size` rows and on `close`.
+    """
+    def __init__(self, filename, header='', extra_keys=(), buffer_size=1, fmt='csv'):
         self.extra_keys = extra_keys
+        self.fmt = fmt
+        self.buffer_size = buffer_size
+        self.rows = []
         assert filename is not None
-        if not filename.endswith(Monitor.EXT):
+        ext = Monitor.EXT if fmt == 'csv' else JSON_EXT
+        if not filename.endswith(ext):
             if osp.isdir(filename):
-                filename = osp.join(filename, Monitor.EXT)
+                filename = osp.join(filename, ext)
             else:
-                filename = filename + "." + Monitor.EXT
+                filename = filename + "." + ext
         self.f = open(filename, "wt")
-        if isinstance(header, dict):
-            header = '# {} \n'.format(json.dumps(header))
-        self.f.write(header)
-        self.logger = csv.DictWriter(self.f, fieldnames=('r', 'l', 't')+tuple(extra_keys))
-        self.logger.writeheader()
+        if fmt == 'csv':
+            if isinstance(header, dict):
+                header = '# {} \n'.format(json.dumps(header))
+            self.f.write(header)
+            self.logger = csv.DictWriter(self.f, fieldnames=('r', 'l', 't')+tuple(extra_keys))
+            self.logger.writeheader()
+        elif fmt == 'json':
+            self.logger = None
+            self.f.write(json.dumps(header if isinstance(header, dict) else {}) + '\n')
+        else:
+            raise ValueError('Unrecognized results format %s' % fmt)
         self.f.flush()
 
     def write_row(self, epinfo):
+        self.write_rows([epinfo])
+
+    def write_rows(self, epinfos):
+        self.rows.extend(epinfos)
+        if len(self.rows) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0 or self.f.closed:
+            return
         if self.logger:
-            self.logger.writerow(epinfo)
-            self.f.flush()
+            self.logger.writerows(self.rows)
+        else:
+            self.f.write(''.join(json.dumps(row) + '\n' for row in self.rows))
+        self.rows = []
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
 
 
 def get_monitor_files(dir):
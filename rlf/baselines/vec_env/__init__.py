@@ -1,10 +1,13 @@
 from .vec_env import AlreadySteppingError, NotSteppingError, VecEnv, VecEnvWrapper, VecEnvObservationWrapper, CloudpickleWrapper
 from .dummy_vec_env import DummyVecEnv
+from .info_batch import InfoBatch
 from .shmem_vec_env import ShmemVecEnv
 from .subproc_vec_env import SubprocVecEnv
+from .thread_vec_env import ThreadVecEnv
+from .torch_vec_env import TorchInfoBatch, TorchVecEnv
 from .vec_frame_stack import VecFrameStack
 from .vec_monitor import VecMonitor
 from .vec_normalize import VecNormalize
 from .vec_remove_dict_obs import VecExtractDictObs
 
-__all__ = ['AlreadySteppingError', 'NotSteppingError', 'VecEnv', 'VecEnvWrapper', 'VecEnvObservationWrapper', 'CloudpickleWrapper', 'DummyVecEnv', 'ShmemVecEnv', 'SubprocVecEnv', 'VecFrameStack', 'VecMonitor', 'VecNormalize', 'VecExtractDictObs']
+__all__ = ['AlreadySteppingError', 'NotSteppingError', 'VecEnv', 'VecEnvWrapper', 'VecEnvObservationWrapper', 'CloudpickleWrapper', 'DummyVecEnv', 'InfoBatch', 'ShmemVecEnv', 'SubprocVecEnv', 'ThreadVecEnv', 'TorchInfoBatch', 'TorchVecEnv', 'VecFrameStack', 'VecMonitor', 'VecNormalize', 'VecExtractDictObs']
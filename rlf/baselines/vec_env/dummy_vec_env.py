@@ -1,6 +1,7 @@
 import numpy as np
 from .vec_env import VecEnv
-from .util import copy_obs_dict, dict_to_obs, obs_space_info
+from .spare_reset_env import SpareResetEnv, log_spare_mem
+from .util import dict_to_obs, obs_space_info
 from collections.abc import Iterable
 
 class DummyVecEnv(VecEnv):
@@ -10,23 +11,45 @@ class DummyVecEnv(VecEnv):
     Useful when debugging and when num_env == 1 (in the latter case,
     avoids communication overhead)
     """
-    def __init__(self, env_fns):
+    def __init__(self, env_fns, double_buffer=True, spare_reset=False):
         """
         Arguments:
 
         env_fns: iterable of callables      functions that build environments
+        double_buffer: bool                 alternate between two observation
+                                            buffers so the observations returned
+                                            by a step are not overwritten by the
+                                            next step.
+        spare_reset: bool                   hold a second instance of each
+                                            environment that is reset in a
+                                            background thread, see
+                                            `SpareResetEnv`.
+
+        The returned observations are views of the internal observation
+        buffer and are not copied.
         """
-        self.envs = [fn() for fn in env_fns]
+        if spare_reset:
+            self.envs = [SpareResetEnv(fn) for fn in env_fns]
+            log_spare_mem(sum(env.spare_mem for env in self.envs))
+        else:
+            self.envs = [fn() for fn in env_fns]
         env = self.envs[0]
         VecEnv.__init__(self, len(env_fns), env.observation_space, env.action_space)
         obs_space = env.observation_space
         self.keys, shapes, dtypes = obs_space_info(obs_space)
 
-        self.buf_obs = { k: np.zeros((self.num_envs,) + tuple(shapes[k]), dtype=dtypes[k]) for k in self.keys }
+        self.double_buffer = double_buffer
+        self.bufs_obs = [{ k: np.zeros((self.num_envs,) + tuple(shapes[k]), dtype=dtypes[k]) for k in self.keys }
+                for _ in range(2 if double_buffer else 1)]
+        self.buf_idx = 0
+        self.buf_obs = self.bufs_obs[self.buf_idx]
         self.buf_dones = np.zeros((self.num_envs,), dtype=bool)
         self.buf_rews  = np.zeros((self.num_envs,), dtype=np.float32)
         self.buf_infos = [{} for _ in range(self.num_envs)]
         self.actions = None
+        # (actions, env_ids) of the steps started by `send` and
+        # `async_reset`, a reset has no actions.
+        self.pending = []
         self.spec = self.envs[0].spec
 
     def step_async(self, actions):
@@ -43,24 +66,59 @@ class DummyVecEnv(VecEnv):
             assert self.num_envs == 1, "actions {} is either not a list or has a wrong size - cannot match to {} environments".format(actions, self.num_envs)
             self.actions = [actions]
 
+    def _next_buf(self):
+        self.buf_idx = (self.buf_idx + 1) % len(self.bufs_obs)
+        self.buf_obs = self.bufs_obs[self.buf_idx]
+
     def step_wait(self):
+        self._next_buf()
         for e in range(self.num_envs):
-            action = self.actions[e]
-            # if isinstance(self.envs[e].action_space, spaces.Discrete):
-            #    action = int(action)
-
-            obs, self.buf_rews[e], self.buf_dones[e], self.buf_infos[e] = self.envs[e].step(action)
-            if self.buf_dones[e]:
-                final_obs = obs
-                if isinstance(obs, dict) and 'observation' in obs:
-                    final_obs = obs['observation']
-                self.buf_infos[e]['final_obs'] = final_obs
-                obs = self.envs[e].reset()
-            self._save_obs(e, obs)
+            self._step_env(e, self.actions[e])
         return (self._obs_from_buf(), np.copy(self.buf_rews), np.copy(self.buf_dones),
                 self.buf_infos.copy())
 
+    def _step_env(self, e, action):
+        # if isinstance(self.envs[e].action_space, spaces.Discrete):
+        #    action = int(action)
+
+        obs, self.buf_rews[e], self.buf_dones[e], self.buf_infos[e] = self.envs[e].step(action)
+        if self.buf_dones[e]:
+            final_obs = obs
+            if isinstance(obs, dict) and 'observation' in obs:
+                final_obs = obs['observation']
+            self.buf_infos[e]['final_obs'] = final_obs
+            obs = self.envs[e].reset()
+        self._save_obs(e, obs)
+
+    def async_reset(self):
+        self.pending = [(None, np.arange(self.num_envs))]
+
+    def send(self, actions, env_ids):
+        self.pending.append((actions, np.asarray(env_ids)))
+
+    def recv(self):
+        """
+        The environments are stepped sequentially so all the pending steps
+        are returned.
+        """
+        pending, self.pending = self.pending, []
+        self._next_buf()
+        for actions, env_ids in pending:
+            for i, e in enumerate(env_ids):
+                if actions is None:
+                    self._save_obs(e, self.envs[e].reset())
+                    self.buf_rews[e] = 0.0
+                    self.buf_dones[e] = False
+                    self.buf_infos[e] = {}
+                else:
+                    self._step_env(e, actions[i])
+        env_ids = np.concatenate([env_ids for _, env_ids in pending])
+        obs = dict_to_obs({k: v[env_ids] for k, v in self.buf_obs.items()})
+        return (obs, self.buf_rews[env_ids], self.buf_dones[env_ids],
+                [self.buf_infos[e] for e in env_ids], env_ids)
+
     def reset(self):
+        self._next_buf()
         for e in range(self.num_envs):
             obs = self.envs[e].reset()
             self._save_obs(e, obs)
@@ -74,7 +132,7 @@ class DummyVecEnv(VecEnv):
                 self.buf_obs[k][e] = obs[k]
 
     def _obs_from_buf(self):
-        return dict_to_obs(copy_obs_dict(self.buf_obs))
+        return dict_to_obs(dict(self.buf_obs))
 
     def get_images(self, **kwargs):
         return [env.render(mode='rgb_array', **kwargs) for env in self.envs]
@@ -0,0 +1,195 @@
+"""
+Helpers for sending the infos of a vectorized environment as arrays rather
+than as pickled dicts.
+"""
+
+from collections import OrderedDict
+
+import gym
+import numpy as np
+
+# The statistics `Monitor` adds to the info at the end of an episode.
+EPISODE_DTYPE = np.dtype([("r", np.float64), ("l", np.int64), ("t", np.float64)])
+
+
+def get_info_schema(obs_space, info_keys=()):
+    """
+    Get the ordered dict {key: (shape, dtype)} of the info keys stored in
+    arrays. `final_obs`, `bad_transition` and the Monitor `episode`
+    statistics are always included.
+    - info_keys: list of (key, shape, dtype) of the other keys. The dtype
+      can be omitted for float32 values.
+    """
+    if isinstance(obs_space, gym.spaces.Dict):
+        # Only the "observation" key is returned as the final observation.
+        obs_space = obs_space.spaces.get("observation", None)
+    schema = OrderedDict()
+    if obs_space is not None:
+        schema["final_obs"] = (tuple(obs_space.shape), np.dtype(obs_space.dtype))
+    schema["bad_transition"] = ((), np.dtype(bool))
+    schema["episode"] = ((), EPISODE_DTYPE)
+    for info_key in info_keys:
+        k, shape = info_key[:2]
+        dtype = info_key[2] if len(info_key) > 2 else np.float32
+        if k not in schema:
+            schema[k] = (tuple(shape), np.dtype(dtype))
+    return schema
+
+
+def get_info_nbytes(schema, num_envs):
+    """
+    The number of bytes of the array of each key of `schema`.
+    """
+    return {
+        k: num_envs * int(np.prod(shape)) * dtype.itemsize
+        for k, (shape, dtype) in schema.items()
+    }
+
+
+def info_arrays_from_buffers(schema, bufs, valid_bufs, num_envs):
+    """
+    Get the `(num_envs, *shape)` numpy views of the buffers of each key and
+    the `(num_envs,)` views of the buffers of the validity masks.
+    """
+    arrays = {
+        k: np.frombuffer(bufs[k], dtype=dtype).reshape((num_envs,) + shape)
+        for k, (shape, dtype) in schema.items()
+    }
+    valid = {k: np.frombuffer(valid_bufs[k], dtype=bool) for k in schema}
+    return arrays, valid
+
+
+def write_info(schema, arrays, valid, i, info):
+    """
+    Write the keys of `info` that are in `schema` to row `i` of the arrays.
+    Returns a dict of the other keys, or None if there are no other keys.
+    """
+    extra = None
+    for k, v in info.items():
+        if k == "episode" and set(v.keys()) != set(EPISODE_DTYPE.names):
+            # Episode statistics with additional entries are sent as is.
+            pass
+        elif k in schema:
+            if k == "episode":
+                v = tuple(v[name] for name in EPISODE_DTYPE.names)
+            arrays[k][i] = v
+            valid[k][i] = True
+            continue
+        if extra is None:
+            extra = {}
+        extra[k] = v
+    return extra
+
+
+def _to_info_val(k, v):
+    if k == "episode":
+        return {name: v[name].item() for name in EPISODE_DTYPE.names}
+    return v
+
+
+class InfoBatch(object):
+    """
+    The infos of a batch of environments. This behaves like the list of info
+    dicts returned by the other vectorized environments, but the dicts are
+    only built when they are accessed.
+    - arrays: {key: array of shape (N, *shape)} of the schema keys.
+    - valid: {key: bool array of shape (N,)} whether each environment
+      returned the key.
+    - extras: list of N dicts of the keys not in the schema, or None.
+    The accessed dicts can be modified, `get_array` includes these changes.
+    """
+
+    def __init__(self, arrays, valid, extras):
+        self.arrays = arrays
+        self.valid = valid
+        self.extras = extras
+        self._dicts = [None] * len(extras)
+
+    def __len__(self):
+        return len(self.extras)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        if self._dicts[i] is None:
+            info = {
+                k: _to_info_val(k, self.arrays[k][i])
+                for k in self.arrays
+                if self.valid[k][i]
+            }
+            if self.extras[i] is not None:
+                info.update(self.extras[i])
+            self._dicts[i] = info
+        return self._dicts[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def copy(self):
+        return list(self)
+
+    def select_keys(self, i, keys):
+        """
+        Get the dict of the `keys` returned by environment `i` without
+        building its full info dict.
+        """
+        if self._dicts[i] is not None:
+            return {k: self._dicts[i][k] for k in keys if k in self._dicts[i]}
+        ret = {}
+        for k in keys:
+            if k in self.arrays and self.valid[k][i]:
+                ret[k] = _to_info_val(k, self.arrays[k][i])
+            elif self.extras[i] is not None and k in self.extras[i]:
+                ret[k] = self.extras[i][k]
+        return ret
+
+    def get_extra_keys(self, i):
+        """
+        The keys of environment `i` that are not from the arrays.
+        """
+        if self._dicts[i] is not None:
+            return [k for k in self._dicts[i] if k not in self.arrays]
+        if self.extras[i] is None:
+            return []
+        return list(self.extras[i].keys())
+
+    def get_array(self, k):
+        """
+        Get the (values, valid) arrays of key `k` of the schema.
+        """
+        values, valid = self.arrays[k], self.valid[k]
+        built = [i for i, info in enumerate(self._dicts) if info is not None]
+        if len(built) == 0:
+            return values, valid
+        values = values.copy() if isinstance(values, np.ndarray) else values.clone()
+        valid = valid.copy() if isinstance(valid, np.ndarray) else valid.clone()
+        for i in built:
+            valid[i] = k in self._dicts[i]
+            if valid[i]:
+                v = self._dicts[i][k]
+                if k == "episode":
+                    v = tuple(v[name] for name in EPISODE_DTYPE.names)
+                values[i] = v
+        return values, valid
+
+    def set_rows(self, k, idx, values):
+        """
+        Set key `k` of the schema of the environments `idx` to `values` and
+        mark them as valid.
+        """
+        self.arrays[k][idx] = values
+        self.valid[k][idx] = True
+        for i in idx:
+            if self._dicts[i] is not None:
+                self._dicts[i][k] = _to_info_val(k, self.arrays[k][i])
+
+    def set_array(self, k, values):
+        """
+        Replace the values of key `k` of the schema by `values`, of shape
+        (N, ...). The shape after the batch dimension can change.
+        """
+        self.arrays[k] = values
+        for i, info in enumerate(self._dicts):
+            if info is not None and k in info:
+                info[k] = values[i]
@@ -2,36 +2,101 @@
 An interface for asynchronous vectorized environments.
 """
 
+import copy
 import multiprocessing as mp
+from multiprocessing.connection import wait
 import numpy as np
 from .vec_env import VecEnv, CloudpickleWrapper, clear_mpi_env_vars
 import ctypes
 from rlf.baselines import logger
 from collections.abc import Iterable
+from gym import spaces as gym_spaces
 
+from .spare_reset_env import SpareResetEnv, log_spare_mem
+from .info_batch import InfoBatch, get_info_nbytes, get_info_schema, info_arrays_from_buffers, write_info
 from .util import dict_to_obs, obs_space_info, obs_to_dict
 
 _NP_TO_CT = {np.float32: ctypes.c_float,
         np.float64: ctypes.c_double,
         np.int32: ctypes.c_int32,
+        np.int64: ctypes.c_int64,
         np.int8: ctypes.c_int8,
         np.uint8: ctypes.c_char,
         bool: ctypes.c_bool}
 
+# Observation and action spaces of the environments by `spaces_key`.
+_SPACES_CACHE = {}
+
+
+def get_context(context, preload=()):
+    """
+    Get the multiprocessing context. For "forkserver", the `preload` modules
+    and this module are imported once by the server process and the workers
+    are forked from it, so they do not import them again. The preloaded
+    modules cannot be changed once the server started.
+    """
+    ctx = mp.get_context(context)
+    if context == 'forkserver':
+        ctx.set_forkserver_preload([__name__, *preload])
+    return ctx
+
 
 class ShmemVecEnv(VecEnv):
     """
     Optimized version of SubprocVecEnv that uses shared variables to communicate observations.
     """
 
-    def __init__(self, env_fns, spaces=None, context='spawn'):
+    def __init__(self, env_fns, spaces=None, context='spawn', double_buffer=True,
+            envs_per_worker=1, batch_size=None, protocol='pipe', info_keys=(),
+            spare_reset=False, spaces_key=None, preload=()):
         """
         If you don't specify observation_space, we'll have to create a dummy
         environment to get it.
+
+        Observations of all environments live in one contiguous
+        `(num_envs, *shape)` shared block per observation key. Workers write
+        directly into their row and the arrays returned by `reset` and
+        `step_wait` are views of that block, so they are only valid until
+        the block is written again.
+        - double_buffer: If True, alternate between two blocks so the
+          observations returned by a step stay valid until the step after
+          the next one (the next `step_async` does not overwrite them).
+        - envs_per_worker: The number of environments stepped sequentially
+          by each worker process. Each worker writes the observations of its
+          whole slice and answers a command with a single message.
+        - batch_size: The number of environments returned by `recv`. The
+          environments of the workers that finish first are returned. Must be
+          a multiple of `envs_per_worker`. Defaults to all the environments.
+        - protocol: How the step and reset commands are sent to the workers.
+          "pipe" pickles the commands and results through a pipe per worker.
+          "shmem" writes the actions, rewards and dones into shared arrays
+          and synchronizes with semaphores, the pipes are only used for the
+          other commands and for the infos that are not empty. Action spaces
+          that cannot be stored in an array fall back to "pipe".
+        - info_keys: list of (key, shape, dtype) of the info keys written to
+          shared arrays in addition to `final_obs`, `bad_transition` and
+          `episode` (see `get_info_schema`). The shape can be a function of
+          this vectorized env. The infos are returned as an `InfoBatch` and
+          only the keys that are not declared are pickled.
+        - spare_reset: If True, each worker holds a second instance of each
+          environment that is reset in the background while the first one
+          is stepped (see `SpareResetEnv`). The step that ends an episode
+          then does not wait for the reset. This doubles the memory used by
+          the environments, the measured cost is logged at startup.
+        - spaces_key: Hashable key of the environments. The spaces are cached
+          by key so later vectorized envs with the same key do not create a
+          dummy environment to get them.
+        - preload: Modules imported once by the forkserver, see
+          `get_context`.
+
+        `share_workers` creates a vectorized env of other environments hosted
+        by the same worker processes.
         """
-        ctx = mp.get_context(context)
+        ctx = get_context(context, preload)
         if spaces:
             observation_space, action_space = spaces
+        elif spaces_key is not None and spaces_key in _SPACES_CACHE:
+            observation_space, action_space = _SPACES_CACHE[spaces_key]
         else:
             # Was very annoying to see this every single time.
             #logger.log('Creating dummy env object to get spaces')
@@ -40,19 +105,53 @@ class ShmemVecEnv(VecEnv):
                 observation_space, action_space = dummy.observation_space, dummy.action_space
                 dummy.close()
                 del dummy
+        if spaces_key is not None:
+            _SPACES_CACHE[spaces_key] = (observation_space, action_space)
         VecEnv.__init__(self, len(env_fns), observation_space, action_space)
         self.obs_keys, self.obs_shapes, self.obs_dtypes = obs_space_info(observation_space)
+        self.double_buffer = double_buffer
+        num_bufs = 2 if double_buffer else 1
         self.obs_bufs = [
-            {k: ctx.Array(_NP_TO_CT[self.obs_dtypes[k].type], int(np.prod(self.obs_shapes[k]))) for k in self.obs_keys}
-            for _ in env_fns]
+            {k: ctx.Array(_NP_TO_CT[self.obs_dtypes[k].type], self.num_envs * int(np.prod(self.obs_shapes[k])))
+                for k in self.obs_keys}
+            for _ in range(num_bufs)]
+        self.obs_arrs = [_bufs_to_np(bufs, self.obs_shapes, self.obs_dtypes, self.num_envs)
+            for bufs in self.obs_bufs]
+        self.buf_idx = 0
+
+        info_keys = [(k, shape(self) if callable(shape) else shape, *rest)
+            for k, shape, *rest in info_keys]
+        self.info_schema = get_info_schema(observation_space, info_keys)
+        self.info_bufs = {k: ctx.RawArray(ctypes.c_uint8, nbytes)
+            for k, nbytes in get_info_nbytes(self.info_schema, self.num_envs).items()}
+        self.info_valid_bufs = {k: ctx.RawArray(ctypes.c_bool, self.num_envs)
+            for k in self.info_schema}
+        self.info_arrs, self.info_valid = info_arrays_from_buffers(
+            self.info_schema, self.info_bufs, self.info_valid_bufs, self.num_envs)
+
+        self.worker_slices = [slice(start, min(start + envs_per_worker, self.num_envs))
+            for start in range(0, self.num_envs, envs_per_worker)]
+
+        if protocol == 'shmem' and _action_info(action_space) is None:
+            logger.warn('Action space %s is not supported by the shmem protocol, using pipes' % action_space)
+            protocol = 'pipe'
+        if protocol == 'shmem':
+            self.channel = _CmdChannel(ctx, self.num_envs, len(self.worker_slices), action_space)
+        elif protocol == 'pipe':
+            self.channel = None
+        else:
+            raise ValueError('Unrecognized protocol %s' % protocol)
+
         self.parent_pipes = []
         self.procs = []
         with clear_mpi_env_vars():
-            for env_fn, obs_buf in zip(env_fns, self.obs_bufs):
-                wrapped_fn = CloudpickleWrapper(env_fn)
+            for worker_idx, env_slice in enumerate(self.worker_slices):
+                wrapped_fns = CloudpickleWrapper(env_fns[env_slice])
                 parent_pipe, child_pipe = ctx.Pipe()
                 proc = ctx.Process(target=_subproc_worker,
-                            args=(child_pipe, parent_pipe, wrapped_fn, obs_buf, self.obs_shapes, self.obs_dtypes, self.obs_keys))
+                            args=(child_pipe, parent_pipe, wrapped_fns, env_slice, self.obs_bufs, self.obs_shapes, self.obs_dtypes, self.obs_keys,
+                                (self.info_schema, self.info_bufs, self.info_valid_bufs), self.channel, worker_idx,
+                                spare_reset))
                 proc.daemon = True
                 self.procs.append(proc)
                 self.parent_pipes.append(parent_pipe)
@@ -61,29 +160,234 @@ class ShmemVecEnv(VecEnv):
         self.waiting_step = False
         self.viewer = None
 
+        if batch_size is None:
+            batch_size = self.num_envs
+        else:
+            assert batch_size % envs_per_worker == 0, (
+                "The batch size must be a multiple of the number of environments per worker")
+        self.batch_size = batch_size
+        self.env_to_worker = np.concatenate([np.full(env_slice.stop - env_slice.start, i)
+            for i, env_slice in enumerate(self.worker_slices)])
+        # Whether each worker has a step or reset started by `send` or
+        # `async_reset` that is not yet returned by `recv`.
+        self.worker_pending = [False] * len(self.worker_slices)
+        # The environments of the workers used by this vectorized env, see
+        # `share_workers`. The state is shared by all the vectorized envs of
+        # these workers.
+        self.group = 0
+        self.workers_state = {'active': 0, 'next_group': 1, 'groups': {0}}
+
+        if spare_reset:
+            for i in range(len(self.parent_pipes)):
+                self._send_pipe_cmd(i, ('spare_mem', None))
+            log_spare_mem(sum(pipe.recv() for pipe in self.parent_pipes))
+
+    def share_workers(self, env_fns):
+        """
+        Create a vectorized env of `env_fns` hosted by the worker processes
+        of this one, for instance the evaluation environments of the
+        training environments. This avoids starting other processes. The
+        workers step the environments of the vectorized env that was last
+        used, a vectorized env cannot be used while the other one has
+        pending steps. They share the observation buffers, so the
+        observations returned by one are overwritten by the steps of the
+        other. The workers are stopped when all of them are closed.
+        """
+        assert len(env_fns) == self.num_envs, (
+            'The shared vectorized env must have the same number of environments')
+        venv = copy.copy(self)
+        venv.waiting_step = False
+        venv.viewer = None
+        venv.group = self.workers_state['next_group']
+        self.workers_state['next_group'] += 1
+        self.workers_state['groups'].add(venv.group)
+        for i, env_slice in enumerate(self.worker_slices):
+            self._send_pipe_cmd(i, ('add_group', (venv.group, CloudpickleWrapper(env_fns[env_slice]))))
+        for pipe in self.parent_pipes:
+            pipe.recv()
+        return venv
+
+    def _activate(self):
+        """
+        Make the workers step the environments of this vectorized env.
+        """
+        if self.workers_state['active'] == self.group:
+            return
+        # The pending steps are tracked per worker, so they can be from the
+        # environments of another vectorized env.
+        assert not any(self.worker_pending), (
+            'The workers have pending steps of another vectorized env')
+        for i in range(len(self.parent_pipes)):
+            self._send_pipe_cmd(i, ('set_group', self.group))
+        for pipe in self.parent_pipes:
+            pipe.recv()
+        self.workers_state['active'] = self.group
+
+    def _next_buf(self):
+        self.buf_idx = (self.buf_idx + 1) % len(self.obs_bufs)
+        return self.buf_idx
+
     def reset(self):
+        self._activate()
+        while any(self.worker_pending):
+            self.recv()
         if self.waiting_step:
             logger.warn('Called reset() while waiting for the step to complete')
             self.step_wait()
-        for pipe in self.parent_pipes:
-            pipe.send(('reset', None))
-        return self._decode_obses([pipe.recv() for pipe in self.parent_pipes])
+        buf_idx = self._next_buf()
+        for i in range(len(self.worker_slices)):
+            self._send_reset(i, buf_idx)
+        for i in self._wait_workers(list(range(len(self.worker_slices))), self.num_envs):
+            self._recv_result(i)
+        return self._decode_obses(buf_idx)
 
     def step_async(self, actions):
-        assert len(actions) == len(self.parent_pipes)
-        for pipe, act in zip(self.parent_pipes, actions):
-            pipe.send(('step', act))
+        self._activate()
+        assert not any(self.worker_pending), 'Called step_async() while asynchronous steps are pending'
+        assert len(actions) == self.num_envs
+        buf_idx = self._next_buf()
+        for i, env_slice in enumerate(self.worker_slices):
+            self._send_step(i, actions[env_slice], buf_idx)
+        self.waiting_step = True
 
     def step_wait(self):
-        outs = [pipe.recv() for pipe in self.parent_pipes]
-        obs, rews, dones, infos = zip(*outs)
-        return self._decode_obses(obs), np.array(rews), np.array(dones), infos
+        workers = list(range(len(self.worker_slices)))
+        self._wait_workers(workers, self.num_envs)
+        outs = [self._recv_result(i) for i in workers]
+        self.waiting_step = False
+        rews, dones, extras = [sum(x, []) for x in zip(*outs)]
+        infos = self._get_infos(np.arange(self.num_envs), extras)
+        return self._decode_obses(self.buf_idx), np.array(rews), np.array(dones), infos
+
+    def async_reset(self):
+        self._activate()
+        assert not self.waiting_step and not any(self.worker_pending), (
+            'Called async_reset() while steps are pending')
+        for i in range(len(self.worker_slices)):
+            self._send_reset(i, self.buf_idx)
+            self.worker_pending[i] = True
+
+    def send(self, actions, env_ids):
+        self._activate()
+        assert not self.waiting_step
+        env_ids = np.asarray(env_ids)
+        env_pos = np.empty(self.num_envs, dtype=np.int64)
+        env_pos[env_ids] = np.arange(len(env_ids))
+        for i in np.unique(self.env_to_worker[env_ids]):
+            assert not self.worker_pending[i], 'Worker %i already has a pending step' % i
+            env_slice = self.worker_slices[i]
+            worker_pos = env_pos[env_slice]
+            assert np.isin(np.arange(env_slice.start, env_slice.stop), env_ids).all(), (
+                'All the environments of a worker must be stepped together')
+            self._send_step(i, actions[worker_pos], self.buf_idx)
+            self.worker_pending[i] = True
+
+    def recv(self):
+        pending = [i for i, is_pending in enumerate(self.worker_pending) if is_pending]
+        assert len(pending) > 0, 'No pending steps to receive'
+        n_envs = min(self.batch_size, sum(self._worker_size(i) for i in pending))
+        ready = self._wait_workers(pending, n_envs)
+
+        rews, dones, extras = [], [], []
+        for i in ready:
+            out = self._recv_result(i)
+            self.worker_pending[i] = False
+            rews.extend(out[0])
+            dones.extend(out[1])
+            extras.extend(out[2])
+        env_ids = np.concatenate([np.arange(self.worker_slices[i].start, self.worker_slices[i].stop)
+            for i in ready])
+        infos = self._get_infos(env_ids, extras)
+        # Indexing copies the rows so they are not overwritten by the next
+        # step of these environments.
+        obs = dict_to_obs({k: v[env_ids] for k, v in self.obs_arrs[self.buf_idx].items()})
+        return obs, np.array(rews), np.array(dones), infos, env_ids
+
+    def _get_infos(self, env_ids, extras):
+        # Indexing copies the arrays so the batch stays valid after the next
+        # step.
+        return InfoBatch({k: v[env_ids] for k, v in self.info_arrs.items()},
+                {k: v[env_ids] for k, v in self.info_valid.items()}, extras)
+
+    def _worker_size(self, i):
+        return self.worker_slices[i].stop - self.worker_slices[i].start
+
+    def _send_step(self, i, actions, buf_idx):
+        if self.channel is None:
+            self.parent_pipes[i].send(('step', (actions, buf_idx)))
+        else:
+            np.copyto(self.channel.actions_arr[self.worker_slices[i]], actions)
+            self.channel.send_cmd(i, _CMD_STEP, buf_idx)
+
+    def _send_reset(self, i, buf_idx):
+        if self.channel is None:
+            self.parent_pipes[i].send(('reset', buf_idx))
+        else:
+            self.channel.send_cmd(i, _CMD_RESET, buf_idx)
+
+    def _send_pipe_cmd(self, i, msg):
+        if self.channel is not None:
+            self.channel.send_cmd(i, _CMD_PIPE, 0)
+        self.parent_pipes[i].send(msg)
+
+    def _wait_workers(self, workers, n_envs):
+        """
+        Wait until the workers among `workers` that finished their command
+        host at least `n_envs` environments. Returns these workers.
+        """
+        ready = []
+        if self.channel is None:
+            if n_envs == sum(self._worker_size(i) for i in workers):
+                # `_recv_result` blocks until each worker is done.
+                return list(workers)
+            pipe_to_worker = {self.parent_pipes[i]: i for i in workers}
+            while sum(self._worker_size(i) for i in ready) < n_envs:
+                for pipe in wait([self.parent_pipes[i] for i in workers if i not in ready]):
+                    if sum(self._worker_size(i) for i in ready) < n_envs:
+                        ready.append(pipe_to_worker[pipe])
+        else:
+            while sum(self._worker_size(i) for i in ready) < n_envs:
+                ready.append(self.channel.wait_any([i for i in workers if i not in ready]))
+        return ready
+
+    def _recv_result(self, i):
+        """
+        Get the (rews, dones, extras) lists of the last step or reset of
+        worker `i`, after `_wait_workers` returned it. `extras` are the info
+        keys that are not in the info arrays.
+        """
+        n = self._worker_size(i)
+        if self.channel is None:
+            out = self.parent_pipes[i].recv()
+            if out is None:
+                # Result of a reset.
+                out = ([0.0] * n, [False] * n, [None] * n)
+            return out
+        env_slice = self.worker_slices[i]
+        if self.channel.has_infos_arr[i]:
+            extras = self.parent_pipes[i].recv()
+        else:
+            extras = [None] * n
+        return (self.channel.rews_arr[env_slice].tolist(),
+                self.channel.dones_arr[env_slice].tolist(), extras)
 
     def close_extras(self):
         if self.waiting_step:
             self.step_wait()
-        for pipe in self.parent_pipes:
-            pipe.send(('close', None))
+        if self.workers_state['active'] == self.group:
+            while any(self.worker_pending):
+                self.recv()
+            self.workers_state['active'] = None
+        self.workers_state['groups'].discard(self.group)
+        if len(self.workers_state['groups']) > 0:
+            # Other vectorized envs still use the workers.
+            for i in range(len(self.parent_pipes)):
+                self._send_pipe_cmd(i, ('close_group', self.group))
+            for pipe in self.parent_pipes:
+                pipe.recv()
+            return
+        for i in range(len(self.parent_pipes)):
+            self._send_pipe_cmd(i, ('close', None))
         for pipe in self.parent_pipes:
             pipe.recv()
             pipe.close()
@@ -91,60 +395,249 @@ class ShmemVecEnv(VecEnv):
             proc.join()
 
     def get_images(self, mode='human', **kwargs):
-        N = len(self.parent_pipes)
-        all_pipe_kwargs = []
-        for i in range(N):
-            pipe_kwargs = {}
+        self._activate()
+        all_env_kwargs = []
+        for i in range(self.num_envs):
+            env_kwargs = {}
             for k, v in kwargs.items():
                 if isinstance(v, Iterable):
-                    pipe_kwargs[k] = kwargs[k][i]
+                    env_kwargs[k] = kwargs[k][i]
                 else:
-                    pipe_kwargs[k] = kwargs[k]
-            all_pipe_kwargs.append(pipe_kwargs)
+                    env_kwargs[k] = kwargs[k]
+            all_env_kwargs.append(env_kwargs)
+
+        for i, env_slice in enumerate(self.worker_slices):
+            self._send_pipe_cmd(i, ('render', (mode, all_env_kwargs[env_slice])))
+        return sum([pipe.recv() for pipe in self.parent_pipes], [])
+
+    def _decode_obses(self, buf_idx):
+        # A new dict is returned since wrappers modify it in place, the arrays
+        # themselves are views of the shared block.
+        return dict_to_obs(dict(self.obs_arrs[buf_idx]))
+
+
+def _bufs_to_np(bufs, obs_shapes, obs_dtypes, num_envs):
+    """
+    Get `(num_envs, *shape)` numpy views of the shared blocks of each key.
+    """
+    return {k: np.frombuffer(bufs[k].get_obj(), dtype=obs_dtypes[k]).reshape((num_envs,) + tuple(obs_shapes[k]))
+            for k in bufs}
+
+
+def _action_info(action_space):
+    """
+    Get the (shape, dtype) of a single action of `action_space` or None if
+    the actions cannot be stored in a shared array.
+    """
+    if isinstance(action_space, gym_spaces.Box):
+        return action_space.shape, action_space.dtype
+    elif isinstance(action_space, gym_spaces.Discrete):
+        return (), np.dtype(np.int64)
+    elif isinstance(action_space, gym_spaces.MultiDiscrete):
+        return action_space.shape, np.dtype(np.int64)
+    elif isinstance(action_space, gym_spaces.MultiBinary):
+        return (action_space.n,), np.dtype(np.int8)
+    return None
+
+
+_CMD_STEP = 0
+_CMD_RESET = 1
+# The command is sent through the pipe.
+_CMD_PIPE = 2
+
+
+class _CmdChannel(object):
+    """
+    Shared memory replacing the pipes for the step and reset commands. The
+    parent writes the command of a worker and releases the command semaphore
+    of the worker. The worker writes its rewards and dones, appends its index
+    to the queue of finished workers and releases the result semaphore, so
+    the parent blocks until whichever worker finishes first.
+    """
+
+    def __init__(self, ctx, num_envs, num_workers, action_space):
+        self.ac_shape, self.ac_dtype = _action_info(action_space)
+        self.num_envs = num_envs
+        self.num_workers = num_workers
+        self.actions = ctx.RawArray(_NP_TO_CT[self.ac_dtype.type],
+                num_envs * int(np.prod(self.ac_shape)))
+        self.rews = ctx.RawArray(ctypes.c_double, num_envs)
+        self.dones = ctx.RawArray(ctypes.c_bool, num_envs)
+        self.has_infos = ctx.RawArray(ctypes.c_bool, num_workers)
+        # The (command, observation buffer index) of each worker.
+        self.cmds = ctx.RawArray(ctypes.c_int32, 2 * num_workers)
+        self.cmd_sems = [ctx.Semaphore(0) for _ in range(num_workers)]
+        # Ring buffer of the indices of the finished workers. A worker has at
+        # most one command in flight so it never holds more than
+        # `num_workers` unread indices.
+        self.ready = ctx.RawArray(ctypes.c_int32, num_workers)
+        self.ready_end = ctx.RawValue(ctypes.c_int64, 0)
+        self.ready_lock = ctx.Lock()
+        self.result_sem = ctx.Semaphore(0)
+        # Only used by the parent: the position of the next unread index and
+        # the finished workers read by `wait_any` that it did not wait for.
+        self._ready_start = 0
+        self._ready_early = []
+        self._create_arrs()
+
+    def _create_arrs(self):
+        self.actions_arr = np.frombuffer(self.actions, dtype=self.ac_dtype).reshape(
+                (self.num_envs,) + tuple(self.ac_shape))
+        self.rews_arr = np.frombuffer(self.rews, dtype=np.float64)
+        self.dones_arr = np.frombuffer(self.dones, dtype=bool)
+        self.has_infos_arr = np.frombuffer(self.has_infos, dtype=bool)
+        self.cmds_arr = np.frombuffer(self.cmds, dtype=np.int32).reshape(self.num_workers, 2)
 
-        for pipe, p_kwargs in zip(self.parent_pipes, all_pipe_kwargs):
-            pipe.send(('render', (mode, p_kwargs)))
-        return [pipe.recv() for pipe in self.parent_pipes]
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['actions_arr', 'rews_arr', 'dones_arr', 'has_infos_arr', 'cmds_arr']:
+            del state[k]
+        return state
 
-    def _decode_obses(self, obs):
-        result = {}
-        for k in self.obs_keys:
-            bufs = [b[k] for b in self.obs_bufs]
-            o = [np.frombuffer(b.get_obj(), dtype=self.obs_dtypes[k]).reshape(self.obs_shapes[k]) for b in bufs]
-            result[k] = np.array(o)
-        return dict_to_obs(result)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_arrs()
 
+    def send_cmd(self, i, cmd, buf_idx):
+        self.cmds_arr[i] = (cmd, buf_idx)
+        self.cmd_sems[i].release()
 
-def _subproc_worker(pipe, parent_pipe, env_fn_wrapper, obs_bufs, obs_shapes, obs_dtypes, keys):
+    def wait_any(self, workers):
+        """
+        Wait for one of `workers` to finish its command and return it.
+        """
+        for i in self._ready_early:
+            if i in workers:
+                self._ready_early.remove(i)
+                return i
+        while True:
+            self.result_sem.acquire()
+            i = int(self.ready[self._ready_start % self.num_workers])
+            self._ready_start += 1
+            if i in workers:
+                return i
+            self._ready_early.append(i)
+
+    def send_result(self, i):
+        with self.ready_lock:
+            self.ready[self.ready_end.value % self.num_workers] = i
+            self.ready_end.value += 1
+        self.result_sem.release()
+
+
+def _subproc_worker(pipe, parent_pipe, env_fn_wrappers, env_slice, obs_bufs, obs_shapes, obs_dtypes, keys,
+        info_bufs, channel=None, worker_idx=None, spare_reset=False):
     """
-    Control a single environment instance using IPC and
-    shared memory.
+    Control a slice of environment instances using IPC and
+    shared memory. If `channel` is specified, the step and reset commands
+    are received through it instead of through the pipe.
+    - info_bufs: (schema, bufs, valid bufs) of the info arrays.
+    - spare_reset: If True, wrap each environment in a `SpareResetEnv`.
+    The worker can host the environments of several vectorized envs (see
+    `ShmemVecEnv.share_workers`), the commands apply to the environments of
+    the last "set_group" command.
     """
-    def _write_obs(maybe_dict_obs):
+    # Views of this worker's rows in each of the shared blocks.
+    obs_rows = []
+    for bufs in obs_bufs:
+        num_envs = len(bufs[keys[0]]) // int(np.prod(obs_shapes[keys[0]]))
+        obs_rows.append({k: v[env_slice] for k, v in _bufs_to_np(bufs, obs_shapes, obs_dtypes, num_envs).items()})
+
+    info_schema = info_bufs[0]
+    info_arrs, info_valid = info_arrays_from_buffers(*info_bufs, num_envs)
+    info_rows = {k: v[env_slice] for k, v in info_arrs.items()}
+    valid_rows = {k: v[env_slice] for k, v in info_valid.items()}
+
+    def _write_obs(i, maybe_dict_obs, buf_idx):
         flatdict = obs_to_dict(maybe_dict_obs)
         for k in keys:
-            dst = obs_bufs[k].get_obj()
-            dst_np = np.frombuffer(dst, dtype=obs_dtypes[k]).reshape(obs_shapes[k])  # pylint: disable=W0212
-            np.copyto(dst_np, flatdict[k])
+            np.copyto(obs_rows[buf_idx][k][i], flatdict[k])
 
-    env = env_fn_wrapper.x()
+    def _clear_infos():
+        for v in valid_rows.values():
+            v[:] = False
+
+    def _reset(buf_idx):
+        _clear_infos()
+        for i, env in enumerate(envs):
+            _write_obs(i, env.reset(), buf_idx)
+
+    def _step(actions, buf_idx):
+        """
+        Returns the rewards, dones and the info keys not written to the
+        info arrays.
+        """
+        _clear_infos()
+        rews, dones, extras = [], [], []
+        for i, (env, action) in enumerate(zip(envs, actions)):
+            obs, reward, done, info = env.step(action)
+            if done:
+                final_obs = obs
+                if isinstance(obs, dict):
+                    final_obs = obs['observation']
+                info['final_obs'] = final_obs
+                obs = env.reset()
+            _write_obs(i, obs, buf_idx)
+            rews.append(reward)
+            dones.append(done)
+            extras.append(write_info(info_schema, info_rows, valid_rows, i, info))
+        return rews, dones, extras
+
+    def _make_envs(env_fns):
+        if spare_reset:
+            return [SpareResetEnv(env_fn) for env_fn in env_fns]
+        return [env_fn() for env_fn in env_fns]
+
+    envs = _make_envs(env_fn_wrappers.x)
+    env_groups = {0: envs}
     parent_pipe.close()
     try:
         while True:
+            if channel is not None:
+                channel.cmd_sems[worker_idx].acquire()
+                cmd, buf_idx = channel.cmds_arr[worker_idx]
+                if cmd == _CMD_STEP:
+                    rews, dones, extras = _step(np.copy(channel.actions_arr[env_slice]), buf_idx)
+                    channel.rews_arr[env_slice] = rews
+                    channel.dones_arr[env_slice] = dones
+                    has_infos = any(extra is not None for extra in extras)
+                    channel.has_infos_arr[worker_idx] = has_infos
+                    # The parent receives the infos after the result, a
+                    # large payload would otherwise block the send.
+                    channel.send_result(worker_idx)
+                    if has_infos:
+                        pipe.send(extras)
+                    continue
+                elif cmd == _CMD_RESET:
+                    _reset(buf_idx)
+                    channel.rews_arr[env_slice] = 0.0
+                    channel.dones_arr[env_slice] = False
+                    channel.has_infos_arr[worker_idx] = False
+                    channel.send_result(worker_idx)
+                    continue
             cmd, data = pipe.recv()
             if cmd == 'reset':
-                pipe.send(_write_obs(env.reset()))
+                _reset(data)
+                pipe.send(None)
             elif cmd == 'step':
-                obs, reward, done, info = env.step(data)
-                if done:
-                    final_obs = obs
-                    if isinstance(obs, dict):
-                        final_obs = obs['observation']
-                    info['final_obs'] = final_obs
-                    obs = env.reset()
-                pipe.send((_write_obs(obs), reward, done, info))
+                pipe.send(_step(*data))
             elif cmd == 'render':
-                pipe.send(env.render(mode=data[0], **data[1]))
+                mode, all_env_kwargs = data
+                pipe.send([env.render(mode=mode, **env_kwargs)
+                    for env, env_kwargs in zip(envs, all_env_kwargs)])
+            elif cmd == 'spare_mem':
+                pipe.send(sum(env.spare_mem for env in envs))
+            elif cmd == 'add_group':
+                group, group_fn_wrappers = data
+                env_groups[group] = _make_envs(group_fn_wrappers.x)
+                pipe.send(None)
+            elif cmd == 'set_group':
+                envs = env_groups[data]
+                pipe.send(None)
+            elif cmd == 'close_group':
+                for env in env_groups.pop(data):
+                    env.close()
+                pipe.send(None)
             elif cmd == 'close':
                 pipe.send(None)
                 break
@@ -153,4 +646,6 @@ def _subproc_worker(pipe, parent_pipe, env_fn_wrapper, obs_bufs, obs_shapes, obs
     except KeyboardInterrupt:
         print('ShmemVecEnv worker: got KeyboardInterrupt')
     finally:
-        env.close()
+        for group_envs in env_groups.values():
+            for env in group_envs:
+                env.close()
@@ -0,0 +1,100 @@
+"""
+An environment that keeps a second instance reset in the background.
+"""
+
+import os
+import resource
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from rlf.baselines import logger
+
+
+def get_rss_mb():
+    """
+    Current resident memory of this process in MB. Falls back to the peak
+    resident memory where `/proc` is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            n_pages = int(f.read().split()[1])
+        return n_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            # Reported in bytes rather than KB.
+            rss /= 1024
+        return rss / 1024
+
+
+def log_spare_mem(spare_mem):
+    """
+    Reports the memory used by the spare instances of a vectorized env.
+    """
+    logger.log('Spare reset environments use about %.1f MB' % spare_mem)
+
+
+class SpareResetEnv(object):
+    """
+    Holds two instances of an environment. While one instance is stepped,
+    the other is reset on a background thread, so `reset` returns
+    immediately by swapping the instances. Consecutive episodes alternate
+    between the two instances. The spare instance is seeded from the random
+    state of the first one so the episodes of the two instances differ.
+
+    Only the reset that follows the end of an episode swaps the instances.
+    A reset in the middle of an episode resets the current instance
+    synchronously, as a wrapper such as `Monitor` may not allow it.
+    """
+
+    def __init__(self, env_fn):
+        self.env = env_fn()
+        start_mem = get_rss_mb()
+        self.spare_env = env_fn()
+        # The memory used by the spare instance, approximate as other
+        # threads can allocate meanwhile.
+        self.spare_mem = max(get_rss_mb() - start_mem, 0.0)
+        np_random = getattr(self.env.unwrapped, 'np_random', None)
+        if np_random is not None:
+            # Draw the seed from a copy so the episodes of the first instance
+            # are unchanged.
+            rng = np.random.RandomState()
+            rng.set_state(np_random.get_state())
+            self.spare_env.seed(int(rng.randint(2**31 - 1)))
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # Future of the observation of the spare instance reset.
+        self._spare_obs = None
+        # Whether the episode of the current instance is done.
+        self._done = False
+
+    def reset(self):
+        if self._spare_obs is None:
+            obs = self.env.reset()
+        elif not self._done:
+            return self.env.reset()
+        else:
+            # Raises the errors of the background reset.
+            obs = self._spare_obs.result()
+            self.env, self.spare_env = self.spare_env, self.env
+        self._done = False
+        self._spare_obs = self._executor.submit(self.spare_env.reset)
+        return obs
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self._done = done
+        return obs, reward, done, info
+
+    def render(self, *args, **kwargs):
+        return self.env.render(*args, **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.env.close()
+        self.spare_env.close()
+
+    def __getattr__(self, name):
+        if name in ['env', 'spare_env']:
+            raise AttributeError(name)
+        return getattr(self.env, name)
@@ -0,0 +1,100 @@
+"""
+A vectorized environment stepping the environments on a thread pool.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .dummy_vec_env import DummyVecEnv
+from .util import dict_to_obs
+
+
+class ThreadVecEnv(DummyVecEnv):
+    """
+    VecEnv that steps the environments on a fixed pool of threads of this
+    process. Each thread steps a contiguous slice of the environments and
+    writes into its rows of the preallocated batch buffers. There is no
+    process start, pickling or shared memory, but the steps only run in
+    parallel for environments that release the GIL, such as MuJoCo physics
+    or numpy heavy environments.
+    """
+    def __init__(self, env_fns, num_threads=None, double_buffer=True, spare_reset=False):
+        """
+        num_threads: int                    number of threads stepping the
+                                            environments, defaults to the
+                                            number of CPUs.
+
+        The other arguments are as in `DummyVecEnv`.
+        """
+        super().__init__(env_fns, double_buffer=double_buffer, spare_reset=spare_reset)
+        if num_threads is None:
+            num_threads = os.cpu_count() or 1
+        num_threads = max(1, min(num_threads, self.num_envs))
+        bounds = np.linspace(0, self.num_envs, num_threads + 1).astype(np.int64)
+        self.env_slices = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def _run_slices(self, fn):
+        """
+        Call `fn(env_slice)` for the slice of each thread and wait for all of
+        them. Exceptions of the threads are raised here.
+        """
+        for future in [self._executor.submit(fn, env_slice) for env_slice in self.env_slices]:
+            future.result()
+
+    def step_wait(self):
+        self._next_buf()
+
+        def _step_slice(env_slice):
+            for e in range(env_slice.start, env_slice.stop):
+                self._step_env(e, self.actions[e])
+
+        self._run_slices(_step_slice)
+        return (self._obs_from_buf(), np.copy(self.buf_rews), np.copy(self.buf_dones),
+                self.buf_infos.copy())
+
+    def reset(self):
+        self._next_buf()
+
+        def _reset_slice(env_slice):
+            for e in range(env_slice.start, env_slice.stop):
+                self._save_obs(e, self.envs[e].reset())
+
+        self._run_slices(_reset_slice)
+        return self._obs_from_buf()
+
+    def recv(self):
+        """
+        All the pending steps are run on the thread pool and returned.
+        """
+        pending, self.pending = self.pending, []
+        self._next_buf()
+        # Pending (action, env id) of each environment.
+        env_actions = {}
+        for actions, env_ids in pending:
+            for i, e in enumerate(env_ids):
+                env_actions[e] = None if actions is None else actions[i]
+
+        def _recv_slice(env_slice):
+            for e in range(env_slice.start, env_slice.stop):
+                if e not in env_actions:
+                    continue
+                if env_actions[e] is None:
+                    self._save_obs(e, self.envs[e].reset())
+                    self.buf_rews[e] = 0.0
+                    self.buf_dones[e] = False
+                    self.buf_infos[e] = {}
+                else:
+                    self._step_env(e, env_actions[e])
+
+        self._run_slices(_recv_slice)
+        env_ids = np.concatenate([env_ids for _, env_ids in pending])
+        obs = dict_to_obs({k: v[env_ids] for k, v in self.buf_obs.items()})
+        return (obs, self.buf_rews[env_ids], self.buf_dones[env_ids],
+                [self.buf_infos[e] for e in env_ids], env_ids)
+
+    def close_extras(self):
+        self._executor.shutdown()
+        super().close_extras()
@@ -0,0 +1,127 @@
+"""
+A vectorized environment simulating all its environments as one batch of
+torch tensors.
+"""
+
+from abc import abstractmethod
+
+import torch
+
+from .info_batch import InfoBatch
+from .vec_env import VecEnv
+
+
+class TorchInfoBatch(InfoBatch):
+    """
+    The infos of a `TorchVecEnv`. The arrays and validity masks are tensors
+    on the device of the environment. The episode statistics are the
+    `(N,)` tensors of `episode` ({name: tensor}), valid where
+    `valid['episode']` is True. No environment has extra keys.
+    """
+
+    def __init__(self, arrays, valid, episode=None):
+        num_envs = len(next(iter(valid.values()))) if len(valid) > 0 else 0
+        super().__init__(arrays, valid, [None] * num_envs)
+        self.episode = episode
+
+    def __getitem__(self, i):
+        if isinstance(i, slice) or self._dicts[i] is not None:
+            return super().__getitem__(i)
+        info = super().__getitem__(i)
+        for k, v in info.items():
+            if isinstance(v, torch.Tensor) and v.dim() == 0:
+                info[k] = v.item()
+        if self.episode is not None and self.valid["episode"][i]:
+            info["episode"] = {k: v[i].item() for k, v in self.episode.items()}
+        return info
+
+    def select_keys(self, i, keys):
+        if self._dicts[i] is not None:
+            return super().select_keys(i, keys)
+        ret = super().select_keys(i, [k for k in keys if k != "episode"])
+        if "episode" in keys and self.episode is not None and self.valid["episode"][i]:
+            ret["episode"] = {k: v[i].item() for k, v in self.episode.items()}
+        return ret
+
+    def get_episode_stats(self):
+        """
+        Get the ({name: tensor}, ended) statistics of the episodes that
+        ended, `ended` is the `(N,)` bool tensor of the environments that
+        ended an episode.
+        """
+        if self.episode is None:
+            return {}, torch.zeros(len(self), dtype=torch.bool)
+        return self.episode, self.valid["episode"]
+
+
+class TorchVecEnv(VecEnv):
+    """
+    Base class of the vectorized environments that simulate all their
+    environments as one batch of tensors on `device`. Subclasses implement
+    `_step_batch` and `_reset_envs`. The environments that end an episode
+    are reset within the batch and the episode returns and lengths are
+    tracked as tensors.
+
+    `step_wait` returns the observations, the `(N, 1)` rewards and the
+    `(N,)` bool dones as tensors on `device` and the infos as a
+    `TorchInfoBatch`, so the wrappers, the runner and the storages use them
+    without converting them to numpy.
+    """
+
+    def __init__(self, num_envs, observation_space, action_space, device):
+        super().__init__(num_envs, observation_space, action_space)
+        self.device = torch.device(device)
+        self._ep_rewards = torch.zeros(num_envs, device=self.device)
+        self._ep_lens = torch.zeros(num_envs, dtype=torch.long, device=self.device)
+        self._actions = None
+
+    @abstractmethod
+    def _step_batch(self, actions):
+        """
+        Step all the environments with the `(N, *action_shape)` tensor
+        `actions`. Returns (obs, reward, done, info arrays) where `reward`
+        is `(N, 1)`, `done` is a `(N,)` bool tensor and the info arrays are
+        {key: (N, ...) tensor} valid for all the environments.
+        """
+        pass
+
+    @abstractmethod
+    def _reset_envs(self, env_mask):
+        """
+        Reset the environments where the `(N,)` bool tensor `env_mask` is
+        True and return the observations of all the environments. Should not
+        synchronize with the device, `env_mask` can be all False.
+        """
+        pass
+
+    def reset(self):
+        self._ep_rewards.zero_()
+        self._ep_lens.zero_()
+        return self._reset_envs(
+            torch.ones(self.num_envs, dtype=torch.bool, device=self.device)
+        )
+
+    def step_async(self, actions):
+        self._actions = torch.as_tensor(actions).to(self.device)
+
+    def step_wait(self):
+        obs, reward, done, info_arrays = self._step_batch(self._actions)
+        valid = {
+            k: torch.ones(self.num_envs, dtype=torch.bool, device=self.device)
+            for k in info_arrays
+        }
+        self._ep_rewards += reward.view(-1)
+        self._ep_lens += 1
+        final_obs = obs["observation"] if isinstance(obs, dict) else obs
+        info_arrays["final_obs"] = final_obs.clone()
+        valid["final_obs"] = done
+        valid["episode"] = done
+        episode = {"r": self._ep_rewards.clone(), "l": self._ep_lens.clone()}
+        self._ep_rewards.masked_fill_(done, 0.0)
+        self._ep_lens.masked_fill_(done, 0)
+        # Branchless so stepping does not wait for the device.
+        obs = self._reset_envs(done)
+        return obs, reward, done, TorchInfoBatch(info_arrays, valid, episode)
+
+    def get_images(self, mode=None, **kwargs):
+        raise NotImplementedError
@@ -83,6 +83,36 @@ class VecEnv(ABC):
         """
         pass
 
+    def async_reset(self):
+        """
+        Start resetting all the environments. The observations are returned
+        by the following calls to recv() with zero rewards, False dones and
+        empty infos.
+        """
+        raise NotImplementedError
+
+    def send(self, actions, env_ids):
+        """
+        Tell the environments with ids `env_ids` to start taking a step with
+        the given actions, `actions[i]` is taken by environment `env_ids[i]`.
+        Call recv() to get the results. Unlike step_async(), several sends
+        can be pending at the same time as long as every environment has at
+        most one pending step.
+        """
+        raise NotImplementedError
+
+    def recv(self):
+        """
+        Wait for a batch of the pending steps started with send() or
+        async_reset(). The batch is made of the environments that finish
+        first rather than of the environments in a fixed order.
+
+        Returns (obs, rews, dones, infos, env_ids) where the first four are
+        as in step_wait() and `env_ids` is an integer array of the ids of the
+        environments in the batch.
+        """
+        raise NotImplementedError
+
     def close_extras(self):
         """
         Clean up the  extra resources, beyond what's in this base class.
@@ -161,6 +191,15 @@ class VecEnvWrapper(VecEnv):
     def step_async(self, actions):
         self.venv.step_async(actions)
 
+    def async_reset(self):
+        self.venv.async_reset()
+
+    def send(self, actions, env_ids):
+        self.venv.send(actions, env_ids)
+
+    def recv(self):
+        return self.venv.recv()
+
     @abstractmethod
     def reset(self):
         pass
@@ -192,6 +231,10 @@ class VecEnvObservationWrapper(VecEnvWrapper):
         obs, rews, dones, infos = self.venv.step_wait()
         return self.process(obs), rews, dones, infos
 
+    def recv(self):
+        obs, rews, dones, infos, env_ids = self.venv.recv()
+        return self.process(obs), rews, dones, infos, env_ids
+
 
 class CloudpickleWrapper(object):
     """
@@ -207,8 +250,11 @@ class CloudpickleWrapper(object):
         return cloudpickle.dumps(self.x)
 
     def __setstate__(self, ob):
-        # import pickle
-        import pickle5 as pickle
+        try:
+            import pickle5 as pickle
+        except ImportError:
+            # Protocol 5 is built in since Python 3.8.
+            import pickle
 
         self.x = pickle.loads(ob)
 
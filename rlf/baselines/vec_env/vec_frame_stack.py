@@ -4,27 +4,41 @@ from gym import spaces
 
 
 class VecFrameStack(VecEnvWrapper):
+    """
+    Stacks the last `nstack` observations along the last axis. The frames
+    are kept in a circular buffer with a write index, so a step writes a
+    single frame instead of rolling the whole stack.
+    """
     def __init__(self, venv, nstack):
         self.venv = venv
         self.nstack = nstack
         wos = venv.observation_space  # wrapped ob space
         low = np.repeat(wos.low, self.nstack, axis=-1)
         high = np.repeat(wos.high, self.nstack, axis=-1)
-        self.stackedobs = np.zeros((venv.num_envs,) + low.shape, low.dtype)
+        # (num_envs, nstack, *obs_shape) frames, the next frame is written at
+        # `self.idx` which is also the oldest frame.
+        self.frames = np.zeros((venv.num_envs, nstack) + wos.shape, low.dtype)
+        self.idx = 0
         observation_space = spaces.Box(low=low, high=high, dtype=venv.observation_space.dtype)
         VecEnvWrapper.__init__(self, venv, observation_space=observation_space)
 
+    def _get_stacked(self):
+        order = [(self.idx + j) % self.nstack for j in range(self.nstack)]
+        return np.concatenate([self.frames[:, j] for j in order], axis=-1)
+
     def step_wait(self):
         obs, rews, news, infos = self.venv.step_wait()
-        self.stackedobs = np.roll(self.stackedobs, shift=-1, axis=-1)
-        for (i, new) in enumerate(news):
-            if new:
-                self.stackedobs[i] = 0
-        self.stackedobs[..., -obs.shape[-1]:] = obs
-        return self.stackedobs, rews, news, infos
+        self.frames[np.asarray(news, dtype=bool)] = 0
+        self.frames[:, self.idx] = obs
+        self.idx = (self.idx + 1) % self.nstack
+        return self._get_stacked(), rews, news, infos
 
     def reset(self):
         obs = self.venv.reset()
-        self.stackedobs[...] = 0
-        self.stackedobs[..., -obs.shape[-1]:] = obs
-        return self.stackedobs
+        self.frames[...] = 0
+        self.frames[:, 0] = obs
+        self.idx = 1 % self.nstack
+        return self._get_stacked()
+
+    def send(self, actions, env_ids):
+        raise NotImplementedError('Frame stacking does not support asynchronous steps')
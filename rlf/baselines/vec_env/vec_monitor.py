@@ -1,18 +1,29 @@
 from . import VecEnvWrapper
+from .info_batch import EPISODE_DTYPE, InfoBatch
 from rlf.baselines.monitor import ResultsWriter
 import numpy as np
 import time
 from collections import deque
 
 class VecMonitor(VecEnvWrapper):
-    def __init__(self, venv, filename=None, keep_buf=0):
+    """
+    Tracks the episode returns and lengths of all the environments in arrays
+    and adds the `episode` statistics {'r', 'l', 't'} to the infos of the
+    environments that ended an episode. The statistics returned by the
+    environment itself, for example by a `Monitor`, are kept.
+    - filename: Where to write the episode statistics, rows are buffered and
+      written every `buffer_size` episodes.
+    - fmt: 'csv' or 'json' (one JSON dict per line).
+    """
+    def __init__(self, venv, filename=None, keep_buf=0, buffer_size=100, fmt='csv'):
         VecEnvWrapper.__init__(self, venv)
-        self.eprets = None
-        self.eplens = None
+        self.eprets = np.zeros(self.num_envs, np.float64)
+        self.eplens = np.zeros(self.num_envs, np.int64)
         self.epcount = 0
         self.tstart = time.time()
         if filename:
-            self.results_writer = ResultsWriter(filename, header={'t_start': self.tstart})
+            self.results_writer = ResultsWriter(filename, header={'t_start': self.tstart},
+                    buffer_size=buffer_size, fmt=fmt)
         else:
             self.results_writer = None
         self.keep_buf = keep_buf
@@ -20,30 +31,68 @@ class VecMonitor(VecEnvWrapper):
             self.epret_buf = deque([], maxlen=keep_buf)
             self.eplen_buf = deque([], maxlen=keep_buf)
 
+    def _reset_stats(self):
+        self.eprets[:] = 0
+        self.eplens[:] = 0
+
     def reset(self):
         obs = self.venv.reset()
-        self.eprets = np.zeros(self.num_envs, 'f')
-        self.eplens = np.zeros(self.num_envs, 'i')
+        self._reset_stats()
         return obs
 
+    def async_reset(self):
+        self._reset_stats()
+        self.venv.async_reset()
+
     def step_wait(self):
         obs, rews, dones, infos = self.venv.step_wait()
-        self.eprets += rews
-        self.eplens += 1
-        newinfos = []
-        for (i, (done, ret, eplen, info)) in enumerate(zip(dones, self.eprets, self.eplens, infos)):
-            info = info.copy()
-            if done:
-                epinfo = {'r': ret, 'l': eplen, 't': round(time.time() - self.tstart, 6)}
-                info['episode'] = epinfo
-                if self.keep_buf:
-                    self.epret_buf.append(ret)
-                    self.eplen_buf.append(eplen)
-                self.epcount += 1
-                self.eprets[i] = 0
-                self.eplens[i] = 0
-                if self.results_writer:
-                    self.results_writer.write_row(epinfo)
-            newinfos.append(info)
-
-        return obs, rews, dones, newinfos
+        infos = self._update(rews, dones, infos, np.arange(self.num_envs))
+        return obs, rews, dones, infos
+
+    def recv(self):
+        obs, rews, dones, infos, env_ids = self.venv.recv()
+        infos = self._update(rews, dones, infos, np.asarray(env_ids))
+        return obs, rews, dones, infos, env_ids
+
+    def _update(self, rews, dones, infos, env_ids):
+        """
+        Accumulates the step results of the environments `env_ids` and adds
+        the statistics of the episodes that ended to `infos`.
+        """
+        self.eprets[env_ids] += rews
+        self.eplens[env_ids] += 1
+        done_idx = np.nonzero(dones)[0]
+        if len(done_idx) == 0:
+            return infos
+
+        done_envs = env_ids[done_idx]
+        episodes = np.zeros(len(done_idx), EPISODE_DTYPE)
+        episodes['r'] = self.eprets[done_envs]
+        episodes['l'] = self.eplens[done_envs]
+        episodes['t'] = round(time.time() - self.tstart, 6)
+        self.eprets[done_envs] = 0
+        self.eplens[done_envs] = 0
+
+        if isinstance(infos, InfoBatch) and 'episode' in infos.arrays:
+            _, has_ep = infos.get_array('episode')
+            keep = np.array([not has_ep[i] and 'episode' not in infos.get_extra_keys(i)
+                for i in done_idx], dtype=bool)
+            infos.set_rows('episode', done_idx[keep], episodes[keep])
+        else:
+            for i, ep in zip(done_idx, episodes.tolist()):
+                if 'episode' not in infos[i]:
+                    infos[i]['episode'] = dict(zip(EPISODE_DTYPE.names, ep))
+
+        if self.keep_buf:
+            self.epret_buf.extend(episodes['r'].tolist())
+            self.eplen_buf.extend(episodes['l'].tolist())
+        self.epcount += len(done_idx)
+        if self.results_writer:
+            self.results_writer.write_rows(
+                [dict(zip(EPISODE_DTYPE.names, ep)) for ep in episodes.tolist()])
+        return infos
+
+    def close(self):
+        if self.results_writer:
+            self.results_writer.close()
+        return self.venv.close()
@@ -1,6 +1,8 @@
 from . import VecEnvWrapper
-from rlf.baselines.common.running_mean_std import RunningMeanStd
+from .torch_vec_env import TorchVecEnv
+from rlf.baselines.common.running_mean_std import RunningMeanStd, TorchRunningMeanStd
 import numpy as np
+import torch
 import rlf.rl.utils as rutils
 from gym import spaces
 
@@ -8,11 +10,16 @@ from gym import spaces
 class VecNormalize(VecEnvWrapper):
     """
     A vectorized wrapper that normalizes the observations
-    and returns from an environment.
+    and returns from an environment. If `device` is set, the environment
+    returns tensors and the statistics are tensors on `device`, updated
+    in-batch without converting to numpy. This is the default for a
+    `TorchVecEnv`. `use_float64` accumulates the statistics in double
+    precision.
     """
 
     def __init__(self, venv, ob=True, ret=True, clipob=10., cliprew=10.,
-            gamma=0.99, epsilon=1e-8, ret_raw_obs=False):
+            gamma=0.99, epsilon=1e-8, ret_raw_obs=False, device=None,
+            use_float64=False):
         VecEnvWrapper.__init__(self, venv)
 
         if ret_raw_obs:
@@ -21,14 +28,24 @@ class VecNormalize(VecEnvWrapper):
                     'raw_obs',
                     spaces.Box(low=ospace.low, high=ospace.high,
                         dtype=ospace.dtype))
+        if device is None and isinstance(venv.unwrapped, TorchVecEnv):
+            device = venv.unwrapped.device
+        self.device = device
+        self.is_torch = device is not None
+        if self.is_torch:
+            dtype = torch.float64 if use_float64 else torch.float32
+            make_rms = lambda shape: TorchRunningMeanStd(shape=shape,
+                    device=device, dtype=dtype)
+        else:
+            make_rms = lambda shape: RunningMeanStd(shape=shape)
         if ob:
-            self.ob_rms_dict = {k: RunningMeanStd(shape=shp)
+            self.ob_rms_dict = {k: make_rms(shp)
                     for k,shp in rutils.get_ob_shapes(self.observation_space).items()}
         else:
             self.ob_rms_dict = None
 
-        self.ret = np.zeros(self.num_envs)
-        self.ret_rms = RunningMeanStd(shape=()) if ret else None
+        self.ret = self._zero_rets()
+        self.ret_rms = make_rms(()) if ret else None
         self.clipob = clipob
         self.cliprew = cliprew
         self.gamma = gamma
@@ -37,15 +54,59 @@ class VecNormalize(VecEnvWrapper):
 
     def step_wait(self):
         orig_obs, rews, news, infos = self.venv.step_wait()
-        self.ret = self.ret * self.gamma + rews
+        obs, rews = self._filt_step(orig_obs, rews, news)
+        return obs, rews, news, infos
+
+    def _zero_rets(self):
+        if self.is_torch:
+            return torch.zeros(self.num_envs, device=self.device)
+        return np.zeros(self.num_envs)
+
+    def _clip(self, x, clip):
+        if isinstance(x, torch.Tensor):
+            return torch.clamp(x, -clip, clip)
+        return np.clip(x, -clip, clip)
+
+    def _normalize(self, x, rms, clip):
+        x = self._clip((x - rms.mean) / (rms.var + self.epsilon) ** 0.5, clip)
+        if self.is_torch:
+            # The statistics may be accumulated in float64.
+            x = x.float()
+        return x
+
+    def async_reset(self):
+        self.ret = self._zero_rets()
+        self.venv.async_reset()
+
+    def recv(self):
+        orig_obs, rews, news, infos, env_ids = self.venv.recv()
+        obs, rews = self._filt_step(orig_obs, rews, news, env_ids)
+        return obs, rews, news, infos, env_ids
+
+    def _filt_step(self, orig_obs, rews, news, env_ids=slice(None)):
+        """
+        Normalizes the step results of the environments `env_ids`.
+        """
+        if self.is_torch:
+            # The rewards are (N, 1) tensors, possibly on another device.
+            rews_device = rews.device
+            rews = rews.to(self.device)
+            self.ret[env_ids] = self.ret[env_ids] * self.gamma + rews.view(-1)
+        else:
+            self.ret[env_ids] = self.ret[env_ids] * self.gamma + rews
         use_obs = orig_obs
         if self.ret_raw_obs:
             use_obs = rutils.clone_ob(orig_obs)
         obs = self._obfilt(use_obs)
         if self.ret_rms:
-            self.ret_rms.update(self.ret)
-            rews = np.clip(rews / np.sqrt(self.ret_rms.var + self.epsilon), -self.cliprew, self.cliprew)
-        self.ret[news] = 0.
+            self.ret_rms.update(self.ret[env_ids])
+            rews = self._clip(rews / (self.ret_rms.var + self.epsilon) ** 0.5, self.cliprew)
+        if self.is_torch:
+            news = torch.as_tensor(news, dtype=torch.bool, device=self.device)
+            self.ret[env_ids] = self.ret[env_ids].masked_fill(news, 0.)
+            rews = rews.float().to(rews_device)
+        else:
+            self.ret[env_ids] = np.where(news, 0., self.ret[env_ids])
 
         if isinstance(orig_obs, dict):
             orig_obs = rutils.get_def_obs(orig_obs)
@@ -54,23 +115,40 @@ class VecNormalize(VecEnvWrapper):
             obs = rutils.combine_obs(obs, 'raw_obs',
                     rutils.get_def_obs(orig_obs))
 
-        return obs, rews, news, infos
+        return obs, rews
 
     def _obfilt(self, obs):
         if self.ob_rms_dict:
             for k, ob_rms in self.ob_rms_dict.items():
                 if k is None:
                     ob_rms.update(obs)
-                    obs = np.clip((obs - ob_rms.mean) / np.sqrt(ob_rms.var + self.epsilon), -self.clipob, self.clipob)
+                    obs = self._normalize(obs, ob_rms, self.clipob)
                 else:
                     ob_rms.update(obs[k])
-                    obs[k] = np.clip((obs[k] - ob_rms.mean) / np.sqrt(ob_rms.var + self.epsilon), -self.clipob, self.clipob)
+                    obs[k] = self._normalize(obs[k], ob_rms, self.clipob)
             return obs
         else:
             return obs
 
+    def state_dict(self):
+        """
+        The normalization statistics, to be saved in a checkpoint.
+        """
+        return {
+            'ob_rms': None if self.ob_rms_dict is None else
+                {k: rms.state_dict() for k, rms in self.ob_rms_dict.items()},
+            'ret_rms': None if self.ret_rms is None else self.ret_rms.state_dict(),
+        }
+
+    def load_state_dict(self, state):
+        if self.ob_rms_dict is not None and state['ob_rms'] is not None:
+            for k, rms_state in state['ob_rms'].items():
+                self.ob_rms_dict[k].load_state_dict(rms_state)
+        if self.ret_rms is not None and state['ret_rms'] is not None:
+            self.ret_rms.load_state_dict(state['ret_rms'])
+
     def reset(self):
-        self.ret = np.zeros(self.num_envs)
+        self.ret = self._zero_rets()
         orig_obs = self.venv.reset()
         use_obs = orig_obs
         if self.ret_raw_obs:
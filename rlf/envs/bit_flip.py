@@ -68,5 +68,8 @@ class BitFlipInterface(EnvInterface):
     def create_from_id(self, env_id):
         return BitFlipEnv(self.args.bit_flip_n, self.args.bit_flip_reward)
 
+    def get_special_stat_names(self):
+        return ['ep_success']
+
 # Match any version
 register_env_interface(BIT_FLIP_ID.split('-')[0], BitFlipInterface)
@@ -169,6 +169,9 @@ class DmControlWrapper(core.Env):
 
 
 class DmControlInterface(EnvInterface):
+    def releases_gil(self):
+        return True
+
     def env_trans_fn(self, env, set_eval):
         return DmControlWrapper(env, self.args.time_limit)
 
@@ -20,13 +20,34 @@ class EnvInterface(object):
         """
         return True
 
+    def releases_gil(self) -> bool:
+        """
+        If True, the environment releases the GIL for most of its step (for
+        instance MuJoCo physics) so `--vec-env-backend auto` steps it on
+        threads instead of worker processes.
+        """
+        return False
+
     def env_trans_fn(self, env, set_eval):
         return env
 
     def final_trans_fn(self, env):
         return env
 
+    def has_final_trans_fn(self) -> bool:
+        """
+        Whether `final_trans_fn` is overridden. It wraps the environment
+        after the episode statistics of the `Monitor` are recorded, so it can
+        change the rewards and dones that a `VecMonitor` records.
+        """
+        return type(self).final_trans_fn is not EnvInterface.final_trans_fn
+
     def get_special_stat_names(self):
+        """
+        The names of the scalar `ep_` statistics in the info dictionary.
+        Declaring them lets the multi-process vectorized env return them
+        through shared arrays instead of pickling them.
+        """
         return []
 
     def get_render_args(self):
@@ -76,12 +97,18 @@ class EnvInterfaceWrapper(EnvInterface):
         super().setup(args, task_id)
         self.env_int.setup(args, task_id)
 
+    def releases_gil(self):
+        return self.env_int.releases_gil()
+
     def env_trans_fn(self, env, set_eval):
         return self.env_int.env_trans_fn(env, set_eval)
 
     def final_trans_fn(self, env):
         return self.env_int.final_trans_fn(env)
 
+    def has_final_trans_fn(self):
+        return self.env_int.has_final_trans_fn()
+
     def get_special_stat_names(self):
         return self.env_int.get_special_stat_names()
 
@@ -119,6 +119,9 @@ class GymFetchInterface(EnvInterface):
             env.env.env._max_episode_steps = self.args.mod_n_steps
         return env
 
+    def get_special_stat_names(self):
+        return ["ep_found_goal", "ep_dist_to_goal"]
+
     def get_add_args(self, parser):
         super().get_add_args(parser)
         parser.add_argument("--gf-dense", type=str2bool, default=True)
@@ -138,6 +138,9 @@ class MinigridInterface(EnvInterface):
             env = DirectionObsWrapper(env)
         return env
 
+    def get_special_stat_names(self):
+        return ['ep_found_goal']
+
     def get_add_args(self, parser):
         parser.add_argument('--gw-mode', type=str, default='flat', help="""
                 Options are: [flat,img]
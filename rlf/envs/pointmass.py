@@ -4,7 +4,7 @@ import torch
 from gym import spaces
 from rlf import EnvInterface, register_env_interface
 from rlf.args import str2bool
-from rlf.baselines.vec_env.vec_env import VecEnv
+from rlf.baselines.vec_env.torch_vec_env import TorchVecEnv
 from torch.distributions import Uniform
 
 VEL_LIMIT = 20.0
@@ -29,7 +29,7 @@ class PointMassEnvSpawnRange(gym.Env):
         raise NotImplementedError(ERROR_MSG)
 
 
-class BatchedTorchPointMassEnvSpawnRange(VecEnv):
+class BatchedTorchPointMassEnvSpawnRange(TorchVecEnv):
     def __init__(
         self,
         fast_env,
@@ -54,23 +54,19 @@ class BatchedTorchPointMassEnvSpawnRange(VecEnv):
         else:
             self.dt = 1 / 100.0
         self.pos_dim = 2
-        self._device = device
-        self._goal = torch.tensor([0.0, 0.0]).to(self._device)
-        self._ep_step = 0
-
-        self._ep_rewards = []
 
         super().__init__(
             self._batch_size,
             spaces.Box(low=-1.0, high=1.0, shape=(2,)),
             spaces.Box(low=-1.0, high=1.0, shape=(2,)),
+            device,
+        )
+        self._goal = torch.tensor([0.0, 0.0], device=self.device)
+        self.cur_pos = torch.zeros(self._batch_size, self.pos_dim, device=self.device)
+        self.cur_vel = torch.zeros(self._batch_size, self.pos_dim, device=self.device)
+        self._ep_step = torch.zeros(
+            self._batch_size, dtype=torch.long, device=self.device
         )
-
-    def step_async(self, actions):
-        pass
-
-    def step_wait(self):
-        pass
 
     def forward(self, cur_pos, cur_vel, action):
         new_vel = cur_vel + action * 0.2
@@ -79,7 +75,7 @@ class BatchedTorchPointMassEnvSpawnRange(VecEnv):
         new_pos = cur_pos + (cur_vel * self.dt)
         return new_pos, new_vel
 
-    def step(self, action):
+    def _step_batch(self, action):
         self.cur_pos, self.cur_vel = self.forward(self.cur_pos, self.cur_vel, action)
         self._ep_step += 1
 
@@ -89,49 +85,49 @@ class BatchedTorchPointMassEnvSpawnRange(VecEnv):
         )
 
         reward = -(1 / 10.0) * dist_to_goal
-        self._ep_rewards.append(reward)
-
-        all_is_done = [is_done for _ in range(self._batch_size)]
-
-        all_info = [
-            {"ep_dist_to_goal": dist_to_goal[i].item()} for i in range(self._batch_size)
-        ]
-
-        if is_done:
-            final_obs = self._get_obs()
-            for i in range(self._batch_size):
-                all_info[i]["episode"] = {
-                    "r": torch.stack(self._ep_rewards).sum(0)[i].item()
-                }
-                all_info[i]["final_obs"] = final_obs[i]
-            self.reset()
 
-        return (self._get_obs(), reward, all_is_done, all_info)
+        return (
+            self._get_obs(),
+            reward,
+            is_done,
+            {"ep_dist_to_goal": dist_to_goal.view(-1)},
+        )
 
     def _get_regions(self, offset, spread):
         inc = np.pi / 2
 
         centers = [offset + i * inc for i in range(4)]
 
-        return torch.tensor([[center - spread, center + spread] for center in centers])
+        return torch.tensor(
+            [[center - spread, center + spread] for center in centers],
+            device=self.device,
+        )
 
-    def reset(self):
+    def _sample_start_pos(self):
+        """
+        Start positions of all the environments.
+        """
         if self._is_eval:
-            idx = torch.randint(0, 4, (self._batch_size,))
+            idx = torch.randint(0, 4, (self._batch_size,), device=self.device)
             regions = self._get_regions(0.0, self._start_noise)
         else:
-            idx = torch.randint(0, self._num_train_regions, (self._batch_size,))
+            idx = torch.randint(
+                0, self._num_train_regions, (self._batch_size,), device=self.device
+            )
             regions = self._get_regions(np.pi / 4, self._start_noise)
 
         ang = Uniform(regions[idx, 0], regions[idx, 1]).sample()
         radius = np.sqrt(2)
-        self.cur_pos = (
+        return (
             torch.stack([radius * torch.cos(ang), radius * torch.sin(ang)], dim=-1)
             + self._goal
         )
-        self.cur_vel = torch.zeros(self._batch_size, 2)
-        self._ep_step = 0
-        self._ep_rewards = []
+
+    def _reset_envs(self, env_mask):
+        mask = env_mask.unsqueeze(-1)
+        self.cur_pos = torch.where(mask, self._sample_start_pos(), self.cur_pos)
+        self.cur_vel = self.cur_vel.masked_fill(mask, 0.0)
+        self._ep_step = self._ep_step.masked_fill(env_mask, 0)
 
         return self._get_obs()
 
@@ -140,8 +136,7 @@ class BatchedTorchPointMassEnvSpawnRange(VecEnv):
 
 
 class BatchedTorchPointMassEnvSingleSpawn(BatchedTorchPointMassEnvSpawnRange):
-    def reset(self):
-        super().reset()
+    def _sample_start_pos(self):
         # Points must move clockwise starting from quadrant 1.
         all_start = torch.tensor(
             [
@@ -149,11 +144,10 @@ class BatchedTorchPointMassEnvSingleSpawn(BatchedTorchPointMassEnvSpawnRange):
                 [-1.0, 1.0],
                 [-1.0, -1.0],
                 [1.0, -1.0],
-            ]
+            ],
+            device=self.device,
         ).view(-1, 1, 2)
-        self.cur_vel = torch.zeros(self._batch_size, 2)
-        self.cur_pos = all_start[self._pm_start_idx].repeat(self._batch_size, 1)
-        return self._get_obs()
+        return all_start[self._pm_start_idx].repeat(self._batch_size, 1)
 
 
 class PointMassInterface(EnvInterface):
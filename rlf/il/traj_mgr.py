@@ -62,6 +62,9 @@ class TrajSaver(object):
         - obs (tensor[n_processes, *obs_dim])
         - done (list(bool)[n_processes])
         """
+        # Observations from the environment are only valid until the next
+        # steps so they must be copied.
+        obs_cp = rutils.obs_op(obs, lambda x: x.clone())
         next_obs_cp = rutils.obs_op(next_obs, lambda x: x.clone())
         # Only count trajectories that satisfy the `self.should_save_traj` condition
         num_done = 0
@@ -71,7 +74,7 @@ class TrajSaver(object):
                 next_obs_cp[i] = torch.tensor(info[i]["final_obs"]).to(action.device)
             self.traj_buffer[i].append(
                 (
-                    rutils.obs_select(obs, i),
+                    rutils.obs_select(obs_cp, i),
                     rutils.obs_select(next_obs_cp, i),
                     done[i],
                     action[i],
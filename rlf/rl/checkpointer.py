@@ -47,6 +47,12 @@ class Checkpointer(object):
     def get_save_path(self):
         return self.model_dir_name
 
+    def get_storage_dir(self):
+        """
+        Directory of the incremental checkpoints of the storage.
+        """
+        return osp.join(self.model_dir_name, 'storage')
+
     def flush(self, num_updates):
         if not self.should_save():
             return
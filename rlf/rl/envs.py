@@ -1,3 +1,4 @@
+import argparse
 import os
 from functools import partial
 
@@ -6,20 +7,33 @@ import numpy as np
 import rlf.rl.utils as rutils
 import torch
 from gym.spaces.box import Box
+from rlf.baselines import logger
 from rlf.baselines.common.atari_wrappers import (WarpFrame, make_atari,
                                                  wrap_deepmind)
 from rlf.baselines.monitor import Monitor
 from rlf.baselines.vec_env import VecEnvWrapper
 from rlf.baselines.vec_env.dummy_vec_env import DummyVecEnv
 from rlf.baselines.vec_env.shmem_vec_env import ShmemVecEnv
+from rlf.baselines.vec_env.thread_vec_env import ThreadVecEnv
+from rlf.baselines.vec_env.torch_vec_env import TorchVecEnv
+from rlf.baselines.vec_env.vec_monitor import VecMonitor
 from rlf.baselines.vec_env.vec_normalize import VecNormalize as VecNormalize_
 
 
-def wrap_in_vec_normalize(envs, gamma, alg_env_settings):
+def wrap_in_vec_normalize(envs, gamma, alg_env_settings, device=None, use_float64=False):
+    """
+    :param device: If specified, `envs` returns tensors and the normalization
+        statistics are kept on this device.
+    """
+    kwargs = {
+        "ret_raw_obs": alg_env_settings.ret_raw_obs,
+        "device": device,
+        "use_float64": use_float64,
+    }
     if gamma is None:
-        return VecNormalize(envs, ret=False, ret_raw_obs=alg_env_settings.ret_raw_obs)
+        return VecNormalize(envs, ret=False, **kwargs)
     else:
-        return VecNormalize(envs, gamma=gamma, ret_raw_obs=alg_env_settings.ret_raw_obs)
+        return VecNormalize(envs, gamma=gamma, **kwargs)
 
 
 def get_vec_normalize(venv):
@@ -31,6 +45,68 @@ def get_vec_normalize(venv):
     return None
 
 
+def get_info_keys(env_interface, alg_env_settings):
+    """
+    The info keys the vectorized env returns as arrays in addition to the
+    default ones: the `ep_` statistics of the environment and the
+    `include_info_keys` of the algorithm.
+    """
+    info_keys = [(k, (), np.float64) for k in env_interface.get_special_stat_names()]
+    info_keys.extend(alg_env_settings.include_info_keys)
+    return info_keys
+
+
+def get_vec_env_backend(args, num_envs, env_interface):
+    """
+    The vectorized env used for `num_envs` environments. "auto" steps a
+    single environment in this process, the environments that release the
+    GIL on a thread pool and the others in worker processes.
+    """
+    if args.vec_env_backend != "auto":
+        return args.vec_env_backend
+    if num_envs == 1 and not args.force_multi_proc:
+        return "dummy"
+    if env_interface.releases_gil():
+        return "thread"
+    return "shmem"
+
+
+def get_async_batch_size(args, num_processes):
+    """
+    Number of environments returned by each `recv` of the vectorized env.
+    With `--rollout-double-buffer` it is one of the two halves.
+    """
+    if args.rollout_double_buffer:
+        return num_processes // 2
+    return args.async_batch_size
+
+
+def use_vec_monitor(args, env_interface):
+    """
+    Whether the episode statistics are tracked by a `VecMonitor` instead of
+    a `Monitor` per environment. By default only if it records the same
+    rewards and dones, when the env interface has no `final_trans_fn`.
+    """
+    if args.vec_monitor is not None:
+        return args.vec_monitor
+    return not env_interface.has_final_trans_fn()
+
+
+def get_spaces_key(env_name, set_eval, env_interface, args):
+    """
+    Key of the spaces of the environments created by `make_vec_envs`. The
+    spaces depend on the settings of the environment wrappers of `make_env`
+    and on the arguments added by the env interface.
+    """
+    env_parser = argparse.ArgumentParser()
+    env_interface.get_add_args(env_parser)
+    env_arg_names = sorted(
+        action.dest for action in env_parser._actions if action.dest != "help"
+    )
+    env_args = tuple((k, str(getattr(args, k, None))) for k in env_arg_names)
+    return (env_name, set_eval, args.warp_frame, args.transpose_frame, env_args)
+
+
 def make_env(
     rank,
     env_id,
@@ -65,7 +141,10 @@ def make_env(
         if hasattr(env.action_space, "seed"):
             env.action_space.seed(seed + rank)
 
-        env = Monitor(env, None, allow_early_resets=allow_early_resets)
+        if is_atari or not use_vec_monitor(args, env_interface):
+            # The Atari wrappers clip the rewards and end the episodes on a
+            # life loss, the statistics are of the original game.
+            env = Monitor(env, None, allow_early_resets=allow_early_resets)
 
         obs_space = env.observation_space
 
@@ -131,7 +210,8 @@ def make_vec_envs(
     """
     :param previous_env: Takes the action and observation space from this
         environment. If specified this avoids creating another dummy environment to
-        fetch the observation and action space.
+        fetch the observation and action space. With `--share-eval-workers` the
+        environments are hosted by the worker processes of this environment.
     """
 
     if args.render_metric and set_eval and num_processes > 1:
@@ -153,7 +233,8 @@ def make_vec_envs(
         for i in range(num_processes)
     ]
 
-    if len(envs) > 1 or args.force_multi_proc:
+    backend = get_vec_env_backend(args, len(envs), env_interface)
+    if backend == "shmem":
         custom_envs = env_interface.get_setup_multiproc_fn(
             make_env,
             env_name,
@@ -164,36 +245,117 @@ def make_vec_envs(
             alg_env_settings,
             args,
         )
-        if custom_envs is None:
+        shared_envs = None
+        if args.share_eval_workers and previous_env is not None:
+            shared_envs = previous_env.unwrapped
+            if not isinstance(shared_envs, ShmemVecEnv):
+                logger.warn(
+                    "--share-eval-workers requires multi-process training "
+                    "environments, starting other workers"
+                )
+                shared_envs = None
+            elif shared_envs.num_envs != len(envs):
+                logger.warn(
+                    f"--share-eval-workers requires as many evaluation "
+                    f"environments as training environments ({len(envs)} != "
+                    f"{shared_envs.num_envs}), starting other workers"
+                )
+                shared_envs = None
+
+        if custom_envs is None and shared_envs is not None:
+            envs = shared_envs.share_workers(envs)
+        elif custom_envs is None:
             extra_kwargs = {}
             if previous_env is not None:
                 extra_kwargs["spaces"] = (
                     previous_env.observation_space,
                     previous_env.action_space,
                 )
-            envs = ShmemVecEnv(envs, context=args.context_mode, **extra_kwargs)
+            envs = ShmemVecEnv(
+                envs,
+                context=args.context_mode,
+                double_buffer=args.vec_env_double_buffer,
+                envs_per_worker=args.envs_per_worker,
+                # The evaluation only steps the environments synchronously.
+                batch_size=None
+                if set_eval
+                else get_async_batch_size(args, len(envs)),
+                protocol=args.vec_env_protocol,
+                spare_reset=args.spare_reset,
+                info_keys=get_info_keys(env_interface, alg_env_settings),
+                spaces_key=get_spaces_key(env_name, set_eval, env_interface, args),
+                preload=[m for m in args.forkserver_preload.split(",") if m != ""],
+                **extra_kwargs
+            )
         else:
             envs = custom_envs
+    elif backend == "thread":
+        envs = ThreadVecEnv(
+            envs,
+            num_threads=args.vec_env_threads,
+            double_buffer=args.vec_env_double_buffer,
+            spare_reset=args.spare_reset,
+        )
+    elif backend == "dummy":
+        envs = DummyVecEnv(
+            envs,
+            double_buffer=args.vec_env_double_buffer,
+            spare_reset=args.spare_reset,
+        )
+
     else:
-        envs = DummyVecEnv(envs)
+        raise ValueError(f"Unrecognized vectorized env backend {backend}")
+
+    # A `TorchVecEnv` tracks its own episode statistics.
+    if use_vec_monitor(args, env_interface) and not isinstance(
+        envs.unwrapped, TorchVecEnv
+    ):
+        envs = VecMonitor(envs)
 
     ob_shapes = rutils.get_ob_shapes(envs.observation_space)
 
     single_shapes = {k: v for k, v in ob_shapes.items() if len(v) == 1}
 
     use_env_norm = not set_eval and len(single_shapes) > 0 and args.normalize_env
-    if use_env_norm:
-        envs = wrap_in_vec_normalize(envs, gamma, alg_env_settings)
 
-    if env_interface.requires_tensor_wrap():
+    # A `TorchVecEnv` already returns tensors.
+    use_tensor_wrap = env_interface.requires_tensor_wrap() and not isinstance(
+        envs.unwrapped, TorchVecEnv
+    )
+    if use_tensor_wrap:
         envs = VecPyTorch(envs, device)
 
+    if use_env_norm:
+        # The normalization is applied to the tensors on the policy device.
+        envs = wrap_in_vec_normalize(
+            envs,
+            gamma,
+            alg_env_settings,
+            device=device if use_tensor_wrap else None,
+            use_float64=args.env_norm_float64,
+        )
+
+    if use_tensor_wrap:
         triple_shapes = {k: v for k, v in ob_shapes.items() if len(v) == 3}
         if num_frame_stack is not None and args.frame_stack:
             envs = VecPyTorchFrameStack(envs, num_frame_stack, device)
         elif len(triple_shapes) > 0 and args.frame_stack:
             envs = VecPyTorchFrameStack(envs, 4, device)
 
+    if not set_eval and get_async_batch_size(args, num_processes) is not None:
+        # The asynchronous rollouts step the environments with `send`.
+        unsupported = None
+        if isinstance(envs.unwrapped, TorchVecEnv):
+            unsupported = "a TorchVecEnv"
+        elif isinstance(envs, VecPyTorchFrameStack):
+            unsupported = "frame stacking (--frame-stack False disables it)"
+        if unsupported is not None:
+            envs.close()
+            raise ValueError(
+                "--async-batch-size and --rollout-double-buffer do not "
+                f"support {unsupported}"
+            )
+
     if (alg_env_settings.state_fn is not None) or (
         alg_env_settings.action_fn is not None
     ):
@@ -259,18 +421,31 @@ class EnvNormFnWrapper(VecEnvWrapper):
         self.action_fn = action_fn
         self.device = device
 
-    def step_wait(self):
-        obs, reward, done, info = self.venv.step_wait()
+    def _trans_obs(self, obs, info):
         if self.state_fn is not None:
             obs = self.state_fn(obs)
         if "final_obs" in info:
             info["final_obs"] = self.state_fn(info["final_obs"])
-        return obs, reward, done, info
+        return obs
 
-    def step_async(self, actions):
+    def _trans_actions(self, actions):
         if self.action_fn is not None:
             actions = self.action_fn(actions.to(self.device)).cpu()
-        self.venv.step_async(actions)
+        return actions
+
+    def step_wait(self):
+        obs, reward, done, info = self.venv.step_wait()
+        return self._trans_obs(obs, info), reward, done, info
+
+    def step_async(self, actions):
+        self.venv.step_async(self._trans_actions(actions))
+
+    def recv(self):
+        obs, reward, done, info, env_ids = self.venv.recv()
+        return self._trans_obs(obs, info), reward, done, info, env_ids
+
+    def send(self, actions, env_ids):
+        self.venv.send(self._trans_actions(actions), env_ids)
 
     def reset(self):
         return self.venv.reset()
@@ -361,6 +536,9 @@ class VecPyTorch(VecEnvWrapper):
     def __init__(self, venv, device):
         super(VecPyTorch, self).__init__(venv)
         self.device = device
+        # The observations of a single buffered env are overwritten by the
+        # next step while the runner still holds them, so they are copied.
+        self.copy_obs = not getattr(venv.unwrapped, "double_buffer", False)
 
     def _data_convert(self, arr):
         if isinstance(arr, np.ndarray) and arr.dtype == np.float64:
@@ -372,18 +550,29 @@ class VecPyTorch(VecEnvWrapper):
         obs = self._trans_obs(obs)
         return obs
 
-    def step_async(self, actions):
+    def _trans_actions(self, actions):
         if isinstance(actions, torch.LongTensor):
             # Squeeze the dimension for discrete actions
             actions = actions.squeeze(1)
-        actions = actions.cpu().numpy()
-        self.venv.step_async(actions)
+        return actions.cpu().numpy()
+
+    def step_async(self, actions):
+        self.venv.step_async(self._trans_actions(actions))
+
+    def send(self, actions, env_ids):
+        self.venv.send(self._trans_actions(actions), env_ids)
 
     def _trans_obs(self, obs):
         # Support for dict observations
         def _convert_obs(x):
             x = self._data_convert(x)
-            x = torch.Tensor(x)
+            # Shares memory with the double buffered vectorized env buffer,
+            # only non float32 observations are copied when converting. uint8
+            # images are kept as uint8 and scaled by the CNN, the other uint8
+            # observations go to MLPs and are cast to float.
+            x = torch.tensor(x) if self.copy_obs else torch.as_tensor(x)
+            if x.dtype != torch.uint8 or x.dim() != 4:
+                x = x.float()
             x = x.to(self.device)
             return x
 
@@ -394,15 +583,19 @@ class VecPyTorch(VecEnvWrapper):
             obs = _convert_obs(obs)
         return obs
 
-    def step_wait(self):
-        obs, reward, done, info = self.venv.step_wait()
-        obs = self._trans_obs(obs)
-
+    def _trans_reward(self, reward):
         reward = torch.Tensor(reward).unsqueeze(dim=1)
         # Reward is sometimes a Double. Observation is considered to always be
         # float32
-        reward = reward.float()
-        return obs, reward, done, info
+        return reward.float()
+
+    def step_wait(self):
+        obs, reward, done, info = self.venv.step_wait()
+        return self._trans_obs(obs), self._trans_reward(reward), done, info
+
+    def recv(self):
+        obs, reward, done, info, env_ids = self.venv.recv()
+        return self._trans_obs(obs), self._trans_reward(reward), done, info, env_ids
 
 
 class VecNormalize(VecNormalize_):
@@ -419,21 +612,13 @@ class VecNormalize(VecNormalize_):
                 if k is None:
                     if self.training and update:
                         ob_rms.update(obs)
-                    obs = np.clip(
-                        (obs - ob_rms.mean) / np.sqrt(ob_rms.var + self.epsilon),
-                        -self.clipob,
-                        self.clipob,
-                    )
+                    obs = self._normalize(obs, ob_rms, self.clipob)
                 else:
                     if k not in obs:
                         continue
                     if self.training and update:
                         ob_rms.update(obs[k])
-                    obs[k] = np.clip(
-                        (obs[k] - ob_rms.mean) / np.sqrt(ob_rms.var + self.epsilon),
-                        -self.clipob,
-                        self.clipob,
-                    )
+                    obs[k] = self._normalize(obs[k], ob_rms, self.clipob)
             return obs
         else:
             return obs
@@ -460,7 +645,11 @@ class VecPyTorchFrameStack(VecEnvWrapper):
         ob_space = rutils.get_obs_space(venv.observation_space)
 
         self.stacked_obs = rutils.StackHelper(
-            ob_space.shape, nstack, device, venv.num_envs
+            ob_space.shape,
+            nstack,
+            device,
+            venv.num_envs,
+            dtype=rutils.get_torch_dtype(ob_space.dtype, ob_space.shape),
         )
         new_obs_space = rutils.update_obs_space(
             venv.observation_space,
@@ -485,5 +674,8 @@ class VecPyTorchFrameStack(VecEnvWrapper):
         obs = rutils.set_def_obs(obs, stacked_obs)
         return obs
 
+    def send(self, actions, env_ids):
+        raise NotImplementedError("Frame stacking does not support asynchronous steps")
+
     def close(self):
         self.venv.close()
@@ -227,8 +227,8 @@ def evaluate(
     while evaluated_episode_count < total_num_eval:
         step_info = get_empty_step_info()
         with torch.no_grad():
-            act_obs = obfilt(rutils.ob_to_np(obs), update=False)
-            act_obs = rutils.ob_to_tensor(act_obs, args.device)
+            # The normalization statistics are on the policy device.
+            act_obs = obfilt(obs, update=False)
 
             ac_info = policy.get_action(
                 rutils.get_def_obs(act_obs),
@@ -247,14 +247,14 @@ def evaluate(
                 obs, next_obs, done, ac_info.take_action, infos
             )
         else:
-            finished_count = sum([int(d) for d in done])
+            finished_count = rutils.get_num_done(done)
 
         if alg_env_settings.on_traj_finished is not None:
             for i in range(num_processes):
                 if done[i]:
                     trajs[i].append(
                         (
-                            obs[i],
+                            obs[i].clone(),
                             torch.tensor(infos[i]["final_obs"]).to(obs.device),
                             ac_info.action,
                         )
@@ -263,7 +263,10 @@ def evaluate(
                     infos[i].update(add_info)
                     trajs[i] = []
                 else:
-                    trajs[i].append((obs[i], next_obs[i], ac_info.action))
+                    # Clone since the env observation buffers are reused.
+                    trajs[i].append(
+                        (obs[i].clone(), next_obs[i].clone(), ac_info.action)
+                    )
 
         pbar.update(finished_count)
         evaluated_episode_count += finished_count
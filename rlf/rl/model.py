@@ -90,51 +90,51 @@ class BaseNet(nn.Module):
             # x is a (T, N, -1) tensor that has been flatten to (T * N, -1)
             N = rnn_hxs.size(0)
             T = int(x.size(0) / N)
-
-            # unflatten
-            x = x.view(T, N, x.size(1))
-
-            # Same deal with masks
-            masks = masks.view(T, N)
-
-            # Let's figure out which steps in the sequence have a zero for any agent
-            # We will always assume t=0 has a zero in it as that makes the logic cleaner
-            has_zeros = (masks[1:] == 0.0).any(dim=-1).nonzero().squeeze().cpu()
-
-            # +1 to correct the masks[1:]
-            if has_zeros.dim() == 0:
-                # Deal with scalar
-                has_zeros = [has_zeros.item() + 1]
-            else:
-                has_zeros = (has_zeros + 1).numpy().tolist()
-
-            # add t=0 and t=T to the list
-            has_zeros = [0] + has_zeros + [T]
-
-            rnn_hxs = rnn_hxs.unsqueeze(0)
-            outputs = []
-            for i in range(len(has_zeros) - 1):
-                # We can now process steps that don't have any zeros in masks together!
-                # This is much faster
-                start_idx = has_zeros[i]
-                end_idx = has_zeros[i + 1]
-
-                rnn_scores, rnn_hxs = self.gru(
-                    x[start_idx:end_idx], rnn_hxs * masks[start_idx].view(1, -1, 1)
-                )
-
-                outputs.append(rnn_scores)
-
-            # assert len(outputs) == T
-            # x is a (T, N, -1) tensor
-            x = torch.cat(outputs, dim=0)
+            x, rnn_hxs = self._forward_gru_segments(
+                x.view(T, N, x.size(1)), rnn_hxs, masks.view(T, N)
+            )
             # flatten
-            x = x.view(T * N, -1)
-            rnn_hxs = rnn_hxs.squeeze(0)
+            x = x.reshape(T * N, -1)
 
         hidden_state["rnn_hxs"] = rnn_hxs
         return x, hidden_state
 
+    def _forward_gru_segments(self, x, rnn_hxs, masks):
+        """
+        Runs the GRU over the (T, N, -1) inputs `x` in one call. The sequence
+        of each environment is split into segments at the zero `masks`
+        (episode starts) and the segments are packed as separate sequences.
+        Only the first segment of each environment starts from `rnn_hxs`.
+        Returns the (T, N, -1) outputs and the (N, -1) final hidden states.
+        """
+        T, N = masks.shape
+        # Environment major order, step t of environment n is at n * T + t.
+        starts = masks.t() == 0.0
+        starts[:, 0] = True
+        starts = starts.reshape(-1)
+        seg_ids = starts.long().cumsum(0) - 1
+        seg_starts = starts.nonzero().squeeze(-1)
+        pos_in_seg = torch.arange(N * T, device=x.device) - seg_starts[seg_ids]
+        seg_lens = torch.bincount(seg_ids, minlength=len(seg_starts)).cpu()
+        max_len = int(seg_lens.max())
+
+        padded = x.new_zeros(len(seg_starts), max_len, x.size(-1))
+        padded[seg_ids, pos_in_seg] = x.transpose(0, 1).reshape(N * T, -1)
+        first_segs = seg_ids.view(N, T)[:, 0]
+        h0 = rnn_hxs.new_zeros(1, len(seg_starts), rnn_hxs.size(-1))
+        h0[0, first_segs] = rnn_hxs * masks[0].view(-1, 1)
+
+        packed = nn.utils.rnn.pack_padded_sequence(
+            padded, seg_lens, batch_first=True, enforce_sorted=False
+        )
+        out, h_n = self.gru(packed, h0)
+        out, _ = nn.utils.rnn.pad_packed_sequence(
+            out, batch_first=True, total_length=max_len
+        )
+        out = out[seg_ids, pos_in_seg].view(N, T, -1).transpose(0, 1)
+        last_segs = seg_ids.view(N, T)[:, -1]
+        return out, h_n[0, last_segs]
+
 
 class IdentityBase(BaseNet):
     def __init__(self, input_shape):
@@ -206,7 +206,8 @@ class CNNBase(BaseNet):
         self.train()
 
     def forward(self, inputs, hxs, masks):
-        x = self.net(inputs / 255.0)
+        # The images are uint8 up to here, scale them to float.
+        x = self.net(inputs.float() / 255.0)
 
         if self.is_recurrent:
             x, hxs = self._forward_gru(x, hxs, masks)
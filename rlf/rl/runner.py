@@ -6,10 +6,35 @@ import torch
 from rlf.algos.base_net_algo import BaseNetAlgo
 from rlf.algos.custom_iter_algo import CustomIterAlgo
 from rlf.baselines.vec_env import VecEnvWrapper
-from rlf.policies.base_policy import get_step_info
+from rlf.policies.base_policy import ActionData, get_step_info
 from rlf.rl import utils
 from rlf.rl.envs import get_vec_normalize, make_vec_envs, wrap_in_vec_normalize
 from rlf.rl.evaluation import full_eval, train_eval
+from rlf.storage.rollout_storage import RolloutStorage
+
+
+def _select_action_data(rows):
+    """
+    Combines the policy outputs of several environments into one `ActionData`.
+    - rows: list of (ActionData, index of the environment in the ActionData).
+    """
+
+    def _cat(get_val):
+        vals = [get_val(ac_info) for ac_info, _ in rows]
+        if not isinstance(vals[0], torch.Tensor) or vals[0].dim() == 0:
+            return vals[0]
+        return torch.cat([val[i : i + 1] for val, (_, i) in zip(vals, rows)])
+
+    ac_info = ActionData(
+        _cat(lambda x: x.value),
+        _cat(lambda x: x.action),
+        _cat(lambda x: x.action_log_probs),
+        {k: _cat(lambda x: x.hxs[k]) for k in rows[0][0].hxs},
+        rows[-1][0].extra,
+        _cat(lambda x: x.add_reward),
+    )
+    ac_info.take_action = _cat(lambda x: x.take_action)
+    return ac_info
 
 
 class Runner:
@@ -85,12 +110,89 @@ class Runner:
 
             step_log_vals = utils.agg_ep_log_stats(infos, ac_info.extra)
 
-            self.episode_count += sum([int(d) for d in done])
+            self.episode_count += utils.get_num_done(done)
             self.log.collect_step_info(step_log_vals)
 
             storage.insert(obs, next_obs, reward, done, infos, ac_info)
         return self.storage
 
+    def rl_rollout_async(self, policy, storage, update_iter, env_groups=None):
+        """
+        Collects `num_steps` transitions for every environment without
+        stepping the environments in lockstep. The policy acts on the first
+        environments that finish their step (see `VecEnv.recv`) and each
+        environment is stored at its own step in the storage so the returns
+        are computed over its own trajectory.
+        - env_groups: list of arrays of environment ids. The first steps of
+          the groups are sent one after the other, so the policy acts on a
+          group while the previous ones step. Defaults to a single group of
+          all the environments.
+        """
+        num_steps = self.args.num_steps
+        # Policy output of the pending step of each environment.
+        pending = {}
+        if env_groups is None:
+            env_groups = [np.arange(self.args.num_processes)]
+        env_groups = list(env_groups)
+        num_inserted = 0
+        while True:
+            if len(env_groups) > 0:
+                env_ids = env_groups.pop(0)
+            # Environments that have all their transitions for this update
+            # wait for the next update.
+            env_ids = env_ids[storage.get_env_steps(env_ids).numpy() < num_steps]
+            if len(env_ids) > 0:
+                obs = storage.get_env_obs(env_ids)
+                step_info = get_step_info(
+                    update_iter,
+                    num_inserted // self.args.num_processes,
+                    self.episode_count,
+                    self.args,
+                )
+                with self.train_ctx():
+                    ac_info = policy.get_action(
+                        utils.get_def_obs(obs, self.args.policy_ob_key),
+                        utils.get_other_obs(obs),
+                        storage.get_env_hidden_state(env_ids),
+                        storage.get_env_masks(env_ids),
+                        step_info,
+                    )
+                    if self.args.clip_actions:
+                        ac_info.clip_action(*self.ac_tensor)
+                self.envs.send(ac_info.take_action, env_ids)
+                for i, env_id in enumerate(env_ids):
+                    pending[env_id] = (ac_info, i)
+            if len(env_groups) > 0:
+                continue
+
+            if len(pending) == 0:
+                break
+            next_obs, reward, done, infos, env_ids = self.envs.recv()
+            ac_info = _select_action_data([pending.pop(env_id) for env_id in env_ids])
+            obs = storage.get_env_obs(env_ids)
+
+            reward += ac_info.add_reward
+
+            step_log_vals = utils.agg_ep_log_stats(infos, ac_info.extra)
+
+            self.episode_count += utils.get_num_done(done)
+            self.log.collect_step_info(step_log_vals)
+
+            storage.insert(obs, next_obs, reward, done, infos, ac_info, env_ids)
+            num_inserted += len(env_ids)
+        return self.storage
+
+    def rl_rollout_double_buffer(self, policy, storage, update_iter):
+        """
+        Collects the rollout with the environments split in two halves. The
+        vectorized env returns one half per `recv` (see
+        `get_async_batch_size`), so one half steps in the workers while the
+        policy acts on the other one. The halves hold whole workers, see
+        `rlf.args.check_args`.
+        """
+        env_groups = np.arange(self.args.num_processes).reshape(2, -1)
+        return self.rl_rollout_async(policy, storage, update_iter, env_groups)
+
     def training_iter(self, update_iter: int) -> Dict[str, Any]:
         self.log.start_interval_log()
         self.updater.pre_update(update_iter)
@@ -99,6 +201,12 @@ class Runner:
             updater_log_vals = self.updater.training_iter(
                 self.rl_rollout, self.storage, update_iter
             )
+        elif self.args.rollout_double_buffer:
+            self.rl_rollout_double_buffer(self.policy, self.storage, update_iter)
+            updater_log_vals = self.updater.update(self.storage)
+        elif self.args.async_batch_size is not None:
+            self.rl_rollout_async(self.policy, self.storage, update_iter)
+            updater_log_vals = self.updater.update(self.storage)
         else:
             self.rl_rollout(self.policy, self.storage, update_iter)
             updater_log_vals = self.updater.update(self.storage)
@@ -124,6 +232,10 @@ class Runner:
         self.updater.first_train(self.log, self._eval_policy, self.env_interface)
         if self.args.clip_actions:
             self.ac_tensor = utils.ac_space_to_tensor(self.policy.action_space)
+        if (
+            self.args.async_batch_size is not None or self.args.rollout_double_buffer
+        ) and not isinstance(self.storage, RolloutStorage):
+            raise ValueError("Asynchronous rollouts require a RolloutStorage")
 
     def easy_make_vec_envs(
         self, args, num_processes=None, set_eval=True, seed_offset=0, env_name=None
@@ -179,11 +291,12 @@ class Runner:
         ) and self.checkpointer.should_save():
             vec_norm = get_vec_normalize(self.envs)
             if vec_norm is not None:
-                self.checkpointer.save_key("ob_rms", vec_norm.ob_rms_dict)
+                self.checkpointer.save_key("env_norm", vec_norm.state_dict())
             self.checkpointer.save_key("step", update_iter)
 
             self.policy.save(self.checkpointer)
             self.updater.save(self.checkpointer)
+            self.storage.save(self.checkpointer)
 
             self.checkpointer.flush(num_updates=update_iter)
             if self.args.sync:
@@ -203,6 +316,7 @@ class Runner:
 
     def close(self):
         self.log.close()
+        self.storage.close()
         if self.train_eval_envs is not None:
             self.train_eval_envs.close()
         self.envs.close()
@@ -210,6 +324,7 @@ class Runner:
     def resume(self):
         self.updater.load_resume(self.checkpointer)
         self.policy.load_resume(self.checkpointer)
+        self.storage.load_resume(self.checkpointer)
         return self.checkpointer.get_key("step")
 
     def should_load_from_checkpoint(self):
@@ -219,13 +334,15 @@ class Runner:
         alg_env_settings = self.updater.get_env_settings(self.args)
 
         vec_norm = None
-        if self.checkpointer.has_load_key("ob_rms"):
+        if self._has_env_norm_key():
             vec_norm = wrap_in_vec_normalize(
-                self.envs, self.args.gamma, alg_env_settings
+                self.envs,
+                self.args.gamma,
+                alg_env_settings,
+                device=self.args.device,
+                use_float64=self.args.env_norm_float64,
             )
-            ob_rms_dict = self.checkpointer.get_key("ob_rms")
-            if vec_norm is not None:
-                vec_norm.ob_rms_dict = ob_rms_dict
+            self._load_env_norm(vec_norm)
 
         return full_eval(
             self.envs,
@@ -243,9 +360,28 @@ class Runner:
     def load_from_checkpoint(self):
         self.policy.load(self.checkpointer)
 
-        if self.checkpointer.has_load_key("ob_rms"):
-            ob_rms_dict = self.checkpointer.get_key("ob_rms")
-            vec_norm = get_vec_normalize(self.envs)
-            if vec_norm is not None:
-                vec_norm.ob_rms_dict = ob_rms_dict
+        vec_norm = get_vec_normalize(self.envs)
+        if vec_norm is not None and self._has_env_norm_key():
+            self._load_env_norm(vec_norm)
         self.updater.load(self.checkpointer)
+
+    def _has_env_norm_key(self):
+        # "ob_rms" are the pickled statistics of older checkpoints.
+        return self.checkpointer.has_load_key(
+            "env_norm"
+        ) or self.checkpointer.has_load_key("ob_rms")
+
+    def _load_env_norm(self, vec_norm):
+        if self.checkpointer.has_load_key("env_norm"):
+            vec_norm.load_state_dict(self.checkpointer.get_key("env_norm"))
+        else:
+            ob_rms_dict = self.checkpointer.get_key("ob_rms")
+            vec_norm.load_state_dict(
+                {
+                    "ob_rms": {
+                        k: {"mean": rms.mean, "var": rms.var, "count": rms.count}
+                        for k, rms in ob_rms_dict.items()
+                    },
+                    "ret_rms": None,
+                }
+            )
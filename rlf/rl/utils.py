@@ -17,6 +17,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 from PIL import Image
+from rlf.baselines.vec_env.info_batch import InfoBatch
+from rlf.baselines.vec_env.torch_vec_env import TorchInfoBatch
 
 try:
     import wandb
@@ -259,9 +261,12 @@ def ob_to_np(obs):
 
 
 def clone_ob(obs):
-    if isinstance(obs, dict):
-        return {k: np.array(v) for k, v in obs.items()}
-    return np.array(obs)
+    def _clone(x):
+        if isinstance(x, torch.Tensor):
+            return x.clone()
+        return np.array(x)
+
+    return obs_op(obs, _clone)
 
 
 def ob_to_tensor(obs, device):
@@ -300,6 +305,30 @@ def get_ob_shapes(ob_space):
         return {None: ob_space.shape}
 
 
+def get_torch_dtype(np_dtype, ob_shape):
+    """
+    The dtype of the tensors of an observation space of `np_dtype` and
+    `ob_shape`. uint8 images are kept as uint8, everything else is float32.
+    """
+    if np.dtype(np_dtype) == np.uint8 and len(ob_shape) == 3:
+        return torch.uint8
+    return torch.float32
+
+
+def get_ob_dtypes(ob_space):
+    """
+    Like `get_ob_shapes` but for the tensor dtype of each key, see
+    `get_torch_dtype`.
+    """
+    if isinstance(ob_space, gym.spaces.Dict):
+        return {
+            k: get_torch_dtype(space.dtype, space.shape)
+            for k, space in ob_space.spaces.items()
+        }
+    else:
+        return {None: get_torch_dtype(ob_space.dtype, ob_space.shape)}
+
+
 def get_ob_shape(obs_space, k):
     if k is None:
         return obs_space.shape
@@ -482,6 +511,13 @@ def agg_ep_log_stats(env_infos, alg_info):
         if k.startswith("alg_add_"):
             all_log_stats[k].append(alg_info[k])
 
+    if isinstance(env_infos, TorchInfoBatch):
+        _agg_torch_info_batch_stats(all_log_stats, env_infos)
+        return all_log_stats
+    if isinstance(env_infos, InfoBatch):
+        _agg_info_batch_stats(all_log_stats, env_infos)
+        return all_log_stats
+
     for inf in env_infos:
         if "episode" in inf:
             # Only log at the end of the episode
@@ -493,6 +529,64 @@ def agg_ep_log_stats(env_infos, alg_info):
     return all_log_stats
 
 
+def _agg_torch_info_batch_stats(all_log_stats, env_infos):
+    """
+    `agg_ep_log_stats` for a `TorchInfoBatch`, only the statistics of the
+    environments that ended an episode are copied from the device.
+    """
+    ep_stats, ended = env_infos.get_episode_stats()
+    if not ended.any():
+        return
+    for k, v in ep_stats.items():
+        all_log_stats[k].extend(v[ended].tolist())
+    for k, v in env_infos.arrays.items():
+        if k.startswith("ep_"):
+            valid = ended & env_infos.valid[k]
+            all_log_stats[k].extend(v[valid].tolist())
+
+
+def get_num_done(done):
+    """
+    The number of environments that ended an episode. `done` is a list, an
+    array or a tensor.
+    """
+    if isinstance(done, torch.Tensor):
+        return int(done.sum().item())
+    return sum([int(d) for d in done])
+
+
+def _agg_info_batch_stats(all_log_stats, env_infos):
+    """
+    `agg_ep_log_stats` for an `InfoBatch`, reads the info arrays rather than
+    the info dicts.
+    """
+    ended = np.zeros(len(env_infos), dtype=bool)
+    if "episode" in env_infos.arrays:
+        ep_stats, ended = env_infos.get_array("episode")
+        if ended.any():
+            for k in ep_stats.dtype.names:
+                all_log_stats[k].extend(ep_stats[k][ended].tolist())
+        ended = ended.copy()
+    for i in range(len(env_infos)):
+        # Episode statistics that are not in the info arrays.
+        if "episode" in env_infos.get_extra_keys(i):
+            ended[i] = True
+            for k, v in env_infos[i]["episode"].items():
+                all_log_stats[k].append(v)
+
+    if not ended.any():
+        return
+    for k in env_infos.arrays:
+        if k.startswith("ep_"):
+            vals, valid = env_infos.get_array(k)
+            if (ended & valid).any():
+                all_log_stats[k].extend(vals[ended & valid].tolist())
+    for i in np.nonzero(ended)[0]:
+        for k in env_infos.get_extra_keys(i):
+            if k.startswith("ep_"):
+                all_log_stats[k].append(env_infos[i][k])
+
+
 # Get a render frame function (Mainly for transition)
 def get_render_frame_func(venv):
     if hasattr(venv, "envs"):
@@ -685,44 +779,57 @@ class TimeProfilee:
 
 class StackHelper:
     """
-    A helper for stacking observations.
+    A helper for stacking observations. With `n_procs`, the last `n_stack`
+    frames of each environment are kept in a circular buffer with a write
+    index, so a step writes a single frame and the frames of the
+    environments that are done are cleared with one masked write. The
+    stacked observations are only built when they are returned.
     """
 
-    def __init__(self, ob_shape, n_stack, device, n_procs=None):
+    def __init__(self, ob_shape, n_stack, device, n_procs=None, dtype=torch.float32):
+        """
+        - dtype: dtype of the stacked tensor observations, uint8 images stay
+          uint8.
+        """
         self.input_dim = ob_shape[0]
         self.n_procs = n_procs
+        self.n_stack = n_stack
         self.real_shape = (n_stack * self.input_dim, *ob_shape[1:])
         if self.n_procs is not None:
-            self.stacked_obs = torch.zeros((n_procs, *self.real_shape))
+            # (n_procs, n_stack, *ob_shape) frames, the next frame is written
+            # at `self.idx` which is also the oldest frame.
+            self.frames = torch.zeros((n_procs, n_stack, *ob_shape), dtype=dtype)
             if device is not None:
-                self.stacked_obs = self.stacked_obs.to(device)
+                self.frames = self.frames.to(device)
+            self.idx = 0
         else:
             self.stacked_obs = np.zeros(self.real_shape)
 
+    def _stack(self, frames, order):
+        """
+        Concatenate the frames of `frames` in the order of the `order` slots.
+        """
+        order = torch.as_tensor(order, device=frames.device)
+        stacked = frames.index_select(1, order)
+        return stacked.reshape(frames.shape[0], -1, *stacked.shape[3:])
+
+    def _get_stacked(self):
+        return self._stack(
+            self.frames, [(self.idx + j) % self.n_stack for j in range(self.n_stack)]
+        )
+
     def update_obs(self, obs, dones=None, infos=None):
         """
         - obs: torch.tensor
         """
         if self.n_procs is not None:
-            self.stacked_obs[:, : -self.input_dim] = self.stacked_obs[
-                :, self.input_dim :
-            ].clone()
-            for (i, new) in enumerate(dones):
-                if new:
-                    self.stacked_obs[i] = 0
-            self.stacked_obs[:, -self.input_dim :] = obs
-
-            # Update info so the final observation frame stack has the final
-            # observation as the final frame in the stack.
-            for i in range(len(infos)):
-                if "final_obs" in infos[i]:
-                    new_final = torch.zeros(*self.stacked_obs.shape[1:])
-                    new_final[:-1] = self.stacked_obs[i][1:]
-                    new_final[-1] = torch.tensor(infos[i]["final_obs"]).to(
-                        self.stacked_obs.device
-                    )
-                    infos[i]["final_obs"] = new_final
-            return self.stacked_obs.clone(), infos
+            done_ids = torch.nonzero(torch.as_tensor(dones), as_tuple=True)[0]
+            if len(done_ids) > 0:
+                self._update_final_obs(done_ids, infos)
+                self.frames[done_ids.to(self.frames.device)] = 0
+            self.frames[:, self.idx] = obs.reshape(self.frames[:, self.idx].shape)
+            self.idx = (self.idx + 1) % self.n_stack
+            return self._get_stacked(), infos
         else:
             self.stacked_obs[: -self.input_dim] = self.stacked_obs[
                 self.input_dim :
@@ -731,14 +838,50 @@ class StackHelper:
 
             return self.stacked_obs.copy(), infos
 
+    def _update_final_obs(self, done_ids, infos):
+        """
+        Update the infos of the environments `done_ids` so the final
+        observation frame stack has the final observation as the final
+        frame in the stack. Must be called before the frames are cleared.
+        """
+        # The frames before the one written at this step, oldest first.
+        prev_order = [(self.idx + j) % self.n_stack for j in range(1, self.n_stack)]
+        done_ids = done_ids.to(self.frames.device)
+        prev_frames = self._stack(self.frames[done_ids], prev_order)
+        if isinstance(infos, InfoBatch) and "final_obs" in infos.arrays:
+            final_obs, _ = infos.get_array("final_obs")
+            if isinstance(final_obs, np.ndarray):
+                done_final = torch.as_tensor(final_obs[done_ids.cpu().numpy()])
+            else:
+                done_final = final_obs[done_ids.to(final_obs.device)]
+            new_final = torch.zeros(
+                len(infos),
+                *self.real_shape,
+                dtype=self.frames.dtype,
+                device=self.frames.device,
+            )
+            new_final[done_ids, : -self.input_dim] = prev_frames
+            new_final[done_ids, -self.input_dim :] = done_final.reshape(
+                new_final[done_ids, -self.input_dim :].shape
+            ).to(new_final)
+            infos.set_array("final_obs", new_final)
+            return
+        for i, env_id in enumerate(done_ids.tolist()):
+            if "final_obs" in infos[env_id]:
+                new_final = torch.zeros(
+                    *self.real_shape, dtype=self.frames.dtype, device=self.frames.device
+                )
+                new_final[: -self.input_dim] = prev_frames[i]
+                new_final[-self.input_dim :] = torch.as_tensor(
+                    infos[env_id]["final_obs"]
+                ).reshape(new_final[-self.input_dim :].shape).to(new_final)
+                infos[env_id]["final_obs"] = new_final
+
     def reset(self, obs):
         if self.n_procs is not None:
-            if torch.backends.cudnn.deterministic:
-                self.stacked_obs = torch.zeros(self.stacked_obs.shape)
-            else:
-                self.stacked_obs.zero_()
-            self.stacked_obs[:, -self.input_dim :] = obs
-            return self.stacked_obs.clone()
+            self.frames.zero_()
+            self.idx = 0
+            return self.update_obs(obs, torch.zeros(self.n_procs, dtype=torch.bool))[0]
         else:
             self.stacked_obs = np.zeros(self.stacked_obs.shape)
             self.stacked_obs[-self.input_dim :] = obs
@@ -10,7 +10,7 @@ from gym.spaces import Box
 
 import rlf
 import rlf.rl.utils as rutils
-from rlf.args import get_default_parser
+from rlf.args import check_args, get_default_parser
 from rlf.envs.env_interface import get_env_interface
 from rlf.exp_mgr import config_mgr
 from rlf.il.traj_mgr import TrajSaver
@@ -148,6 +148,7 @@ class RunSettings(MasterClass):
         # Convert the types of some of the standard types that don't allow the
         # scientific notation when expecting integer inputs.
         args.num_env_steps = int(args.num_env_steps)
+        check_args(args)
         return args
 
     def stop(self):
@@ -248,11 +249,12 @@ class RunSettings(MasterClass):
 
         # Setup storage buffer
         storage = algo.get_storage_buffer(policy, envs, args)
-        for ik, get_shape in alg_env_settings.include_info_keys:
+        for ik, get_shape, *_ in alg_env_settings.include_info_keys:
             storage.add_info_key(ik, get_shape(envs))
         storage.to(args.device)
         storage.init_storage(envs.reset())
-        storage.set_traj_done_callback(algo.on_traj_finished)
+        if algo.uses_traj_finished():
+            storage.set_traj_done_callback(algo.on_traj_finished)
 
         runner = self._get_runner_cls(algo, policy)(
             envs,
@@ -1,3 +1,4 @@
 from rlf.storage.base_storage import BaseStorage
 from rlf.storage.rollout_storage import RolloutStorage
 from rlf.storage.transition_storage import TransitionStorage
+from rlf.storage.memory_planner import MemoryPlan
@@ -1,15 +1,22 @@
 from abc import abstractmethod
 
+import numpy as np
 import rlf.rl.utils as rutils
 import torch
+from rlf.baselines.vec_env import InfoBatch, TorchInfoBatch
 
 
 class BaseStorage(object):
     def __init__(self):
         self._add_info_keys = []
-        self._on_traj_done_callback = lambda done_trajs: None
+        self._on_traj_done_callback = None
 
     def set_traj_done_callback(self, on_traj_done_fn):
+        """
+        Tracks the trajectories of the environments and calls
+        `on_traj_done_fn` with the trajectories that finished (see
+        `_on_traj_done`).
+        """
         self._on_traj_done_callback = on_traj_done_fn
 
     def _on_traj_done(self, done_trajs):
@@ -17,18 +24,47 @@ class BaseStorage(object):
         done_trajs: A list of transitions where each transition is a tuple of form:
             (state,action,mask,info_dict,reward). The data is a bit confusing.
             mask[t] is technically the mask at t+1. The mask at t=0 is always
-            1. The final state is NOT included and must be included through the
-            info_dict if needed.
+            1. The action is the `take_action` executed by the environment.
+            The info_dict has the keys of `add_info_key`. The final state is
+            NOT a transition, it is the "final_obs" of the info_dict of the
+            last transition when the environment returns it.
         """
         pass
 
+    def _tracks_trajs(self):
+        """
+        The trajectories are only tracked if they are used, by a callback or
+        by an override of `_on_traj_done`.
+        """
+        return self._on_traj_done_callback is not None or (
+            type(self)._on_traj_done is not BaseStorage._on_traj_done
+        )
+
     def init_storage(self, obs):
-        self.traj_storage = [[] for _ in range(rutils.get_def_obs(obs).shape[0])]
+        self._num_envs = rutils.get_def_obs(obs).shape[0]
+        # The storage index at which the unfinished trajectory of each
+        # environment starts, see `_get_traj`.
+        self._traj_starts = np.zeros(self._num_envs, dtype=np.int64)
+        # {env_id: transitions} of the unfinished trajectories that started
+        # before the storage was reset by `after_update`.
+        self._traj_carry = {}
 
     @abstractmethod
     def copy_storage(self):
         pass
 
+    def save(self, checkpointer):
+        """
+        Saves what is needed to resume training with the checkpoint.
+        """
+        pass
+
+    def load_resume(self, checkpointer):
+        pass
+
+    def close(self):
+        pass
+
     @abstractmethod
     def get_generator(self, **kwargs):
         pass
@@ -42,25 +78,76 @@ class BaseStorage(object):
     def get_masks(self, step):
         pass
 
-    def insert(self, obs, next_obs, reward, done, info, ac_info):
-        done_trajs = []
+    def insert(self, obs, next_obs, reward, done, info, ac_info, env_ids=None):
+        """
+        - env_ids: The ids of the environments of each transition in the
+          batch. If None, the batch contains all the environments in order.
+        """
+        pass
 
-        for i in range(len(info)):
-            traj_trans = self.get_traj_info(
-                rutils.obs_select(obs, i),
-                ac_info.take_action[i],
-                done[i],
-                info[i],
-                reward[i],
+    def _end_trajs(self, done, info, env_ids, ends):
+        """
+        Called by the storages that track trajectories once a batch is
+        inserted. `ends[i]` is the storage index after the transition of
+        environment `env_ids[i]`. The trajectories that are done are read
+        back from the storage by `_get_traj`, with the "final_obs" of the
+        step that ended them.
+        """
+        if not self._tracks_trajs():
+            return
+        if isinstance(done, torch.Tensor):
+            # Read the dones of a `TorchVecEnv` from the device once.
+            done = done.cpu().numpy()
+        done = np.asarray(done, dtype=bool).reshape(-1)
+        if not done.any():
+            return
+        done_idx = np.nonzero(done)[0]
+        ended = np.asarray(env_ids)[done_idx]
+        ends = np.asarray(ends)[done_idx]
+        done_trajs = []
+        for i, env_id, end in zip(done_idx, ended, ends):
+            traj = self._traj_carry.pop(env_id, []) + self._get_traj(
+                env_id, self._traj_starts[env_id], end
             )
-            self.traj_storage[i].append(traj_trans)
-
-            if done[i]:
-                done_trajs.append(self.traj_storage[i])
-                self.traj_storage[i] = []
-        if len(done_trajs) > 0:
+            if isinstance(info, InfoBatch):
+                final_info = info.select_keys(i, ["final_obs"])
+            else:
+                final_info = info[i]
+            if "final_obs" in final_info:
+                traj[-1][3]["final_obs"] = rutils.obs_op(
+                    final_info["final_obs"], lambda x: torch.as_tensor(x).clone()
+                )
+            done_trajs.append(traj)
+        self._traj_starts[ended] = ends
+
+        if self._on_traj_done_callback is not None:
             self._on_traj_done_callback(done_trajs)
-            self._on_traj_done(done_trajs)
+        self._on_traj_done(done_trajs)
+
+    def _carry_trajs(self, ends):
+        """
+        Reads the unfinished trajectories out of the storage before it is
+        reset, `ends[env_id]` is the current storage index of each
+        environment. Their next transitions start at index 0.
+        """
+        if not self._tracks_trajs():
+            return
+        for env_id, end in enumerate(ends):
+            start = self._traj_starts[env_id]
+            if end > start:
+                self._traj_carry[env_id] = self._traj_carry.get(
+                    env_id, []
+                ) + self._get_traj(env_id, start, end)
+        self._traj_starts[:] = 0
+
+    def _get_traj(self, env_id, start, end):
+        """
+        The transitions of environment `env_id` from the storage index
+        `start` to `end` (exclusive), as tuples of `get_traj_info`.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not track the trajectories"
+        )
 
     def after_update(self):
         pass
@@ -70,11 +157,21 @@ class BaseStorage(object):
 
     def compute_masks(self, done, infos):
         # If done then clean the history of observations.
-        masks = torch.FloatTensor([[0.0] if done_ else [1.0] for done_ in done])
-
-        bad_masks = torch.FloatTensor(
-            [[0.0] if "bad_transition" in info.keys() else [1.0] for info in infos]
-        )
+        if not isinstance(done, torch.Tensor):
+            done = torch.as_tensor(np.asarray(done, dtype=bool))
+        masks = (~done).float().unsqueeze(-1)
+
+        if isinstance(infos, InfoBatch) and "bad_transition" in infos.arrays:
+            _, is_bad = infos.get_array("bad_transition")
+            bad_masks = 1.0 - torch.as_tensor(is_bad).float().unsqueeze(-1)
+        elif isinstance(infos, TorchInfoBatch):
+            # The environment does not return `bad_transition`.
+            bad_masks = torch.ones_like(masks)
+        else:
+            is_bad = np.fromiter(
+                ("bad_transition" in info for info in infos), dtype=bool, count=len(infos)
+            )
+            bad_masks = 1.0 - torch.as_tensor(is_bad).float().unsqueeze(-1)
 
         return masks, bad_masks
 
@@ -87,7 +184,7 @@ class BaseStorage(object):
         ret_dict = {}
         for k in self.get_extract_info_keys():
             if k in info:
-                assign_val = torch.tensor(info[k]).to(self.args.device)
+                assign_val = torch.as_tensor(info[k]).to(self.args.device)
                 ret_dict[k] = assign_val
 
         return obs, action, mask, ret_dict, reward
@@ -0,0 +1,142 @@
+"""
+Helpers to pick compact dtypes for the storage buffers and to check their
+memory footprint before they are allocated.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from rlf.baselines import logger
+
+# The dtypes that `--storage-ob-dtype` can select for low dimensional
+# float observations.
+LOW_DIM_OB_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+def get_action_dtype(action_space):
+    """
+    The smallest integer dtype that holds the actions of a discrete action
+    space, float32 for the other action spaces.
+    """
+    if action_space.__class__.__name__ != "Discrete":
+        return torch.float32
+    if action_space.n <= np.iinfo(np.int8).max + 1:
+        return torch.int8
+    if action_space.n <= np.iinfo(np.int16).max + 1:
+        return torch.int16
+    return torch.long
+
+
+def get_ob_storage_dtype(ob_shape, ob_dtype, low_dim_dtype="float32"):
+    """
+    The dtype an observation of `ob_shape` and tensor dtype `ob_dtype` is
+    stored as. uint8 images stay uint8 and 1D float observations use
+    `low_dim_dtype`, a key of `LOW_DIM_OB_DTYPES`.
+    """
+    if ob_dtype == torch.float32 and len(ob_shape) == 1:
+        return LOW_DIM_OB_DTYPES[low_dim_dtype]
+    return ob_dtype
+
+
+def from_storage_dtype(x):
+    """
+    Casts a tensor of a compact storage dtype back to the dtype the
+    algorithms use: bool masks and half precision observations to float32
+    and small integer actions to int64.
+    """
+    if x.dtype in (torch.bool, torch.float16, torch.bfloat16):
+        return x.float()
+    if x.dtype in (torch.int8, torch.int16):
+        return x.long()
+    return x
+
+
+def _itemsize(dtype):
+    if isinstance(dtype, torch.dtype):
+        return torch.empty((), dtype=dtype).element_size()
+    return np.dtype(dtype).itemsize
+
+
+def _dtype_name(dtype):
+    if isinstance(dtype, torch.dtype):
+        return str(dtype).replace("torch.", "")
+    return np.dtype(dtype).name
+
+
+def _fmt_bytes(n):
+    if n < 1024:
+        return f"{n}B"
+    for unit in ["KB", "MB", "GB"]:
+        n /= 1024
+        if n < 1024 or unit == "GB":
+            return f"{n:.1f}{unit}"
+
+
+# The plans already logged by `MemoryPlan.check`.
+_LOGGED_PLANS = set()
+
+
+class MemoryPlan(object):
+    """
+    The shape, dtype and size of each field of a storage buffer. The fields
+    are added before they are allocated so `check` can refuse a
+    configuration that does not fit in the memory budget.
+    - name: Name of the storage the fields belong to.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.fields = OrderedDict()
+
+    def add(self, field, shape, dtype):
+        """
+        Add a field of `shape` and `dtype` (torch or numpy), adding a field
+        again replaces it. Returns `dtype`.
+        """
+        shape = tuple(int(x) for x in shape)
+        nbytes = int(np.prod(shape)) * _itemsize(dtype)
+        self.fields[field] = (shape, dtype, nbytes)
+        return dtype
+
+    @property
+    def total_bytes(self):
+        return sum(nbytes for _, _, nbytes in self.fields.values())
+
+    def __str__(self):
+        rows = [
+            (str(field), str(shape), _dtype_name(dtype), _fmt_bytes(nbytes))
+            for field, (shape, dtype, nbytes) in self.fields.items()
+        ]
+        rows.append(("total", "", "", _fmt_bytes(self.total_bytes)))
+        widths = [max(len(row[i]) for row in rows) for i in range(4)]
+        lines = [f"{self.name} memory plan:"]
+        for row in rows:
+            lines.append("  " + "  ".join(x.ljust(w) for x, w in zip(row, widths)))
+        return "\n".join(lines)
+
+    def check(self, budget_gb, verbose=False):
+        """
+        Raises a `MemoryError` if the fields need more than `budget_gb`
+        gigabytes, no limit if `budget_gb` is 0 or None.
+        - verbose: Log the plan, only the first time an identical plan is
+          checked.
+        """
+        if verbose:
+            plan = str(self)
+            if plan not in _LOGGED_PLANS:
+                _LOGGED_PLANS.add(plan)
+                logger.log(plan)
+        if not budget_gb:
+            return
+        budget = int(budget_gb * 1024 ** 3)
+        if self.total_bytes > budget:
+            raise MemoryError(
+                f"{self.name} needs {_fmt_bytes(self.total_bytes)} which is over "
+                f"the memory budget of {_fmt_bytes(budget)} (--storage-mem-budget). "
+                "Reduce the buffer size or use more compact observation dtypes "
+                "(--storage-ob-dtype)."
+            )
@@ -35,6 +35,18 @@ class NestedStorage(BaseStorage):
         for _,v in self.child_dict.items():
             v.to(device)
 
+    def save(self, checkpointer):
+        for _,v in self.child_dict.items():
+            v.save(checkpointer)
+
+    def load_resume(self, checkpointer):
+        for _,v in self.child_dict.items():
+            v.load_resume(checkpointer)
+
+    def close(self):
+        for _,v in self.child_dict.items():
+            v.close()
+
     def add_info_key(self, key_name, data_size):
         for _,v in self.child_dict.items():
             v.add_info_key(key_name, data_size)
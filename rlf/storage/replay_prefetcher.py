@@ -0,0 +1,104 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+class ReplayPrefetcher(object):
+    """
+    Samples the next `n_batches` batches of a `TransitionStorage` on a worker
+    thread while the learner updates. The batches are gathered into reusable
+    host buffers, pinned when the storage device is CUDA so `get` only queues
+    asynchronous copies to the device. A batch returned by `get` is valid
+    until the next call to `get`, when its buffers are handed back to the
+    worker.
+    """
+
+    def __init__(self, storage, batch_size, n_batches):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.device = torch.device(storage.device)
+        self.pin = self.device.type == "cuda"
+        # One more buffer than the batches sampled ahead for the batch the
+        # learner is using.
+        n_slots = n_batches + 1
+        self._slots = [None] * n_slots
+        # The CUDA events of the last copies out of each buffer.
+        self._copied = [None] * n_slots
+        self._free = queue.Queue()
+        for i in range(n_slots):
+            self._free.put(i)
+        self._ready = queue.Queue()
+        self._in_use = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                i = self._free.get()
+                if self._closed:
+                    return
+                if self._copied[i] is not None:
+                    self._copied[i].synchronize()
+                batch = self.storage._sample_batch(self.batch_size)
+                self._slots[i] = self._fill_slot(self._slots[i], batch)
+                self._ready.put(i)
+        except Exception as e:
+            self._ready.put(e)
+
+    def _fill_slot(self, slot, batch):
+        """
+        Copies the numpy arrays of `batch` into the tensors of `slot`, which
+        are allocated on the first use. The "sample_idxs" stay a numpy array.
+        """
+        if slot is None:
+            slot = {}
+        for name, x in batch.items():
+            if name == "sample_idxs":
+                slot[name] = x
+            elif isinstance(x, dict):
+                slot[name] = self._fill_slot(slot.get(name), x)
+            else:
+                x = torch.from_numpy(np.ascontiguousarray(x))
+                if name not in slot:
+                    slot[name] = torch.empty(x.shape, dtype=x.dtype)
+                    if self.pin:
+                        slot[name] = slot[name].pin_memory()
+                slot[name].copy_(x)
+        return slot
+
+    def _to_device(self, slot):
+        batch = {}
+        for name, x in slot.items():
+            if name == "sample_idxs":
+                batch[name] = x
+            elif isinstance(x, dict):
+                batch[name] = self._to_device(x)
+            else:
+                batch[name] = x.to(self.device, non_blocking=self.pin)
+        return batch
+
+    def get(self):
+        """
+        The next batch of `TransitionStorage._sample_batch`, with its arrays
+        as tensors on the storage device.
+        """
+        if self._in_use is not None:
+            self._free.put(self._in_use)
+        i = self._ready.get()
+        if isinstance(i, Exception):
+            raise i
+        self._in_use = i
+        batch = self._to_device(self._slots[i])
+        if self.pin:
+            self._copied[i] = torch.cuda.Event()
+            self._copied[i].record()
+        return batch
+
+    def close(self):
+        self._closed = True
+        self._free.put(None)
+        self._thread.join()
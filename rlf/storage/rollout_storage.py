@@ -1,10 +1,17 @@
 from collections import defaultdict
+from typing import Optional
 
 import numpy as np
 import rlf.rl.utils as rutils
 import torch
+from rlf.baselines.vec_env import InfoBatch
 from rlf.storage.base_storage import BaseStorage
-from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+from rlf.storage.memory_planner import (
+    MemoryPlan,
+    from_storage_dtype,
+    get_action_dtype,
+    get_ob_storage_dtype,
+)
 
 
 def get_shape_for_ac(action_space):
@@ -20,14 +27,76 @@ def get_shape_for_ac(action_space):
     return action_shape
 
 
-def _flatten_helper(T, N, _tensor):
-    return _tensor.view(T * N, *_tensor.size()[2:])
+# The keys of the minibatches of `RolloutStorage`.
+BATCH_KEYS = [
+    "state",
+    "other_state",
+    "reward",
+    "hxs",
+    "action",
+    "value",
+    "return",
+    "mask",
+    "prev_log_prob",
+    "adv",
+]
+
+
+def gather_packed(fields, indices):
+    """
+    Gathers the rows `indices` of the (B, ...) tensors of `fields` into one
+    contiguous buffer per dtype. Each field is a contiguous region of the
+    buffer so slicing its rows gives views.
+    - fields: {name: tensor}
+    Returns the {name: (len(indices), ...) tensor} views of the buffers.
+    """
+    by_dtype = defaultdict(list)
+    for name, x in fields.items():
+        by_dtype[x.dtype].append(name)
+    n = len(indices)
+    packed = {}
+    for dtype, names in by_dtype.items():
+        sizes = [n * fields[name][0].numel() for name in names]
+        buf = torch.empty(sum(sizes), dtype=dtype, device=indices.device)
+        for name, chunk in zip(names, buf.split(sizes)):
+            x = fields[name]
+            out = chunk.view(n, *x.shape[1:])
+            torch.index_select(x, 0, indices, out=out)
+            packed[name] = out
+    return packed
 
 
 def to_double(inp):
     return inp.double() if (inp is not None and inp.dtype == torch.float32) else inp
 
 
+@torch.jit.script
+def discounted_reverse_scan(
+    a: torch.Tensor,
+    c: torch.Tensor,
+    b: Optional[torch.Tensor],
+    z: Optional[torch.Tensor],
+    init: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Computes `x[t] = (a[t] + c[t] * x[t + 1]) * b[t] + z[t]` backward from
+    `x[T] = init` for the (T, N, ...) tensors. `b` and `z` are skipped if
+    None. With GAE `a` are the TD errors and `c` is gamma * lambda * mask,
+    otherwise `a` are the rewards and `c` is gamma * mask. `b` are the bad
+    masks and `z` the value bootstrapped at time limits.
+    """
+    out = torch.empty_like(a)
+    x = init
+    for t in range(a.size(0) - 1, -1, -1):
+        x = a[t] + c[t] * x
+        if b is not None:
+            x = x * b[t]
+        if z is not None:
+            x = x + z[t]
+        out[t] = x
+    return out
+
+
 class RolloutStorage(BaseStorage):
     def __init__(
         self,
@@ -46,10 +115,38 @@ class RolloutStorage(BaseStorage):
         self.value_dim = value_dim
         self.args = args
 
+        # The fields are planned first to check that they fit in the memory
+        # budget before allocating them.
+        T, N = num_steps, num_processes
+        self.mem_plan = MemoryPlan("RolloutStorage")
+        plan = self.mem_plan
+
         self.ob_keys = rutils.get_ob_shapes(obs_space)
+        # uint8 images are stored as uint8 and scaled by the network.
+        ob_dtypes = rutils.get_ob_dtypes(obs_space)
+        for k, space in self.ob_keys.items():
+            ob_dtypes[k] = plan.add(
+                f"obs.{k}" if k is not None else "obs",
+                (T + 1, N, *space),
+                get_ob_storage_dtype(space, ob_dtypes[k], args.storage_ob_dtype),
+            )
+        plan.add("rewards", (T, N, 1), torch.float32)
+        plan.add("value_preds", (T + 1, N, self.value_dim), torch.float32)
+        plan.add("returns", (T + 1, N, self.value_dim), torch.float32)
+        plan.add("action_log_probs", (T, N, self.value_dim), torch.float32)
+        for k, dim in hidden_states.items():
+            plan.add(f"hidden_states.{k}", (T + 1, N, dim), torch.float32)
+        action_shape = get_shape_for_ac(action_space)
+        action_dtype = plan.add(
+            "actions", (T, N, action_shape), get_action_dtype(action_space)
+        )
+        plan.add("masks", (T + 1, N, 1), torch.bool)
+        plan.add("bad_masks", (T + 1, N, 1), torch.bool)
+        plan.check(args.storage_mem_budget, verbose=True)
+
         self.obs = {}
         for k, space in self.ob_keys.items():
-            ob = torch.zeros(num_steps + 1, num_processes, *space)
+            ob = torch.zeros(num_steps + 1, num_processes, *space, dtype=ob_dtypes[k])
             if k is None:
                 self.obs = ob
             else:
@@ -67,34 +164,45 @@ class RolloutStorage(BaseStorage):
         for k, dim in hidden_states.items():
             self.hidden_states[k] = torch.zeros(num_steps + 1, num_processes, dim)
 
-        action_shape = get_shape_for_ac(action_space)
-
-        self.actions = torch.zeros(num_steps, num_processes, action_shape)
-
-        if action_space.__class__.__name__ == "Discrete":
-            self.actions = self.actions.long()
+        # Discrete actions are stored in the smallest integer dtype that
+        # holds them and the masks as bools, `from_storage_dtype` casts them
+        # back when they are read.
+        self.actions = torch.zeros(
+            num_steps, num_processes, action_shape, dtype=action_dtype
+        )
 
-        self.masks = torch.zeros(num_steps + 1, num_processes, 1)
+        self.masks = torch.zeros(num_steps + 1, num_processes, 1, dtype=torch.bool)
 
         # Masks that indicate whether it's a true terminal state
         # or time limit end state
-        self.bad_masks = torch.ones(num_steps + 1, num_processes, 1)
+        self.bad_masks = torch.ones(num_steps + 1, num_processes, 1, dtype=torch.bool)
 
         self.num_steps = num_steps
         self.n_procs = num_processes
         self.step = 0
+        # The current step of each environment when inserting the
+        # transitions of a subset of the environments.
+        self.env_steps = torch.zeros(num_processes, dtype=torch.long)
+        # The actions executed by the environments, which can differ from
+        # `self.actions` (for instance clipped), for the tracked
+        # trajectories. Allocated by the first insert that tracks them.
+        self.traj_actions = None
 
     def __len__(self):
         return self.num_steps * self.n_procs
 
     def get_def_obs_seq(self):
         if isinstance(self.obs, dict):
-            return rutils.get_def_obs(self.obs)
+            return from_storage_dtype(rutils.get_def_obs(self.obs))
         else:
-            return self.obs
+            return from_storage_dtype(self.obs)
 
     def add_info_key(self, key_name, data_size):
         super().add_info_key(key_name, data_size)
+        self.mem_plan.add(
+            f"add_data.{key_name}", (self.num_steps, self.n_procs, *data_size), torch.float32
+        )
+        self.mem_plan.check(self.args.storage_mem_budget, verbose=True)
         self.add_data[key_name] = torch.zeros(self.num_steps, self.n_procs, *data_size)
 
     def init_storage(self, obs):
@@ -107,6 +215,7 @@ class RolloutStorage(BaseStorage):
 
         self.masks = self.masks.zero_()
         self.bad_masks = self.bad_masks.zero_()
+        self.env_steps.zero_()
         for k, dim in self.hidden_states.items():
             self.hidden_states[k] = self.hidden_states[k].zero_()
 
@@ -125,6 +234,8 @@ class RolloutStorage(BaseStorage):
         self.returns = self.returns.to(device)
         self.action_log_probs = self.action_log_probs.to(device)
         self.actions = self.actions.to(device)
+        if self.traj_actions is not None:
+            self.traj_actions = self.traj_actions.to(device)
         self.masks = self.masks.to(device)
         self.bad_masks = self.bad_masks.to(device)
         for k, d in self.add_data.items():
@@ -133,8 +244,15 @@ class RolloutStorage(BaseStorage):
         for k, d in self.hidden_states.items():
             self.hidden_states[k] = d.to(device)
 
-    def insert(self, obs, next_obs, rewards, done, info, ac_info):
-        super().insert(obs, next_obs, rewards, done, info, ac_info)
+    def insert(self, obs, next_obs, rewards, done, info, ac_info, env_ids=None):
+        """
+        - env_ids: If specified, the transitions are only of these
+          environments and are inserted at the current step of each of them
+          (see `get_env_obs`) rather than at the shared current step.
+        """
+        if env_ids is not None:
+            self._insert_envs(next_obs, rewards, done, info, ac_info, env_ids)
+            return
         masks, bad_masks = self.compute_masks(done, info)
 
         for k in self.ob_keys:
@@ -143,14 +261,9 @@ class RolloutStorage(BaseStorage):
             else:
                 self.obs[k][self.step + 1].copy_(next_obs[k])
 
-        for i, inf in enumerate(info):
-            for k in self.get_extract_info_keys():
-                if k in inf:
-                    if not isinstance(inf[k], torch.Tensor):
-                        assign_val = torch.tensor(inf[k]).to(self.args.device)
-                    else:
-                        assign_val = inf[k]
-                    self.add_data[k][self.step, i] = assign_val
+        self._insert_add_data(
+            info, torch.full((self.n_procs,), self.step), torch.arange(self.n_procs)
+        )
 
         self.actions[self.step].copy_(ac_info.action)
         self.action_log_probs[self.step].copy_(ac_info.action_log_probs)
@@ -161,9 +274,118 @@ class RolloutStorage(BaseStorage):
         for k in self.hidden_states:
             self.hidden_states[k][self.step + 1].copy_(ac_info.hxs[k])
 
+        if self._tracks_trajs():
+            self._insert_traj_actions(
+                torch.full((self.n_procs,), self.step),
+                torch.arange(self.n_procs),
+                ac_info.take_action,
+            )
+        self._end_trajs(
+            done, info, np.arange(self.n_procs), np.full(self.n_procs, self.step + 1)
+        )
         self.step = (self.step + 1) % self.num_steps
 
+    def _insert_envs(self, next_obs, rewards, done, info, ac_info, env_ids):
+        env_ids = torch.as_tensor(env_ids, dtype=torch.long)
+        steps = self.env_steps[env_ids]
+        assert (steps < self.num_steps).all(), "Inserted too many steps for an environment"
+        masks, bad_masks = self.compute_masks(done, info)
+
+        for k in self.ob_keys:
+            if k is None:
+                self.obs[steps + 1, env_ids] = next_obs.to(self.obs)
+            else:
+                self.obs[k][steps + 1, env_ids] = next_obs[k].to(self.obs[k])
+
+        self._insert_add_data(info, steps, env_ids)
+
+        device = self.rewards.device
+        self.actions[steps, env_ids] = ac_info.action.to(self.actions)
+        self.action_log_probs[steps, env_ids] = ac_info.action_log_probs.to(device)
+        self.value_preds[steps, env_ids] = ac_info.value.to(device)
+        self.rewards[steps, env_ids] = rewards.to(device)
+        self.masks[steps + 1, env_ids] = masks.to(self.masks)
+        self.bad_masks[steps + 1, env_ids] = bad_masks.to(self.bad_masks)
+        for k in self.hidden_states:
+            self.hidden_states[k][steps + 1, env_ids] = ac_info.hxs[k].to(device)
+
+        if self._tracks_trajs():
+            self._insert_traj_actions(steps, env_ids, ac_info.take_action)
+        self.env_steps[env_ids] += 1
+        self._end_trajs(done, info, env_ids.numpy(), (steps + 1).cpu().numpy())
+
+    def _insert_add_data(self, info, steps, env_ids):
+        """
+        Store the info keys in `add_data`, `info[i]` is at step `steps[i]` of
+        environment `env_ids[i]`.
+        """
+        for k in self.get_extract_info_keys():
+            if isinstance(info, InfoBatch) and k in info.arrays:
+                vals, valid = info.get_array(k)
+                # The arrays of a `TorchInfoBatch` can be on another device.
+                valid = torch.as_tensor(valid)
+                vals = torch.as_tensor(vals)[valid]
+                valid = valid.cpu()
+                self.add_data[k][steps[valid], env_ids[valid]] = vals.to(
+                    self.add_data[k]
+                )
+                continue
+            # Stack the values of all the environments that returned the key
+            # to assign them at once.
+            valid = [i for i, inf in enumerate(info) if k in inf]
+            if len(valid) == 0:
+                continue
+            vals = [info[i][k] for i in valid]
+            if isinstance(vals[0], torch.Tensor):
+                vals = torch.stack(vals)
+            else:
+                vals = torch.as_tensor(np.stack(vals))
+            valid = torch.as_tensor(valid, dtype=torch.long)
+            self.add_data[k][steps[valid], env_ids[valid]] = vals.to(self.add_data[k])
+
+    def _insert_traj_actions(self, steps, env_ids, take_action):
+        take_action = torch.as_tensor(take_action)
+        if self.traj_actions is None:
+            self.traj_actions = torch.zeros(
+                self.num_steps,
+                self.n_procs,
+                *take_action.shape[1:],
+                dtype=take_action.dtype,
+                device=self.actions.device,
+            )
+        self.traj_actions[steps, env_ids] = take_action.to(self.traj_actions)
+
+    def _get_traj(self, env_id, start, end):
+        # One copy of the rows of the trajectory, the storage is overwritten
+        # by the next rollouts.
+        obs = rutils.obs_op(
+            rutils.obs_select(self.obs, (slice(start, end), env_id)),
+            lambda x: from_storage_dtype(x).clone(),
+        )
+        actions = self.traj_actions[start:end, env_id].clone()
+        rewards = self.rewards[start:end, env_id].clone()
+        dones = (self.masks[start + 1 : end + 1, env_id] == 0).view(-1).tolist()
+        add_data = {
+            k: self.add_data[k][start:end, env_id].clone()
+            for k in self.get_extract_info_keys()
+        }
+        return [
+            self.get_traj_info(
+                rutils.obs_select(obs, t),
+                actions[t],
+                dones[t],
+                {k: v[t] for k, v in add_data.items()},
+                rewards[t],
+            )
+            for t in range(end - start)
+        ]
+
     def after_update(self):
+        if self.env_steps.any():
+            self._carry_trajs(self.env_steps.cpu().numpy())
+        else:
+            self._carry_trajs(np.full(self.n_procs, self.num_steps))
+        self.env_steps.zero_()
         for k in self.ob_keys:
             if k is None:
                 self.obs[0].copy_(self.obs[-1])
@@ -180,62 +402,39 @@ class RolloutStorage(BaseStorage):
             self.hidden_states[k][0].copy_(self.hidden_states[k][-1])
 
     def compute_returns(self, next_value):
-        exp_rewards = self.rewards.repeat(1, 1, self.value_dim)
         gamma = self.args.gamma
+        # Accumulating in float64 avoids the rounding errors of long horizons.
+        cast = to_double if self.args.returns_float64 else (lambda x: x)
+        rewards = cast(self.rewards.expand(-1, -1, self.value_dim))
+        masks = cast(self.masks[1:].float())
+        bad_masks = None
         if self.args.use_proper_time_limits:
             # Use the "bad_masks" to properly account for early terminations.
             # This is the case in mujoco OpenAI gym tasks.
-            if self.args.use_gae:
-                self.value_preds[-1] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.size(0))):
-                    delta = (
-                        exp_rewards[step]
-                        + gamma * self.value_preds[step + 1] * self.masks[step + 1]
-                        - self.value_preds[step]
-                    )
-                    gae = (
-                        delta
-                        + gamma * self.args.gae_lambda * self.masks[step + 1] * gae
-                    )
-                    gae = gae * self.bad_masks[step + 1]
-                    self.returns[step] = gae + self.value_preds[step]
-            else:
-                self.returns[-1] = next_value
-                for step in reversed(range(self.rewards.size(0))):
-                    # ((R_{t+1} * \gamma * M_{t+1}) + (R_t * B_{t+1}) +
-                    # (1 - B_{t+1}) * V_t
-                    self.returns[step] = (
-                        self.returns[step + 1] * gamma * self.masks[step + 1]
-                        + exp_rewards[step]
-                    ) * self.bad_masks[step + 1] + (
-                        1 - self.bad_masks[step + 1]
-                    ) * self.value_preds[
-                        step
-                    ]
+            bad_masks = cast(self.bad_masks[1:].float())
+
+        if self.args.use_gae:
+            self.value_preds[-1] = next_value
+            values = cast(self.value_preds)
+            deltas = rewards + gamma * values[1:] * masks - values[:-1]
+            gae = discounted_reverse_scan(
+                deltas,
+                gamma * self.args.gae_lambda * masks,
+                bad_masks,
+                None,
+                torch.zeros_like(values[-1]),
+            )
+            self.returns[:-1] = gae + values[:-1]
         else:
-            if self.args.use_gae:
-                self.value_preds[-1] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.size(0))):
-                    delta = (
-                        exp_rewards[step]
-                        + gamma * self.value_preds[step + 1] * self.masks[step + 1]
-                        - self.value_preds[step]
-                    )
-
-                    gae = (
-                        delta
-                        + gamma * self.args.gae_lambda * self.masks[step + 1] * gae
-                    )
-                    self.returns[step] = gae + self.value_preds[step]
-            else:
-                self.returns[-1] = next_value
-                for step in reversed(range(self.rewards.size(0))):
-                    self.returns[step] = (
-                        self.returns[step + 1] * gamma * self.masks[step + 1]
-                        + exp_rewards[step]
-                    )
+            self.returns[-1] = next_value
+            # ((R_{t+1} * \gamma * M_{t+1}) + (R_t * B_{t+1}) +
+            # (1 - B_{t+1}) * V_t
+            bootstrap = None
+            if bad_masks is not None:
+                bootstrap = (1 - bad_masks) * cast(self.value_preds[:-1])
+            self.returns[:-1] = discounted_reverse_scan(
+                rewards, gamma * masks, bad_masks, bootstrap, cast(self.returns[-1])
+            )
 
     def compute_advantages(self):
         advantages = self.returns[:-1] - self.value_preds[:-1]
@@ -245,13 +444,23 @@ class RolloutStorage(BaseStorage):
         # return advantages.reshape(-1, self.value_dim)
 
     def get_generator(
-        self, advantages=None, num_mini_batch=None, mini_batch_size=None, **kwargs
+        self,
+        advantages=None,
+        num_mini_batch=None,
+        mini_batch_size=None,
+        keys=None,
+        **kwargs,
     ):
+        """
+        - keys: The keys of the minibatches that are read, all of them if None.
+        """
         if self.args.recurrent_policy:
-            data_generator = self.recurrent_generator(advantages, num_mini_batch)
+            data_generator = self.recurrent_generator(
+                advantages, num_mini_batch, keys=keys
+            )
         else:
             data_generator = self.feed_forward_generator(
-                advantages, num_mini_batch, mini_batch_size, **kwargs
+                advantages, num_mini_batch, mini_batch_size, keys=keys, **kwargs
             )
         return data_generator
 
@@ -259,14 +468,70 @@ class RolloutStorage(BaseStorage):
         gen = self.get_generator(advantages, num_mini_batch=1)
         return next(gen)
 
+    def _get_flat_obs(self, obs_steps):
+        """
+        Splits the (T * N, ...) observations at `obs_steps` into the policy
+        observation and the dict of the other observations.
+        """
+        obs = None
+        other_obs = {}
+        for k, ob_shape in self.ob_keys.items():
+            if k is None:
+                obs = self.obs[obs_steps].view(-1, *ob_shape)
+            elif k == self.args.policy_ob_key:
+                obs = self.obs[k][obs_steps].view(-1, *ob_shape)
+            else:
+                other_obs[k] = self.obs[k][obs_steps].view(-1, *ob_shape)
+        assert obs is not None, f"Found not find {self.args.policy_ob_key}"
+        return obs, other_obs
+
+    def _get_batch_fields(self, advantages, keys, get_next_state):
+        """
+        The (T * N, ...) views of the `keys` of the feed forward minibatches,
+        the values of "other_state", "hxs" and "next_other_state" are dicts.
+        """
+        fields = {}
+        if "state" in keys or "other_state" in keys:
+            fields["state"], fields["other_state"] = self._get_flat_obs(
+                slice(None, -1)
+            )
+        if get_next_state:
+            fields["next_state"], fields["next_other_state"] = self._get_flat_obs(
+                slice(1, None)
+            )
+        fields["reward"] = self.rewards.view(-1, 1)
+        fields["hxs"] = {
+            k: self.hidden_states[k][:-1].view(-1, self.hidden_states[k].size(-1))
+            for k in self.hidden_states
+        }
+        fields["action"] = self.actions.view(-1, self.actions.size(-1))
+        fields["value"] = self.value_preds[:-1].view(-1, self.value_dim)
+        fields["return"] = self.returns[:-1].view(-1, self.value_dim)
+        fields["mask"] = self.masks[:-1].view(-1, 1)
+        fields["prev_log_prob"] = self.action_log_probs.view(-1, self.value_dim)
+        if advantages is not None:
+            fields["adv"] = advantages.reshape(-1, self.value_dim)
+        return {
+            k: v
+            for k, v in fields.items()
+            if k in keys or k in ["next_state", "next_other_state"]
+        }
+
     def feed_forward_generator(
         self,
         advantages,
         num_mini_batch=None,
         mini_batch_size=None,
         get_next_state=False,
+        keys=None,
         **kwargs,
     ):
+        """
+        The fields of all the minibatches of the epoch are gathered once in a
+        random order into a packed buffer and the minibatches are slices of
+        it, cast from the compact storage dtypes.
+        - keys: The keys of the minibatches to include, all of them if None.
+        """
         num_steps, num_processes = self.rewards.size()[0:2]
         batch_size = num_processes * num_steps
 
@@ -280,71 +545,32 @@ class RolloutStorage(BaseStorage):
                 )
             )
             mini_batch_size = batch_size // num_mini_batch
-
-        sampler = BatchSampler(
-            SubsetRandomSampler(range(batch_size)), mini_batch_size, drop_last=True
-        )
-
-        for indices in sampler:
-            obs_batch = None
-            other_obs_batch = {}
-            for k, ob_shape in self.ob_keys.items():
-                if k is None:
-                    obs_batch = self.obs[:-1].view(-1, *ob_shape)[indices]
-                elif k == self.args.policy_ob_key:
-                    obs_batch = self.obs[k][:-1].view(-1, *ob_shape)[indices]
-                else:
-                    other_obs_batch[k] = self.obs[k][:-1].view(-1, *ob_shape)[indices]
-
-            assert obs_batch is not None, f"Found not find {self.args.policy_ob_key}"
-
-            actions_batch = self.actions.view(-1, self.actions.size(-1))[indices]
-            rewards_batch = self.rewards.view(-1, 1)[indices]
-
-            hidden_states_batch = {}
-            for k in self.hidden_states:
-                hidden_states_batch[k] = self.hidden_states[k][:-1].view(
-                    -1, self.hidden_states[k].size(-1)
-                )[indices]
-
-            value_preds_batch = self.value_preds[:-1].view(-1, self.value_dim)[indices]
-            return_batch = self.returns[:-1].view(-1, self.value_dim)[indices]
-            masks_batch = self.masks[:-1].view(-1, 1)[indices]
-            old_action_log_probs_batch = self.action_log_probs.view(-1, self.value_dim)[
-                indices
-            ]
-            if advantages is None:
-                adv_targ = None
+        num_batches = batch_size // mini_batch_size
+
+        if keys is None:
+            keys = BATCH_KEYS
+        fields = self._get_batch_fields(advantages, keys, get_next_state)
+
+        # Only the samples of the complete minibatches are gathered.
+        perm = torch.randperm(batch_size, device=self.rewards.device)
+        flat_fields = {}
+        for k, v in fields.items():
+            if isinstance(v, dict):
+                flat_fields.update({(k, sub_k): x for sub_k, x in v.items()})
             else:
-                adv_targ = advantages.view(-1, self.value_dim)[indices]
-
-            ret_dict = {
-                "state": obs_batch,
-                "other_state": other_obs_batch,
-                "reward": rewards_batch,
-                "hxs": hidden_states_batch,
-                "action": actions_batch,
-                "value": value_preds_batch,
-                "return": return_batch,
-                "mask": masks_batch,
-                "prev_log_prob": old_action_log_probs_batch,
-                "adv": adv_targ,
-            }
-            if get_next_state:
-                next_obs_batch = None
-                next_other_obs_batch = {}
-                for k, ob_shape in self.ob_keys.items():
-                    if k is None:
-                        next_obs_batch = self.obs[1:].view(-1, *ob_shape)[indices]
-                    elif k == self.args.policy_ob_key:
-                        next_obs_batch = self.obs[k][1:].view(-1, *ob_shape)[indices]
-                    else:
-                        next_other_obs_batch[k] = self.obs[k][1:].view(-1, *ob_shape)[
-                            indices
-                        ]
-                ret_dict["next_state"] = next_obs_batch
-                ret_dict["next_other_state"] = next_other_obs_batch
-
+                flat_fields[(k, None)] = v
+        packed = gather_packed(flat_fields, perm[: num_batches * mini_batch_size])
+
+        for i in range(num_batches):
+            batch = slice(i * mini_batch_size, (i + 1) * mini_batch_size)
+            ret_dict = {k: {} for k, v in fields.items() if isinstance(v, dict)}
+            for (k, sub_k), x in packed.items():
+                if sub_k is None:
+                    ret_dict[k] = from_storage_dtype(x[batch])
+                else:
+                    ret_dict[k][sub_k] = from_storage_dtype(x[batch])
+            if "adv" in keys and advantages is None:
+                ret_dict["adv"] = None
             yield ret_dict
 
     def get_np_tensors(self):
@@ -353,10 +579,11 @@ class RolloutStorage(BaseStorage):
         data ordering is preserved.
         """
         ob_shape = self.ob_keys[None]
-        s = self.obs[:-1].view(-1, *ob_shape).numpy()
-        n_s = self.obs[1:].view(-1, *ob_shape).numpy()
-        mask = self.masks[1:].view(-1, 1).numpy()
-        actions = self.actions.view(-1, self.actions.size(-1)).numpy()
+        obs = from_storage_dtype(self.obs)
+        s = obs[:-1].view(-1, *ob_shape).numpy()
+        n_s = obs[1:].view(-1, *ob_shape).numpy()
+        mask = self.masks[1:].view(-1, 1).float().numpy()
+        actions = self.get_actions().numpy()
         reward = self.rewards.view(-1, 1).numpy()
         return s, n_s, actions, reward, mask
 
@@ -364,111 +591,83 @@ class RolloutStorage(BaseStorage):
         s, n_s, a, r, m = self.get_np_tensors()
         return int(s[0]), int(n_s[0]), a[0, 0], r[0, 0], m[0, 0]
 
-    def recurrent_generator(self, advantages, num_mini_batch):
-        # Only called if args.recurrent_policy is True
-        num_processes = self.rewards.size(1)
-        assert num_processes >= num_mini_batch, (
-            "PPO requires the number of processes ({}) "
+    def recurrent_generator(self, advantages, num_mini_batch, keys=None):
+        """
+        Splits the rollout of each environment into chunks of
+        `--bptt-chunk-len` steps and yields minibatches of random chunks. The
+        tensors are (L, B, ...) flattened to (L * B, ...) for chunks of
+        length L and "hxs" are the stored (B, -1) hidden states at the start
+        of each chunk.
+        - keys: The keys of the minibatches to include, all of them if None.
+        """
+        num_steps, num_processes = self.rewards.size()[0:2]
+        chunk_len = self.args.bptt_chunk_len
+        if chunk_len <= 0:
+            chunk_len = num_steps
+        assert (
+            num_steps % chunk_len == 0
+        ), f"The chunk length {chunk_len} must divide the number of steps {num_steps}"
+        num_chunks = (num_steps // chunk_len) * num_processes
+        assert num_chunks >= num_mini_batch, (
+            "PPO requires the number of chunks ({}) "
             "to be greater than or equal to the number of "
-            "PPO mini batches ({}).".format(num_processes, num_mini_batch)
+            "PPO mini batches ({}).".format(num_chunks, num_mini_batch)
         )
-
-        num_envs_per_batch = num_processes // num_mini_batch
-        perm = torch.randperm(num_processes)
-        for start_ind in range(0, num_processes, num_envs_per_batch):
-            obs_batch = []
-            hidden_states_batch = defaultdict(list)
-            obs_batch = defaultdict(list)
-            other_obs_batch = defaultdict(list)
-            actions_batch = []
-            value_preds_batch = []
-            return_batch = []
-            masks_batch = []
-            old_action_log_probs_batch = []
-            adv_targ = []
-            reward_batch = []
-
-            for offset in range(num_envs_per_batch):
-                ind = perm[start_ind + offset]
-                for k, ob_shape in self.ob_keys.items():
-                    if k is None:
-                        obs_batch[None].append(self.obs[:-1, ind])
-                    elif k == self.args.policy_ob_key or k is None:
-                        obs_batch[k].append(self.obs[k][:-1, ind])
-                    else:
-                        other_obs_batch[k].append(self.obs[k][:-1, ind])
-
-                for k in self.hidden_states:
-                    hidden_states_batch[k].append(self.hidden_states[k][0:1, ind])
-
-                actions_batch.append(self.actions[:, ind])
-                value_preds_batch.append(self.value_preds[:-1, ind])
-                return_batch.append(self.returns[:-1, ind])
-                reward_batch.append(self.rewards[:, ind])
-                masks_batch.append(self.masks[:-1, ind])
-                old_action_log_probs_batch.append(self.action_log_probs[:, ind])
-                adv_targ.append(advantages[:, ind])
-
-            T, N = self.num_steps, num_envs_per_batch
-            # These are all tensors of size (T, N, -1)
-            actions_batch = torch.stack(actions_batch, 1)
-            value_preds_batch = torch.stack(value_preds_batch, 1)
-            return_batch = torch.stack(return_batch, 1)
-            reward_batch = torch.stack(reward_batch, 1)
-            masks_batch = torch.stack(masks_batch, 1)
-            old_action_log_probs_batch = torch.stack(old_action_log_probs_batch, 1)
-            adv_targ = torch.stack(adv_targ, 1)
-
-            # States is just a (N, -1) tensor
-            for k in hidden_states_batch:
-                hidden_states_batch[k] = torch.stack(hidden_states_batch[k], 1).view(
-                    N, -1
-                )
-            # Flatten the (T, N, ...) tensors to (T * N, ...)
-            for k in obs_batch:
-                obs_batch[k] = torch.stack(obs_batch[k], 1)
-                obs_batch[k] = _flatten_helper(T, N, obs_batch[k])
-            for k in other_obs_batch:
-                other_obs_batch[k] = torch.stack(other_obs_batch[k], 1)
-                other_obs_batch[k] = _flatten_helper(T, N, other_obs_batch[k])
-            actions_batch = _flatten_helper(T, N, actions_batch)
-            value_preds_batch = _flatten_helper(T, N, value_preds_batch)
-            reward_batch = _flatten_helper(T, N, reward_batch)
-            return_batch = _flatten_helper(T, N, return_batch)
-            masks_batch = _flatten_helper(T, N, masks_batch)
-            old_action_log_probs_batch = _flatten_helper(
-                T, N, old_action_log_probs_batch
-            )
-            adv_targ = _flatten_helper(T, N, adv_targ)
-
-            # No need to return obs dict if there's only one thing in
-            # dictionary
-            if len(obs_batch) == 1:
-                obs_batch = next(iter(obs_batch.values()))
-
-            yield {
-                "other_state": other_obs_batch,
-                "reward": reward_batch,
-                "hxs": hidden_states_batch,
-                "state": obs_batch,
-                "action": actions_batch,
-                "value": value_preds_batch,
-                "return": return_batch,
-                "mask": masks_batch,
-                "prev_log_prob": old_action_log_probs_batch,
-                "adv": adv_targ,
-            }
+        chunks_per_batch = num_chunks // num_mini_batch
+
+        if keys is None:
+            keys = BATCH_KEYS
+        fields = self._get_batch_fields(advantages, keys, False)
+        hxs = fields.pop("hxs", None)
+
+        # Chunk `j` is the steps [c * L, (c + 1) * L) of environment `n` with
+        # j = c * N + n, its step `l` is at row (c * L + l) * N + n of the
+        # flattened (T * N, ...) tensors.
+        device = self.rewards.device
+        perm = torch.randperm(num_chunks, device=device)
+        perm = perm[: num_mini_batch * chunks_per_batch]
+        starts = (perm // num_processes) * chunk_len * num_processes + (
+            perm % num_processes
+        )
+        rows = starts.view(num_mini_batch, 1, chunks_per_batch) + (
+            torch.arange(chunk_len, device=device).view(1, -1, 1) * num_processes
+        )
+        flat_fields = {}
+        for k, v in fields.items():
+            if isinstance(v, dict):
+                flat_fields.update({(k, sub_k): x for sub_k, x in v.items()})
+            else:
+                flat_fields[(k, None)] = v
+        packed = gather_packed(flat_fields, rows.view(-1))
+        if hxs is not None:
+            packed_hxs = gather_packed(hxs, starts)
+
+        batch_len = chunk_len * chunks_per_batch
+        for i in range(num_mini_batch):
+            batch = slice(i * batch_len, (i + 1) * batch_len)
+            ret_dict = {k: {} for k, v in fields.items() if isinstance(v, dict)}
+            for (k, sub_k), x in packed.items():
+                if sub_k is None:
+                    ret_dict[k] = from_storage_dtype(x[batch])
+                else:
+                    ret_dict[k][sub_k] = from_storage_dtype(x[batch])
+            if hxs is not None:
+                chunks = slice(i * chunks_per_batch, (i + 1) * chunks_per_batch)
+                ret_dict["hxs"] = {k: x[chunks] for k, x in packed_hxs.items()}
+            if "adv" in keys and advantages is None:
+                ret_dict["adv"] = None
+            yield ret_dict
 
     def get_actions(self):
         actions = self.actions.view(-1, self.actions.size(-1))
-        return actions
+        return from_storage_dtype(actions)
 
     def get_obs(self, step):
         obs = {}
         for k in self.ob_keys:
             if k is None:
-                return self.obs[step]
-            obs[k] = self.obs[k][step]
+                return from_storage_dtype(self.obs[step])
+            obs[k] = from_storage_dtype(self.obs[k][step])
         assert len(obs) != 0, "No matching keys in state observation dictionary"
 
         return obs
@@ -477,4 +676,33 @@ class RolloutStorage(BaseStorage):
         return rutils.deep_dict_select(self.hidden_states, step)
 
     def get_masks(self, step):
-        return self.masks[step]
+        return self.masks[step].float()
+
+    def get_env_steps(self, env_ids):
+        """
+        The number of transitions inserted for each of the environments
+        `env_ids` since the last update.
+        """
+        return self.env_steps[torch.as_tensor(env_ids, dtype=torch.long)]
+
+    def get_env_obs(self, env_ids):
+        """
+        Observations of the environments `env_ids` at the current step of
+        each environment.
+        """
+        env_ids = torch.as_tensor(env_ids, dtype=torch.long)
+        steps = self.env_steps[env_ids]
+        if not isinstance(self.obs, dict):
+            return from_storage_dtype(self.obs[steps, env_ids])
+        return {
+            k: from_storage_dtype(self.obs[k][steps, env_ids]) for k in self.ob_keys
+        }
+
+    def get_env_hidden_state(self, env_ids):
+        env_ids = torch.as_tensor(env_ids, dtype=torch.long)
+        steps = self.env_steps[env_ids]
+        return {k: v[steps, env_ids] for k, v in self.hidden_states.items()}
+
+    def get_env_masks(self, env_ids):
+        env_ids = torch.as_tensor(env_ids, dtype=torch.long)
+        return self.masks[self.env_steps[env_ids], env_ids].float()
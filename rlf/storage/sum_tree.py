@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class SumTree(object):
+    """
+    Array-backed binary tree of the sums and minimums of `capacity`
+    priorities, used to sample transitions proportionally to their
+    priority. Node `i` has the children `2 * i` and `2 * i + 1`, the root is
+    node 1 and the leaves start at node `self.n_leaves`. The updates and
+    searches take arrays of indices and only loop over the levels of the
+    tree.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.n_leaves = 1 << self.depth
+        self.sums = np.zeros(2 * self.n_leaves, dtype=np.float64)
+        self.mins = np.full(2 * self.n_leaves, np.inf, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.sums[1]
+
+    @property
+    def min(self):
+        return self.mins[1]
+
+    def get(self, idxs):
+        return self.sums[np.asarray(idxs) + self.n_leaves]
+
+    def update(self, idxs, priorities):
+        """
+        Set the priorities of the leaves `idxs`, `priorities` is an array or
+        a scalar. For repeated indices the last priority is kept.
+        """
+        nodes = np.asarray(idxs, dtype=np.int64) + self.n_leaves
+        self.sums[nodes] = priorities
+        # The zero priorities are never sampled so they are not a minimum.
+        priorities = np.asarray(priorities, dtype=np.float64)
+        self.mins[nodes] = np.where(priorities > 0, priorities, np.inf)
+        # The parents are recomputed from their children so the repeated
+        # parents of a level all write the same value.
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            left = 2 * nodes
+            self.sums[nodes] = self.sums[left] + self.sums[left + 1]
+            self.mins[nodes] = np.minimum(self.mins[left], self.mins[left + 1])
+
+    def find(self, values):
+        """
+        The indices of the leaves where the prefix sums of the priorities
+        reach `values`, which are in [0, total).
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sums = self.sums[left]
+            go_right = values >= left_sums
+            values -= np.where(go_right, left_sums, 0.0)
+            nodes = left + go_right
+        return nodes - self.n_leaves
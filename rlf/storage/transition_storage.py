@@ -2,15 +2,30 @@
 Code is heavily based off of https://github.com/denisyarats/pytorch_sac.
 The license is at `rlf/algos/off_policy/denis_yarats_LICENSE.md`
 """
+import copy
+import json
+import os
+import os.path as osp
 import pickle
 import random
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 from typing import Optional
 
 import numpy as np
 import rlf.rl.utils as rutils
 import torch
+from rlf.baselines import logger
 from rlf.storage.base_storage import BaseStorage
+from rlf.storage.memory_planner import MemoryPlan, from_storage_dtype
+from rlf.storage.replay_prefetcher import ReplayPrefetcher
+from rlf.storage.sum_tree import SumTree
+
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
 
 
 class TransitionStorage(BaseStorage):
@@ -25,55 +40,434 @@ class TransitionStorage(BaseStorage):
         self.obs_space = obs_space
         self.action_shape = action_shape
 
-        # the proprioceptive obs is stored as float32, pixels obs as uint8
+        # With the "memmap" backend each field is a `.npy` file in
+        # `self.replay_dir` which is reopened if it already exists, so the
+        # buffer survives restarts.
+        self.replay_dir = None
+        # With `--replay-dedup-obs` the next observations are not stored, see
+        # `_insert_next_obs`.
+        self.dedup_obs = args.replay_dedup_obs
+        if args.replay_backend == "memmap":
+            if self.dedup_obs:
+                raise ValueError(
+                    "The memmap replay backend does not keep the terminal "
+                    "observations of --replay-dedup-obs"
+                )
+            self.replay_dir = args.replay_dir
+            if self.replay_dir == "":
+                self.replay_dir = osp.join(
+                    args.save_dir, args.env_name, args.prefix, "replay"
+                )
+            os.makedirs(self.replay_dir, exist_ok=True)
+        self._reused = []
+
+        # The fields are planned first to check that they fit in the memory
+        # budget before allocating them.
+        self.mem_plan = MemoryPlan("TransitionStorage")
+        plan = self.mem_plan
+        if args.storage_ob_dtype == "bfloat16":
+            raise ValueError("TransitionStorage does not support bfloat16 observations")
+
+        # the proprioceptive obs is stored as float32 (or the
+        # `--storage-ob-dtype`), pixels obs as uint8
         self.ob_keys = rutils.get_ob_shapes(obs_space)
-        self.obses = {}
-        self.next_obses = {}
+        # (name, shape, dtype) of the fields, named as in `_named_fields`.
+        fields = []
         for k, obs_shape in self.ob_keys.items():
-            obs_dtype = np.float32 if len(obs_shape) == 1 else np.uint8
-            ob = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-            next_ob = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-            if k is None:
-                self.obses = ob
-                self.next_obses = next_ob
+            ob_dtype = np.uint8 if len(obs_shape) != 1 else args.storage_ob_dtype
+            name = "obs" if k is None else f"obs.{k}"
+            fields.append((name, obs_shape, ob_dtype))
+            if not self.dedup_obs:
+                fields.append((f"next_{name}", obs_shape, ob_dtype))
+        fields.append(("actions", action_shape, np.float32))
+        fields.append(("rewards", (1,), np.float32))
+        # The masks are stored as bools and read as float32.
+        fields.append(("masks", (1,), bool))
+        fields.append(("masks_no_max", (1,), bool))
+
+        # With `--replay-packed` the fields other than the pixel obs are the
+        # float32 columns `self._pack_columns[name] = (start, end, shape)`
+        # of the single (capacity, width) array `self._packed`, so sampling
+        # a batch is one gather and one transfer.
+        self._pack_columns = OrderedDict()
+        width = 0
+        if args.replay_packed:
+            for name, shape, dtype in fields:
+                if np.dtype(dtype) != np.uint8:
+                    size = int(np.prod(shape))
+                    self._pack_columns[name] = (width, width + size, tuple(shape))
+                    width += size
+        for name, shape, dtype in fields:
+            if name not in self._pack_columns:
+                plan.add(name, (capacity, *shape), dtype)
+        if width > 0:
+            plan.add("packed", (capacity, width), np.float32)
+        # The memory budget is for the RAM, not the disk.
+        plan.check(
+            args.storage_mem_budget if self.replay_dir is None else 0, verbose=True
+        )
+
+        self._packed = None
+        if width > 0:
+            self._packed = self._alloc("packed", (capacity, width), np.float32)
+        self.obses = {}
+        self.next_obses = None if self.dedup_obs else {}
+        for name, shape, dtype in fields:
+            if name in self._pack_columns:
+                x = self._packed_view(self._packed, name)
             else:
-                self.obses[k] = ob
-                self.next_obses[k] = next_ob
+                x = self._alloc(name, (capacity, *shape), dtype)
+            self._set_field(name, x)
+        # With `dedup_obs` the next observations of the terminal transitions
+        # that are not the observation that follows them. `_final_slot[row]`
+        # is the row of `_final_obs[k]` holding the next observation of
+        # `row`, -1 if there is none. The slots are allocated from
+        # `_free_slots` and `_final_obs` grows when they run out.
+        if self.dedup_obs:
+            self._final_slot = np.full(capacity, -1, dtype=np.int64)
+            self._final_obs = {
+                k: np.zeros((0, *obs_shape), dtype=self._get_obs_field(k).dtype)
+                for k, obs_shape in self.ob_keys.items()
+            }
+            self._free_slots = np.zeros(0, dtype=np.int64)
+        # The terminal rows of the last insert.
+        self._check_final = np.zeros(0, dtype=np.int64)
+
+        # [idx, full, n_inserted, num_envs], stored with the fields so a
+        # reopened buffer knows which transitions are valid.
+        self._pos = self._alloc("pos", (4,), np.int64)
+        if not all(self._reused):
+            self._pos[:] = 0
+        elif len(self) > 0:
+            logger.log(f"Reopened the {len(self)} transitions of {self.replay_dir}")
+        # The value of `n_inserted` at the last `save_storage`.
+        self.last_save = self.n_inserted
+        self._save_thread = None
+
+        # With a prioritized replay the transitions are sampled
+        # proportionally to `(|td error| + eps) ** alpha`, new transitions
+        # get the highest priority seen so far.
+        self.priorities = None
+        if args.prioritized_replay:
+            self.priorities = SumTree(capacity)
+            self.max_priority = 1.0
+            if len(self) > 0:
+                self.priorities.update(
+                    self._rows(np.arange(len(self))), self.max_priority
+                )
 
-        self.actions = np.empty((capacity, *action_shape), dtype=np.float32)
-        self.rewards = np.empty((capacity, 1), dtype=np.float32)
-        self.masks = np.empty((capacity, 1), dtype=np.float32)
-        self.masks_no_max = np.empty((capacity, 1), dtype=np.float32)
+        self._modify_reward_fn = None
+        # Held while the buffer is written so the batches sampled by the
+        # `ReplayPrefetcher` of `--replay-prefetch` only see fully inserted
+        # transitions.
+        self._lock = threading.Lock()
+        self._prefetcher = None
 
-        self.idx = 0
-        self.last_save = 0
-        self.full = False
+    def _alloc(self, name, shape, dtype):
+        """
+        Allocates a field in RAM, or as a memory-mapped `.npy` file with the
+        "memmap" backend. An existing file of the same shape and dtype is
+        reopened, which is recorded in `self._reused`.
+        """
+        if self.replay_dir is None:
+            self._reused.append(False)
+            return np.zeros(shape, dtype=dtype)
+        path = osp.join(self.replay_dir, name + ".npy")
+        if osp.exists(path):
+            arr = np.lib.format.open_memmap(path, mode="r+")
+            if arr.shape == tuple(shape) and arr.dtype == np.dtype(dtype):
+                self._reused.append(True)
+                return arr
+            del arr
+        self._reused.append(False)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def _packed_view(self, packed, name):
+        """
+        The view of the field `name` in the packed rows `packed`, an array
+        or a tensor.
+        """
+        start, end, shape = self._pack_columns[name]
+        x = packed[:, start:end]
+        if isinstance(x, torch.Tensor):
+            return x.view(-1, *shape)
+        # Setting the shape raises rather than copying.
+        x.shape = (-1, *shape)
+        return x
+
+    def _set_field(self, name, x):
+        """
+        Sets the field `name` of `_named_fields` to the array `x`.
+        """
+        field, _, k = name.partition(".")
+        attr = {"obs": "obses", "next_obs": "next_obses"}.get(field, field)
+        if k == "":
+            setattr(self, attr, x)
+        else:
+            getattr(self, attr)[k] = x
 
-        self._modify_reward_fn = None
+    @property
+    def idx(self):
+        return int(self._pos[0])
+
+    @idx.setter
+    def idx(self, idx):
+        self._pos[0] = idx
+
+    @property
+    def full(self):
+        return bool(self._pos[1])
+
+    @full.setter
+    def full(self, full):
+        self._pos[1] = full
+
+    @property
+    def n_inserted(self):
+        """
+        The total number of transitions ever inserted.
+        """
+        return int(self._pos[2])
+
+    @n_inserted.setter
+    def n_inserted(self, n_inserted):
+        self._pos[2] = n_inserted
+
+    @property
+    def num_envs(self):
+        """
+        The number of transitions of each insert, one per environment.
+        """
+        return int(self._pos[3])
+
+    def _rows(self, ordinals):
+        """
+        The rows of the valid transitions `ordinals`, from 0 for the oldest
+        to `len(self) - 1` for the newest.
+        """
+        return (self.idx - len(self) + ordinals) % self.capacity
+
+    def _get_obs_field(self, k):
+        """
+        The (capacity, ...) array of the observation key `k`.
+        """
+        return self.obses if k is None else self.obses[k]
+
+    def _named_fields(self):
+        """
+        The {name: (capacity, ...) array} of the fields, named as their
+        memory-mapped files.
+        """
+        fields = OrderedDict()
+        all_obs = [("obs", self.obses)]
+        if not self.dedup_obs:
+            all_obs.append(("next_obs", self.next_obses))
+        for name, obs in all_obs:
+            if isinstance(obs, dict):
+                for k, x in obs.items():
+                    fields[f"{name}.{k}"] = x
+            else:
+                fields[name] = obs
+        fields["actions"] = self.actions
+        fields["rewards"] = self.rewards
+        fields["masks"] = self.masks
+        fields["masks_no_max"] = self.masks_no_max
+        return fields
+
+    def flush(self):
+        """
+        Writes the memory-mapped fields to disk. Not needed to survive a
+        restart of the process, only a crash of the machine.
+        """
+        for x in [self._pos, self._packed, *self._named_fields().values()]:
+            if isinstance(x, np.memmap):
+                x.flush()
 
     def copy_storage(self) -> BaseStorage:
-        new_storage = TransitionStorage(
-            self.obs_space, self.action_shape, self.capacity, self.args
-        )
+        """
+        The copy is always in RAM, even with the "memmap" backend.
+        """
+        new_storage = copy.copy(self)
+        new_storage.replay_dir = None
+        new_storage._pos = np.copy(self._pos)
+        new_storage._save_thread = None
+        new_storage._lock = threading.Lock()
+        new_storage._prefetcher = None
         new_storage.actions = np.copy(self.actions)
         new_storage.obses = rutils.obs_op(self.obses, lambda x: np.copy(x))
-        new_storage.next_obses = rutils.obs_op(self.next_obses, lambda x: np.copy(x))
+        if not self.dedup_obs:
+            new_storage.next_obses = rutils.obs_op(
+                self.next_obses, lambda x: np.copy(x)
+            )
+        if self.dedup_obs:
+            new_storage._final_slot = np.copy(self._final_slot)
+            new_storage._final_obs = {
+                k: np.copy(x) for k, x in self._final_obs.items()
+            }
+            new_storage._free_slots = np.copy(self._free_slots)
         new_storage.rewards = np.copy(self.rewards)
         new_storage.masks = np.copy(self.masks)
         new_storage.masks_no_max = np.copy(self.masks_no_max)
-        new_storage.idx = self.idx
-        new_storage.last_save = self.last_save
-        new_storage.full = self.full
-        new_storage._modify_reward_fn = self._modify_reward_fn
+        if self._packed is not None:
+            new_storage._packed = np.copy(self._packed)
+            for name in self._pack_columns:
+                new_storage._set_field(
+                    name, new_storage._packed_view(new_storage._packed, name)
+                )
+        if self.priorities is not None:
+            new_storage.priorities = copy.deepcopy(self.priorities)
+            new_storage.max_priority = self.max_priority
         return new_storage
 
-    def save_storage(self, save_path):
-        with open(save_path, "wb") as f:
-            pickle.dump(self, f)
-        print("Saved storage to ", save_path)
+    def save_storage(self, save_dir):
+        """
+        Appends the transitions inserted since the last save to `save_dir`
+        as a numbered chunk file and adds it to the `index.json` of the
+        directory. The chunk is copied out of the buffer on the calling
+        thread and written to disk on a background thread. Chunks whose
+        transitions were all overwritten since are deleted.
+        """
+        self.wait_save()
+        os.makedirs(save_dir, exist_ok=True)
+        index_path = osp.join(save_dir, "index.json")
+        if osp.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+        else:
+            index = {"capacity": self.capacity, "chunks": []}
+        assert index["capacity"] == self.capacity, "Saving to another buffer's directory"
+
+        count = min(self.n_inserted - self.last_save, self.capacity)
+        end = self.n_inserted
+        # Chunks after the last save are from a run that was not resumed.
+        stale_chunks = [c for c in index["chunks"] if c["end"] > self.last_save]
+        self.last_save = end
+        if count <= 0:
+            return
+        start = (self.idx - count) % self.capacity
+        rows = (start + np.arange(count)) % self.capacity
+        chunk = {name: x[rows] for name, x in self._named_fields().items()}
+        if self.dedup_obs:
+            chunk.update(self._dedup_fields(rows))
+        chunk_name = "chunk_%i.npz" % end
+        # Chunks before `end - capacity` were overwritten by the newer ones.
+        old_chunks = stale_chunks + [
+            c for c in index["chunks"] if c["end"] <= end - self.capacity
+        ]
+        index["chunks"] = [c for c in index["chunks"] if c not in old_chunks]
+        index["chunks"].append(
+            {"file": chunk_name, "start": int(start), "count": count, "end": end}
+        )
+
+        def write():
+            np.savez(osp.join(save_dir, chunk_name), **chunk)
+            # The index is replaced atomically after the chunk is complete
+            # so an interrupted save keeps the previous index.
+            tmp_path = index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+            for c in old_chunks:
+                if c["file"] != chunk_name:
+                    os.remove(osp.join(save_dir, c["file"]))
+
+        self._save_thread = threading.Thread(target=write, daemon=True)
+        self._save_thread.start()
+
+    def _dedup_fields(self, rows):
+        """
+        The fields a chunk of the rows `rows` also needs with `dedup_obs`:
+        the next observations of the newest transitions, written ahead of
+        them, and the terminal next observations of `rows`.
+        """
+        fields = {"num_envs": np.array(self.num_envs)}
+        lookahead = (self.idx + np.arange(self.num_envs)) % self.capacity
+        final_rows = rows[self._final_slot[rows] >= 0]
+        fields["final_rows"] = final_rows
+        for k in self.ob_keys:
+            name = "obs" if k is None else f"obs.{k}"
+            fields[f"lookahead_{name}"] = self._get_obs_field(k)[lookahead]
+            fields[f"final_{name}"] = self._final_obs[k][self._final_slot[final_rows]]
+        return fields
+
+    def _load_dedup_fields(self, chunk, rows):
+        """
+        Restores the fields of `_dedup_fields` from a chunk of the rows
+        `rows`.
+        """
+        self._pos[3] = int(chunk["num_envs"])
+        self._free_final(rows)
+        lookahead = (rows[-1] + 1 + np.arange(self.num_envs)) % self.capacity
+        final_rows = chunk["final_rows"]
+        slots = self._alloc_final(final_rows)
+        for k in self.ob_keys:
+            name = "obs" if k is None else f"obs.{k}"
+            self._get_obs_field(k)[lookahead] = chunk[f"lookahead_{name}"]
+            self._final_obs[k][slots] = chunk[f"final_{name}"]
+
+    def wait_save(self):
+        """
+        Waits for the background write of the last `save_storage`.
+        """
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+
+    def load_storage(self, save_dir, max_inserted=None):
+        """
+        Streams the chunks of `save_dir` back into the buffer one at a time,
+        up to the chunk saved when `max_inserted` transitions were inserted.
+        """
+        with open(osp.join(save_dir, "index.json"), "r") as f:
+            index = json.load(f)
+        assert index["capacity"] == self.capacity, "Loading another buffer's chunks"
+        end = 0
+        for c in index["chunks"]:
+            if max_inserted is not None and c["end"] > max_inserted:
+                break
+            rows = (c["start"] + np.arange(c["count"])) % self.capacity
+            with np.load(osp.join(save_dir, c["file"])) as chunk:
+                for name, x in self._named_fields().items():
+                    x[rows] = chunk[name]
+                if self.dedup_obs:
+                    self._load_dedup_fields(chunk, rows)
+            end = c["end"]
+        self.n_inserted = end
+        self.last_save = end
+        self.idx = end % self.capacity
+        self.full = end >= self.capacity
+        if self.priorities is not None:
+            self.priorities = SumTree(self.capacity)
+            self.priorities.update(self._rows(np.arange(len(self))), self.max_priority)
+        logger.log(f"Loaded {len(self)} transitions from {save_dir}")
+
+    def save(self, checkpointer):
+        if not self.args.save_replay:
+            return
+        save_dir = checkpointer.get_storage_dir()
+        self.save_storage(save_dir)
+        checkpointer.save_key(
+            "replay_storage", {"dir": save_dir, "n_inserted": self.n_inserted}
+        )
+
+    def load_resume(self, checkpointer):
+        if not checkpointer.has_load_key("replay_storage"):
+            return
+        replay_state = checkpointer.get_key("replay_storage")
+        self.load_storage(replay_state["dir"], replay_state["n_inserted"])
+
+    def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        self.wait_save()
+        self.flush()
 
     @staticmethod
     def load_from_file(load_path):
+        """
+        Loads a storage pickled by older versions.
+        """
         print("Loading storage from ", load_path)
         with open(load_path, "rb") as f:
             return pickle.load(f)
@@ -98,17 +492,9 @@ class TransitionStorage(BaseStorage):
         if num_samples > len(self):
             return None
         if from_recent:
-            all_indices = []
-            max_side = self.idx
-            all_indices = list(range(max(self.idx - num_samples, 0), self.idx))
-
-            overflow_amount = num_samples - self.idx
-            if self.full and overflow_amount > 0:
-                all_indices.extend(
-                    [list(range(self.capacity - overflow_amount, self.capacity))]
-                )
+            all_indices = self._rows(np.arange(len(self) - num_samples, len(self)))
         else:
-            all_indices = list(range(0, self.capacity if self.full else self.idx))
+            all_indices = self._rows(np.arange(len(self)))
 
         if n_mini_batches > 0:
             num_batches = min(num_samples // mini_batch_size, n_mini_batches)
@@ -118,10 +504,10 @@ class TransitionStorage(BaseStorage):
             idxs = np.random.choice(all_indices, mini_batch_size)
 
             obses, other_obses = self._dict_sel(self.obses, idxs)
-            next_obses, other_next_obses = self._dict_sel(self.next_obses, idxs)
+            next_obses, other_next_obses = self._obs_tensors(self._get_next_obs(idxs))
             actions = torch.as_tensor(self.actions[idxs], device=self.device)
             rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-            masks = torch.as_tensor(self.masks[idxs], device=self.device)
+            masks = torch.as_tensor(self.masks[idxs], device=self.device).float()
 
             yield {
                 "state": obses,
@@ -134,20 +520,149 @@ class TransitionStorage(BaseStorage):
             }
 
     def __len__(self):
-        return self.capacity if self.full else self.idx
+        # With `dedup_obs` the observations of the oldest `num_envs` rows
+        # were overwritten by the next observations of the newest ones.
+        lookahead = self.num_envs if self.dedup_obs else 0
+        return min(self.n_inserted, self.capacity - lookahead)
 
-    def sample_tensors(self, batch_size):
-        idxs = np.random.randint(
-            0, self.capacity if self.full else self.idx, size=batch_size
+    def _sample_uniform(self, batch_size):
+        """
+        With `--replay-sample-chunk` > 1 the batch is made of runs of that
+        many consecutive transitions from random starts, which reads fewer
+        pages of a memory-mapped buffer than independent indices.
+        """
+        n = len(self)
+        chunk = self.args.replay_sample_chunk
+        if chunk <= 1:
+            return self._rows(np.random.randint(0, n, size=batch_size))
+        starts = np.random.randint(0, n, size=-(-batch_size // chunk))
+        idxs = (starts[:, None] + np.arange(chunk)).reshape(-1)[:batch_size]
+        return self._rows(idxs % n)
+
+    def _sample_prioritized(self, batch_size):
+        """
+        Stratified sampling: one index is drawn from each of `batch_size`
+        equal segments of the total priority. Returns the indices and their
+        (batch_size, 1) importance weights, normalized by the largest weight.
+        """
+        total = self.priorities.total
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * (
+            total / batch_size
         )
+        idxs = self.priorities.find(values)
+        # Rounding errors can reach the rows without a priority.
+        idxs[self.priorities.get(idxs) == 0] = self._rows(len(self) - 1)
+        beta = self.args.per_beta
+        weights = (self.priorities.get(idxs) / total) ** -beta
+        weights /= (self.priorities.min / total) ** -beta
+        return idxs, weights.astype(np.float32).reshape(-1, 1)
+
+    def update_priorities(self, idxs, td_errors):
+        """
+        Sets the priorities of the transitions `idxs` from the absolute TD
+        errors `td_errors` of the last update.
+        """
+        priorities = (np.abs(td_errors) + self.args.per_eps) ** self.args.per_alpha
+        with self._lock:
+            self.max_priority = max(self.max_priority, priorities.max())
+            self.priorities.update(idxs, priorities)
 
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        obses, other_obses = self._dict_sel(self.obses, idxs)
-        next_obses, other_next_obses = self._dict_sel(self.next_obses, idxs)
+    def _sample_batch(self, batch_size):
+        """
+        Samples `batch_size` transitions and gathers their fields as numpy
+        arrays. Called by the `ReplayPrefetcher` thread, under `self._lock`.
+        """
+        with self._lock:
+            batch = {}
+            if self.priorities is not None:
+                idxs, weights = self._sample_prioritized(batch_size)
+                batch["sample_weights"] = weights
+                batch["sample_idxs"] = idxs
+            else:
+                idxs = self._sample_uniform(batch_size)
+            if self._packed is not None:
+                batch["packed"] = self._packed[idxs]
+                batch.update(self._select_unpacked("obs", self.obses, idxs))
+                if self.dedup_obs:
+                    batch["next_obs"] = self._get_next_obs(idxs)
+                else:
+                    batch.update(
+                        self._select_unpacked("next_obs", self.next_obses, idxs)
+                    )
+                return batch
+            batch["obs"] = rutils.obs_select(self.obses, idxs)
+            batch["next_obs"] = self._get_next_obs(idxs)
+            batch["actions"] = self.actions[idxs]
+            batch["rewards"] = self.rewards[idxs]
+            batch["masks"] = self.masks[idxs]
+        return batch
+
+    def _select_unpacked(self, name, obs, idxs):
+        """
+        {name: rows `idxs` of the obs `obs` that are not packed}, the packed
+        ones are added by `_unpack_batch`.
+        """
+        if isinstance(obs, dict):
+            return {
+                name: {
+                    k: x[idxs]
+                    for k, x in obs.items()
+                    if f"{name}.{k}" not in self._pack_columns
+                }
+            }
+        if name in self._pack_columns:
+            return {}
+        return {name: obs[idxs]}
 
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        masks = torch.as_tensor(self.masks[idxs], device=self.device)
-        masks_no_max = torch.as_tensor(self.masks_no_max[idxs], device=self.device)
+    def _unpack_batch(self, batch):
+        """
+        Replaces the "packed" rows of a batch by the views of their columns.
+        """
+        packed = torch.as_tensor(batch.pop("packed"), device=self.device)
+        for name in self._pack_columns:
+            if name == "masks_no_max":
+                continue
+            field, _, k = name.partition(".")
+            x = self._packed_view(packed, name)
+            if k == "":
+                batch[field] = x
+            else:
+                batch.setdefault(field, {})[k] = x
+        return batch
+
+    def sample_tensors(self, batch_size):
+        """
+        With a prioritized replay `add_info` also has the (batch_size, 1)
+        importance "sample_weights" and the "sample_idxs" of the transitions
+        for `update_priorities`. With `--replay-prefetch` the batch comes
+        from the `ReplayPrefetcher` and is only valid until the next call.
+        """
+        if self.args.replay_prefetch > 0:
+            if self._prefetcher is None or self._prefetcher.batch_size != batch_size:
+                if self._prefetcher is not None:
+                    self._prefetcher.close()
+                self._prefetcher = ReplayPrefetcher(
+                    self, batch_size, self.args.replay_prefetch
+                )
+            batch = self._prefetcher.get()
+        else:
+            batch = self._sample_batch(batch_size)
+        if "packed" in batch:
+            batch = self._unpack_batch(batch)
+
+        sample_info = {}
+        if "sample_idxs" in batch:
+            sample_info = {
+                "sample_weights": torch.as_tensor(
+                    batch["sample_weights"], device=self.device
+                ),
+                "sample_idxs": batch["sample_idxs"],
+            }
+        actions = torch.as_tensor(batch["actions"], device=self.device)
+        obses, other_obses = self._obs_tensors(batch["obs"])
+        next_obses, other_next_obses = self._obs_tensors(batch["next_obs"])
+        rewards = torch.as_tensor(batch["rewards"], device=self.device)
+        masks = torch.as_tensor(batch["masks"], device=self.device).float()
 
         if self._modify_reward_fn is not None:
             rewards = self._modify_reward_fn(obses, actions, next_obses, masks)
@@ -157,7 +672,7 @@ class TransitionStorage(BaseStorage):
             next_obses,
             actions,
             rewards,
-            {"other_state": other_obses},
+            {"other_state": other_obses, **sample_info},
             {"mask": masks, "other_state": other_next_obses},
         )
 
@@ -181,17 +696,121 @@ class TransitionStorage(BaseStorage):
         return self.last_seen["masks"]
 
     def _dict_sel(self, obs, idx):
+        return self._obs_tensors(rutils.obs_select(obs, idx))
+
+    def _obs_tensors(self, obs):
+        """
+        Splits the numpy batch of observations `obs` into the tensors of the
+        policy observation and the dict of the other observations.
+        """
         obs_batch = None
         other_obs_batch = {}
         for k, ob_shape in self.ob_keys.items():
             if k is None:
-                obs_batch = torch.as_tensor(obs[idx], device=self.device).float()
+                obs_batch = torch.as_tensor(obs, device=self.device).float()
             elif k == self.args.policy_ob_key:
-                obs_batch = torch.as_tensor(obs[k][idx], device=self.device)
+                obs_batch = from_storage_dtype(
+                    torch.as_tensor(obs[k], device=self.device)
+                )
             else:
-                other_obs_batch[k] = torch.as_tensor(obs[k][idx], device=self.device)
+                other_obs_batch[k] = from_storage_dtype(
+                    torch.as_tensor(obs[k], device=self.device)
+                )
         return obs_batch, other_obs_batch
 
+    def _get_next_obs(self, idxs):
+        """
+        The numpy next observations of the rows `idxs`. With `dedup_obs` it
+        is the observation of the next transition of the same environment,
+        `num_envs` rows later, except for the terminal transitions with a
+        slot in `self._final_obs`.
+        """
+        if not self.dedup_obs:
+            return rutils.obs_select(self.next_obses, idxs)
+        next_obs = rutils.obs_select(self.obses, (idxs + self.num_envs) % self.capacity)
+        slots = self._final_slot[idxs]
+        is_final = slots >= 0
+        if is_final.any():
+            slots = slots[is_final]
+            if isinstance(next_obs, dict):
+                for k in next_obs:
+                    next_obs[k][is_final] = self._final_obs[k][slots]
+            else:
+                next_obs[is_final] = self._final_obs[None][slots]
+        return next_obs
+
+    def _alloc_final(self, rows):
+        """
+        Assigns a slot of `self._final_obs` to each of the rows `rows`, which
+        must not have one, growing `self._final_obs` if needed. Returns the
+        slots.
+        """
+        n = len(rows)
+        if len(self._free_slots) < n:
+            # The `self._final_obs` arrays have the same length.
+            size = len(next(iter(self._final_obs.values())))
+            new_size = max(2 * size, size + n, 64)
+            for k, x in self._final_obs.items():
+                grown = np.zeros((new_size, *x.shape[1:]), dtype=x.dtype)
+                grown[:size] = x
+                self._final_obs[k] = grown
+            self._free_slots = np.concatenate(
+                [self._free_slots, np.arange(size, new_size)]
+            )
+        slots = self._free_slots[len(self._free_slots) - n :]
+        self._free_slots = self._free_slots[: len(self._free_slots) - n]
+        self._final_slot[rows] = slots
+        return slots
+
+    def _free_final(self, rows):
+        """
+        Releases the `self._final_obs` slots of the rows `rows`.
+        """
+        slots = self._final_slot[rows]
+        slots = np.unique(slots[slots >= 0])
+        if len(slots) == 0:
+            return
+        self._free_slots = np.concatenate([self._free_slots, slots])
+        self._final_slot[rows] = -1
+
+    def _insert_next_obs(self, rows, next_obs, done):
+        """
+        With `dedup_obs` the next observation of a transition is the
+        observation of the next transition of the same environment, which is
+        inserted `num_envs` rows later. The next observations are written
+        ahead to these rows so the newest transitions can be sampled. The
+        next observations of the terminal transitions are also kept in
+        `self._final_obs` until the next insert shows whether they differ
+        from the observation that follows.
+        """
+        n = self.num_envs
+        check_rows = self._check_final[self._final_slot[self._check_final] >= 0]
+        if len(check_rows) > 0:
+            slots = self._final_slot[check_rows]
+            after_rows = (check_rows + n) % self.capacity
+            same = np.ones(len(check_rows), dtype=bool)
+            for k, final in self._final_obs.items():
+                after = self._get_obs_field(k)[after_rows]
+                same &= (final[slots] == after).reshape(len(check_rows), -1).all(1)
+            self._free_final(check_rows[same])
+        next_rows = (rows + n) % self.capacity
+        # The transitions of these rows are overwritten.
+        self._free_final(np.concatenate([rows, next_rows]))
+        for k in self.ob_keys:
+            if k is None:
+                self.obses[next_rows] = next_obs
+            else:
+                self.obses[k][next_rows] = next_obs[k]
+        if self.priorities is not None:
+            # The look-ahead rows are not valid transitions yet.
+            self.priorities.update(next_rows, 0.0)
+        done_idx = np.nonzero(np.asarray(done).reshape(-1))[0]
+        slots = self._alloc_final(rows[done_idx])
+        for k in self.ob_keys:
+            final = next_obs if k is None else next_obs[k]
+            self._final_obs[k][slots] = final[done_idx]
+        self._check_final = rows[done_idx]
+
     def insert(self, obs, next_obs, reward, done, infos, ac_info):
         masks, bad_masks = self.compute_masks(done, infos)
         self.last_seen = {
@@ -200,20 +819,18 @@ class TransitionStorage(BaseStorage):
             "hxs": ac_info.hxs,
         }
 
-        use_next_obs = {}
-        use_obs = {}
-        for k in self.ob_keys:
-            if k is None:
-                if isinstance(obs, torch.Tensor):
-                    use_obs = obs.cpu().numpy()
-                if isinstance(next_obs, torch.Tensor):
-                    use_next_obs = next_obs.cpu().numpy()
-            else:
-                if isinstance(obs[k], torch.Tensor):
-                    use_obs[k] = obs[k].cpu().numpy()
-                if isinstance(next_obs[k], torch.Tensor):
-                    use_next_obs[k] = next_obs[k].cpu().numpy()
-        action = ac_info.take_action
+        # The runner passes tensors, possibly on the device, and the
+        # environments numpy arrays.
+        if None in self.ob_keys:
+            use_obs = _to_numpy(obs)
+            use_next_obs = _to_numpy(next_obs)
+        else:
+            use_obs = {k: _to_numpy(obs[k]) for k in self.ob_keys}
+            use_next_obs = {k: _to_numpy(next_obs[k]) for k in self.ob_keys}
+        action = _to_numpy(ac_info.take_action)
+        reward = _to_numpy(reward).reshape(-1, 1)
+        done = _to_numpy(done).astype(bool).reshape(-1, 1)
+        bad_masks = _to_numpy(bad_masks)
 
         def copy_from_to(buffer_start, batch_start, how_many):
             buffer_slice = slice(buffer_start, buffer_start + how_many)
@@ -222,31 +839,51 @@ class TransitionStorage(BaseStorage):
             for k, ob_shape in self.ob_keys.items():
                 if k is None:
                     np.copyto(self.obses[buffer_slice], use_obs[batch_slice])
-                    np.copyto(self.next_obses[buffer_slice], use_next_obs[batch_slice])
+                    if not self.dedup_obs:
+                        np.copyto(
+                            self.next_obses[buffer_slice], use_next_obs[batch_slice]
+                        )
                 else:
                     np.copyto(self.obses[k][buffer_slice], use_obs[k][batch_slice])
-                    np.copyto(
-                        self.next_obses[k][buffer_slice], use_next_obs[k][batch_slice]
-                    )
+                    if not self.dedup_obs:
+                        np.copyto(
+                            self.next_obses[k][buffer_slice],
+                            use_next_obs[k][batch_slice],
+                        )
 
             np.copyto(self.actions[buffer_slice], action[batch_slice])
             np.copyto(self.rewards[buffer_slice], reward[batch_slice])
-            np.copyto(self.masks[buffer_slice], done[batch_slice])
-            np.copyto(self.masks_no_max[buffer_slice], bad_masks[batch_slice])
-
-        _batch_start = 0
-        obs_len = rutils.get_def_obs(use_obs).shape[0]
-        buffer_end = self.idx + obs_len
-        if buffer_end > self.capacity:
-            copy_from_to(self.idx, _batch_start, self.capacity - self.idx)
-            _batch_start = self.capacity - self.idx
-            self.idx = 0
-            self.full = True
-
-        _how_many = obs_len - _batch_start
-        copy_from_to(self.idx, _batch_start, _how_many)
-        self.idx = (self.idx + _how_many) % self.capacity
-        self.full = self.full or self.idx == 0
+            np.copyto(self.masks[buffer_slice], done[batch_slice], casting="unsafe")
+            np.copyto(
+                self.masks_no_max[buffer_slice],
+                bad_masks[batch_slice],
+                casting="unsafe",
+            )
+            if self.priorities is not None:
+                self.priorities.update(
+                    np.arange(buffer_start, buffer_start + how_many),
+                    self.max_priority,
+                )
+
+        with self._lock:
+            _batch_start = 0
+            obs_len = len(done)
+            self._pos[3] = obs_len
+            rows = (self.idx + np.arange(obs_len)) % self.capacity
+            buffer_end = self.idx + obs_len
+            if buffer_end > self.capacity:
+                copy_from_to(self.idx, _batch_start, self.capacity - self.idx)
+                _batch_start = self.capacity - self.idx
+                self.idx = 0
+                self.full = True
+
+            _how_many = obs_len - _batch_start
+            copy_from_to(self.idx, _batch_start, _how_many)
+            self.idx = (self.idx + _how_many) % self.capacity
+            self.full = self.full or self.idx == 0
+            if self.dedup_obs:
+                self._insert_next_obs(rows, use_next_obs, done)
+            self.n_inserted += obs_len
 
     def set_modify_reward_fn(self, modify_reward_fn):
         self._modify_reward_fn = modify_reward_fn
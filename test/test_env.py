@@ -1,5 +1,7 @@
 import os.path as osp
 
+import gym
+import numpy as np
 import pytest
 import rlf.envs.pointmass
 from rlf import run_policy
@@ -38,3 +40,64 @@ def test_pm_settings():
         f"--prefix 'ppo-test' --use-proper-time-limits --linear-lr-decay True --lr 3e-4 --entropy-coef 0 --num-env-steps {NUM_ENV_SAMPLES} --num-mini-batch 32 --num-epochs 10 --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes {NUM_PROCS} --cuda False --pm-start-idx 0 --force-multi-proc True --normalize-env False"
     )
     run_policy(run_settings)
+
+
+def test_spaces_key():
+    from rlf.envs.env_interface import get_env_interface
+    from rlf.rl.envs import get_spaces_key
+
+    TEST_ENV = "RltPointMassEnvSpawnRange-v0"
+
+    def get_key(args_str):
+        run_settings = PPORunSettings(f"--env-name {TEST_ENV} --cuda False {args_str}")
+        args = run_settings.get_args(PPO(), DistActorCritic())
+        env_interface = get_env_interface(TEST_ENV)(args)
+        return get_spaces_key(TEST_ENV, False, env_interface, args)
+
+    key = get_key("--lr 3e-4")
+    # Only the settings of the environments change the key.
+    assert get_key("--lr 1e-2 --num-processes 4") == key
+    assert get_key("--pm-start-idx 0") != key
+    assert get_key("--warp-frame True") != key
+
+
+class ImageEnv(gym.Env):
+    observation_space = gym.spaces.Box(0, 255, (84, 84, 3), dtype=np.uint8)
+    action_space = gym.spaces.Discrete(2)
+
+    def reset(self):
+        return np.zeros((84, 84, 3), dtype=np.uint8)
+
+    def step(self, action):
+        return self.reset(), 0.0, False, {}
+
+
+gym.register("RltImageTest-v0", entry_point=ImageEnv, max_episode_steps=10)
+
+
+def test_async_frame_stack():
+    args = f"--prefix 'ppo-test' --num-env-steps {NUM_ENV_SAMPLES} --num-steps {NUM_STEPS} --env-name RltImageTest-v0 --eval-interval -1 --save-interval -1 --num-processes 4 --async-batch-size 2 --vec-env-backend dummy --cuda False"
+    with pytest.raises(ValueError, match="frame stacking"):
+        run_policy(PPORunSettings(args))
+    # Without frame stacking the asynchronous rollouts are supported.
+    run_policy(PPORunSettings(args + " --frame-stack False"))
+
+
+def test_use_vec_monitor():
+    from types import SimpleNamespace
+
+    from rlf.envs.env_interface import EnvInterface, EnvInterfaceWrapper
+    from rlf.rl.envs import use_vec_monitor
+
+    class RewardScaleInterface(EnvInterface):
+        def final_trans_fn(self, env):
+            return gym.wrappers.TransformReward(env, lambda r: 2 * r)
+
+    args = SimpleNamespace(vec_monitor=None)
+    assert use_vec_monitor(args, EnvInterface(args))
+    # The `VecMonitor` would record the rewards of `final_trans_fn`.
+    assert not use_vec_monitor(args, RewardScaleInterface(args))
+    assert not use_vec_monitor(args, EnvInterfaceWrapper(args, RewardScaleInterface))
+    for vec_monitor in [False, True]:
+        args = SimpleNamespace(vec_monitor=vec_monitor)
+        assert use_vec_monitor(args, RewardScaleInterface(args)) == vec_monitor
@@ -37,3 +37,52 @@ def test_disc_train():
         f"--prefix 'ppo-test' --use-proper-time-limits --linear-lr-decay True --lr 3e-4 --entropy-coef 0 --num-env-steps {NUM_ENV_SAMPLES} --num-mini-batch 32 --num-epochs 10 --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes {NUM_PROCS} --cuda False"
     )
     run_policy(run_settings)
+
+
+def test_vec_monitor_train():
+    TEST_ENV = "Acrobot-v1"
+    run_settings = PPORunSettings(
+        f"--prefix 'ppo-test' --use-proper-time-limits --linear-lr-decay True --lr 3e-4 --entropy-coef 0 --num-env-steps {NUM_ENV_SAMPLES} --num-mini-batch 32 --num-epochs 10 --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes {NUM_PROCS} --vec-monitor True --cuda False"
+    )
+    run_policy(run_settings)
+
+
+def test_async_train():
+    TEST_ENV = "Acrobot-v1"
+    run_settings = PPORunSettings(
+        f"--prefix 'ppo-test' --use-proper-time-limits --linear-lr-decay True --lr 3e-4 --entropy-coef 0 --num-env-steps {NUM_ENV_SAMPLES} --num-mini-batch 32 --num-epochs 10 --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes 4 --async-batch-size 2 --cuda False"
+    )
+    run_policy(run_settings)
+
+
+@pytest.mark.parametrize("envs_per_worker", [1, 2])
+def test_double_buffer_train(envs_per_worker):
+    TEST_ENV = "Acrobot-v1"
+    run_settings = PPORunSettings(
+        f"--prefix 'ppo-test' --use-proper-time-limits --linear-lr-decay True --lr 3e-4 --entropy-coef 0 --num-env-steps {NUM_ENV_SAMPLES} --num-mini-batch 32 --num-epochs 10 --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes 4 --rollout-double-buffer True --envs-per-worker {envs_per_worker} --cuda False"
+    )
+    run_policy(run_settings)
+
+
+@pytest.mark.parametrize(
+    "split_args",
+    [
+        "--num-processes 6 --envs-per-worker 2 --rollout-double-buffer True",
+        "--num-processes 4 --envs-per-worker 2 --async-batch-size 3",
+    ],
+)
+def test_split_worker_envs(split_args):
+    TEST_ENV = "Acrobot-v1"
+    run_settings = PPORunSettings(
+        f"--prefix 'ppo-test' --num-env-steps {NUM_ENV_SAMPLES} --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --save-interval -1 {split_args} --cuda False"
+    )
+    with pytest.raises(ValueError, match="--envs-per-worker"):
+        run_policy(run_settings)
+
+
+def test_recurrent_chunk_train():
+    TEST_ENV = "Pendulum-v0"
+    run_settings = PPORunSettings(
+        f"--prefix 'ppo-test' --use-proper-time-limits --linear-lr-decay True --lr 3e-4 --entropy-coef 0 --num-env-steps {NUM_ENV_SAMPLES} --num-mini-batch 4 --num-epochs 2 --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes {NUM_PROCS} --recurrent-policy --bptt-chunk-len 25 --cuda False"
+    )
+    run_policy(run_settings)
@@ -0,0 +1,339 @@
+from types import SimpleNamespace
+
+import gym
+import numpy as np
+import pytest
+import torch
+from rlf.storage.rollout_storage import RolloutStorage
+
+NUM_STEPS = 64
+NUM_PROCS = 4
+
+
+def make_args(**kwargs):
+    args = dict(
+        gamma=0.99,
+        gae_lambda=0.95,
+        use_gae=True,
+        use_proper_time_limits=False,
+        returns_float64=False,
+        storage_ob_dtype="float32",
+        storage_mem_budget=0.0,
+        device="cpu",
+    )
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+def make_storage(use_gae, use_proper_time_limits, returns_float64=False, value_dim=1):
+    args = make_args(
+        use_gae=use_gae,
+        use_proper_time_limits=use_proper_time_limits,
+        returns_float64=returns_float64,
+    )
+    storage = RolloutStorage(
+        NUM_STEPS,
+        NUM_PROCS,
+        gym.spaces.Box(-1.0, 1.0, (3,)),
+        gym.spaces.Box(-1.0, 1.0, (2,)),
+        args,
+        value_dim=value_dim,
+    )
+    gen = torch.Generator().manual_seed(0)
+    storage.rewards.copy_(torch.randn(storage.rewards.shape, generator=gen))
+    storage.value_preds.copy_(torch.randn(storage.value_preds.shape, generator=gen))
+    storage.masks.copy_(
+        (torch.rand(storage.masks.shape, generator=gen) > 0.1).float()
+    )
+    storage.bad_masks.copy_(
+        (torch.rand(storage.bad_masks.shape, generator=gen) > 0.1).float()
+    )
+    return storage
+
+
+def reference_returns(storage, next_value):
+    """
+    The step by step computation of the returns.
+    """
+    args = storage.args
+    value_preds = storage.value_preds.clone()
+    returns = storage.returns.clone()
+    rewards = storage.rewards.repeat(1, 1, storage.value_dim)
+    masks, bad_masks = storage.masks.float(), storage.bad_masks.float()
+    gamma = args.gamma
+    if args.use_gae:
+        value_preds[-1] = next_value
+        gae = 0
+        for step in reversed(range(rewards.size(0))):
+            delta = (
+                rewards[step]
+                + gamma * value_preds[step + 1] * masks[step + 1]
+                - value_preds[step]
+            )
+            gae = delta + gamma * args.gae_lambda * masks[step + 1] * gae
+            if args.use_proper_time_limits:
+                gae = gae * bad_masks[step + 1]
+            returns[step] = gae + value_preds[step]
+    else:
+        returns[-1] = next_value
+        for step in reversed(range(rewards.size(0))):
+            if args.use_proper_time_limits:
+                returns[step] = (
+                    returns[step + 1] * gamma * masks[step + 1] + rewards[step]
+                ) * bad_masks[step + 1] + (1 - bad_masks[step + 1]) * value_preds[step]
+            else:
+                returns[step] = returns[step + 1] * gamma * masks[step + 1] + rewards[step]
+    return returns
+
+
+@pytest.mark.parametrize("use_gae", [False, True])
+@pytest.mark.parametrize("use_proper_time_limits", [False, True])
+@pytest.mark.parametrize("value_dim", [1, 2])
+def test_compute_returns_parity(use_gae, use_proper_time_limits, value_dim):
+    storage = make_storage(use_gae, use_proper_time_limits, value_dim=value_dim)
+    next_value = torch.randn(NUM_PROCS, value_dim)
+    expected = reference_returns(storage, next_value)
+    storage.compute_returns(next_value)
+    assert torch.equal(storage.returns, expected)
+
+
+@pytest.mark.parametrize("use_gae", [False, True])
+def test_compute_returns_float64(use_gae):
+    storage = make_storage(use_gae, True, returns_float64=True)
+    next_value = torch.randn(NUM_PROCS, 1)
+    expected = reference_returns(storage, next_value)
+    storage.compute_returns(next_value)
+    assert storage.returns.dtype == torch.float32
+    assert np.allclose(storage.returns.numpy(), expected.numpy(), atol=1e-5)
+
+
+def test_feed_forward_generator():
+    storage = make_storage(True, False)
+    storage.args.recurrent_policy = False
+    storage.args.policy_ob_key = "observation"
+    # Tag each transition by its flattened index.
+    idx = torch.arange(NUM_STEPS * NUM_PROCS, dtype=torch.float32).view(
+        NUM_STEPS, NUM_PROCS, 1
+    )
+    storage.obs[:-1] = idx
+    storage.rewards.copy_(idx)
+    storage.actions.copy_(idx.expand(-1, -1, 2))
+    advantages = idx.clone()
+
+    num_mini_batch = 4
+    seen = []
+    for sample in storage.get_generator(advantages, num_mini_batch):
+        assert sample["state"].shape == (NUM_STEPS * NUM_PROCS // num_mini_batch, 3)
+        for k in ["reward", "adv"]:
+            assert torch.equal(sample[k][:, 0], sample["state"][:, 0])
+        assert torch.equal(sample["action"][:, 0], sample["state"][:, 0])
+        assert sample["other_state"] == {} and sample["hxs"] == {}
+        seen.extend(sample["reward"].view(-1).tolist())
+    assert sorted(seen) == idx.view(-1).tolist()
+
+    samples = list(
+        storage.get_generator(advantages, num_mini_batch, keys=["state", "adv"])
+    )
+    assert all(sample.keys() == {"state", "adv"} for sample in samples)
+    # The minibatches are views of one packed buffer.
+    assert samples[0]["state"].storage().data_ptr() == samples[1]["adv"].storage().data_ptr()
+
+
+def test_recurrent_generator():
+    storage = make_storage(True, False)
+    storage.args.recurrent_policy = True
+    storage.args.policy_ob_key = "observation"
+    storage.args.bptt_chunk_len = 16
+    storage.hidden_states["rnn_hxs"] = torch.zeros(NUM_STEPS + 1, NUM_PROCS, 1)
+    step = torch.arange(NUM_STEPS, dtype=torch.float32).view(-1, 1, 1)
+    env = torch.arange(NUM_PROCS, dtype=torch.float32).view(1, -1, 1)
+    storage.obs[:-1] = step * NUM_PROCS + env
+    storage.hidden_states["rnn_hxs"][:-1] = step * NUM_PROCS + env
+    advantages = torch.zeros(NUM_STEPS, NUM_PROCS, 1)
+
+    num_mini_batch = 8
+    num_chunks = (NUM_STEPS // 16) * NUM_PROCS
+    chunks_per_batch = num_chunks // num_mini_batch
+    n_batches = 0
+    for sample in storage.get_generator(advantages, num_mini_batch):
+        n_batches += 1
+        ids = sample["state"][:, 0].view(16, chunks_per_batch)
+        # Each column is a chunk of consecutive steps of one environment.
+        assert torch.equal(ids[1:] - ids[:-1], torch.full_like(ids[1:], NUM_PROCS))
+        assert torch.equal(sample["hxs"]["rnn_hxs"][:, 0], ids[0])
+        assert (ids[0] // NUM_PROCS % 16 == 0).all()
+    assert n_batches == num_mini_batch
+
+
+def test_forward_gru_segments():
+    from rlf.rl.model import PassThroughBase
+
+    T, N, D, H = 12, 5, 3, 8
+    torch.manual_seed(0)
+    net = PassThroughBase((D,), True, H)
+    x = torch.randn(T, N, D)
+    masks = (torch.rand(T, N) > 0.3).float()
+    rnn_hxs = torch.randn(N, H)
+
+    out, hidden = net(x.view(T * N, D), {"rnn_hxs": rnn_hxs.clone()}, masks.view(-1, 1))
+
+    # One step at a time.
+    hxs = rnn_hxs
+    expected = []
+    for t in range(T):
+        step_out, hxs = net.gru(x[t : t + 1], (hxs * masks[t].view(-1, 1)).unsqueeze(0))
+        hxs = hxs.squeeze(0)
+        expected.append(step_out[0])
+    expected = torch.stack(expected).view(T * N, H)
+    assert torch.allclose(out, expected, atol=1e-5)
+    assert torch.allclose(hidden["rnn_hxs"], hxs, atol=1e-5)
+
+
+def test_compact_dtypes():
+    args = make_args(storage_ob_dtype="float16")
+    ob_space = gym.spaces.Dict(
+        {
+            "observation": gym.spaces.Box(-1.0, 1.0, (3,)),
+            "image": gym.spaces.Box(0, 255, (1, 4, 4), dtype=np.uint8),
+        }
+    )
+    storage = RolloutStorage(
+        NUM_STEPS, NUM_PROCS, ob_space, gym.spaces.Discrete(5), args
+    )
+    assert storage.obs["observation"].dtype == torch.float16
+    assert storage.obs["image"].dtype == torch.uint8
+    assert storage.actions.dtype == torch.int8
+    assert storage.masks.dtype == torch.bool
+
+    env_ids = np.array([1, 3])
+    ac_info = SimpleNamespace(
+        action=torch.tensor([[4], [2]]),
+        action_log_probs=torch.zeros(2, 1),
+        value=torch.zeros(2, 1),
+        hxs={},
+    )
+    next_obs = {
+        "observation": torch.full((2, 3), 0.5),
+        "image": torch.full((2, 1, 4, 4), 7, dtype=torch.uint8),
+    }
+    storage.insert(
+        None, next_obs, torch.ones(2, 1), [False, True], [{}, {}], ac_info, env_ids
+    )
+    assert torch.equal(storage.get_env_masks(env_ids), torch.tensor([[1.0], [0.0]]))
+    obs = storage.get_env_obs(env_ids)
+    assert obs["observation"].dtype == torch.float32
+    assert obs["image"].dtype == torch.uint8
+    assert storage.get_actions().dtype == torch.long
+    assert storage.get_actions().view(NUM_STEPS, NUM_PROCS)[0, 3] == 2
+
+
+def test_memory_plan():
+    from rlf.storage.memory_planner import MemoryPlan
+
+    plan = MemoryPlan("Test")
+    plan.add("obs", (1000, 256), torch.float16)
+    plan.add("masks", (1000, 1), np.bool_)
+    assert plan.total_bytes == 1000 * 256 * 2 + 1000
+    assert "obs" in str(plan) and "float16" in str(plan)
+    plan.check(1.0)
+    with pytest.raises(MemoryError):
+        plan.check(1e-4)
+
+    args = make_args(storage_mem_budget=1e-4)
+    with pytest.raises(MemoryError):
+        RolloutStorage(
+            10000,
+            NUM_PROCS,
+            gym.spaces.Box(-1.0, 1.0, (3,)),
+            gym.spaces.Box(-1.0, 1.0, (2,)),
+            args,
+        )
+
+
+def test_memory_plan_logged_once(monkeypatch):
+    from rlf.baselines import logger
+    from rlf.storage.memory_planner import MemoryPlan
+
+    logged = []
+    monkeypatch.setattr(logger, "log", lambda *args, **kwargs: logged.append(args))
+    for _ in range(2):
+        plan = MemoryPlan("TestLogged")
+        plan.add("obs", (10, 3), torch.float32)
+        plan.check(1.0)
+    assert logged == []
+    for _ in range(2):
+        plan.check(1.0, verbose=True)
+    assert logged == [(str(plan),)]
+
+    # The rollout storage reports its plan before allocating.
+    logged.clear()
+    storage = RolloutStorage(
+        7,
+        NUM_PROCS,
+        gym.spaces.Box(-1.0, 1.0, (7,)),
+        gym.spaces.Box(-1.0, 1.0, (7,)),
+        make_args(),
+    )
+    assert logged == [(str(storage.mem_plan),)]
+
+
+def test_traj_tracking():
+    num_steps = 8
+    storage = RolloutStorage(
+        num_steps,
+        NUM_PROCS,
+        gym.spaces.Box(-1.0, 1.0, (1,)),
+        gym.spaces.Box(-1.0, 1.0, (1,)),
+        make_args(),
+    )
+    storage.init_storage(torch.zeros(NUM_PROCS, 1))
+    done_trajs = []
+    # Not tracked until a callback is set.
+    assert not storage._tracks_trajs()
+    storage.set_traj_done_callback(done_trajs.extend)
+
+    # Environment `i` ends an episode every `i + 2` of its steps, only half
+    # of the environments are stepped at a time. The episodes of 3 and 5
+    # steps cross the rollouts.
+    env_steps = np.zeros(NUM_PROCS, dtype=np.int64)
+    for update in range(3):
+        for step in range(2 * num_steps):
+            env_ids = np.arange(step % 2, NUM_PROCS, 2)
+            env_steps[env_ids] += 1
+            n = len(env_ids)
+            done = env_steps[env_ids] % (env_ids + 2) == 0
+            # The trajectories have the executed actions, not the policy ones.
+            ac_info = SimpleNamespace(
+                action=torch.full((n, 1), -1.0),
+                take_action=torch.as_tensor(env_ids, dtype=torch.float32).view(-1, 1),
+                action_log_probs=torch.zeros(n, 1),
+                value=torch.zeros(n, 1),
+                hxs={},
+            )
+            next_obs = torch.as_tensor(env_steps[env_ids], dtype=torch.float32)
+            storage.insert(
+                None,
+                next_obs.view(-1, 1),
+                torch.ones(n, 1),
+                done,
+                [
+                    {"final_obs": np.array([-env_id], np.float32)} if d else {}
+                    for env_id, d in zip(env_ids, done)
+                ],
+                ac_info,
+                env_ids=env_ids,
+            )
+        storage.after_update()
+
+    assert len(done_trajs) == sum(3 * num_steps // (i + 2) for i in range(NUM_PROCS))
+    for traj in done_trajs:
+        env_id = int(traj[0][1].item())
+        assert len(traj) == env_id + 2
+        assert all(trans[1].item() == env_id for trans in traj)
+        assert [trans[2] for trans in traj] == [1.0] * (env_id + 1) + [0.0]
+        assert [list(trans[3].keys()) for trans in traj[:-1]] == [[]] * (env_id + 1)
+        assert traj[-1][3]["final_obs"].item() == -env_id
+        # The observation before each step is the number of steps taken.
+        steps = [int(trans[0].item()) for trans in traj]
+        assert steps == list(range(steps[0], steps[0] + env_id + 2))
+        assert steps[0] % (env_id + 2) == 0
@@ -28,3 +28,15 @@ def test_sac_cont_train():
         f"--prefix 'sac-test' --use-proper-time-limits --linear-lr-decay True --lr 3e-4 --num-env-steps {NUM_ENV_SAMPLES} --num-steps {NUM_STEPS} --env-name {TEST_ENV} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes 1 --cuda False --n-rnd-steps 10"
     )
     run_policy(run_settings)
+
+
+@pytest.mark.parametrize("env_name", ["Pendulum-v0", "RltPointMassEnvSpawnRange-v0"])
+def test_sac_multi_proc_train(env_name):
+    # The pointmass env is a `TorchVecEnv` so the storage gets the dones,
+    # rewards and observations as tensors.
+    import rlf.envs.pointmass
+
+    run_settings = SacRunSettings(
+        f"--prefix 'sac-test' --use-proper-time-limits --lr 3e-4 --num-env-steps {NUM_ENV_SAMPLES} --num-steps {NUM_STEPS} --env-name {env_name} --eval-interval -1 --log-smooth-len 10 --save-interval -1 --num-processes 2 --cuda False --n-rnd-steps 10 --batch-size 32 --normalize-env False"
+    )
+    run_policy(run_settings)
@@ -0,0 +1,296 @@
+import json
+import os
+from types import SimpleNamespace
+
+import gym
+import numpy as np
+import torch
+from rlf.storage.sum_tree import SumTree
+from rlf.storage.transition_storage import TransitionStorage
+
+CAPACITY = 100
+NUM_PROCS = 2
+
+
+def make_args(**kwargs):
+    args = dict(
+        device="cpu",
+        policy_ob_key="observation",
+        storage_ob_dtype="float32",
+        storage_mem_budget=0.0,
+        prioritized_replay=False,
+        per_alpha=0.6,
+        per_beta=0.4,
+        per_eps=1e-6,
+        replay_backend="ram",
+        replay_dir="",
+        replay_sample_chunk=1,
+        replay_dedup_obs=False,
+        replay_prefetch=0,
+        replay_packed=False,
+        save_replay=True,
+    )
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+def make_storage(**kwargs):
+    storage = TransitionStorage(
+        gym.spaces.Box(-1.0, 1.0, (3,)), (2,), CAPACITY, make_args(**kwargs)
+    )
+    storage.init_storage(torch.zeros(NUM_PROCS, 3))
+    return storage
+
+
+def fill(storage, num_steps, start=0, done_every=0):
+    """
+    Inserts `num_steps` steps of `NUM_PROCS` environments. The observation
+    of environment `i` at step `t` is `(start + t) * NUM_PROCS + i`. With
+    `done_every` environment 0 ends its episodes every `done_every` steps
+    with the terminal observation `-1`.
+    """
+    for t in range(start, start + num_steps):
+        obs = (t * NUM_PROCS + torch.arange(NUM_PROCS, dtype=torch.float32)).view(-1, 1)
+        next_obs = (obs + NUM_PROCS).repeat(1, 3)
+        done = np.zeros(NUM_PROCS, dtype=bool)
+        if done_every > 0 and (t + 1) % done_every == 0:
+            done[0] = True
+            next_obs[0] = -1.0
+        ac_info = SimpleNamespace(take_action=obs.repeat(1, 2), hxs={})
+        storage.insert(
+            obs.repeat(1, 3),
+            next_obs,
+            obs.clone(),
+            done,
+            [{} for _ in range(NUM_PROCS)],
+            ac_info,
+        )
+
+
+def test_sum_tree():
+    tree = SumTree(10)
+    priorities = np.arange(10, dtype=np.float64) + 1
+    tree.update(np.arange(10), priorities)
+    assert tree.total == priorities.sum()
+    assert tree.min == 1.0
+    prefix = np.cumsum(priorities)
+    values = np.array([0.0, 0.5, 1.0, 2.9, 3.0, prefix[-1] - 1e-6])
+    expected = np.searchsorted(prefix, values, "right")
+    assert tree.find(values).tolist() == expected.tolist()
+
+    # Repeated indices keep the last priority.
+    tree.update(np.array([3, 3]), np.array([100.0, 0.5]))
+    assert tree.get([3])[0] == 0.5
+    assert tree.total == priorities.sum() - 4.0 + 0.5
+    assert tree.min == 0.5
+
+
+def test_prioritized_sampling():
+    storage = make_storage(prioritized_replay=True, per_alpha=1.0, per_eps=0.0)
+    fill(storage, 10)
+    n = len(storage)
+    # Only transition 5 has a non zero priority.
+    storage.update_priorities(np.arange(n), np.zeros(n))
+    storage.update_priorities(np.array([5]), np.array([2.0]))
+    state, _, _, reward, add_info, _ = storage.sample_tensors(16)
+    assert (reward.view(-1) == 5).all()
+    assert add_info["sample_idxs"].tolist() == [5] * 16
+
+    # The weights undo the sampling bias relative to the rarest transition.
+    storage.update_priorities(np.arange(n), np.ones(n))
+    storage.update_priorities(np.array([0]), np.array([4.0]))
+    _, _, _, reward, add_info, _ = storage.sample_tensors(64)
+    weights = add_info["sample_weights"].view(-1)
+    expected = np.where(add_info["sample_idxs"] == 0, 4.0 ** -0.4, 1.0)
+    assert np.allclose(weights.numpy(), expected)
+    assert np.array_equal(reward.view(-1).numpy(), add_info["sample_idxs"])
+
+
+def test_uniform_sampling():
+    storage = make_storage()
+    fill(storage, 60)
+    assert len(storage) == CAPACITY
+    state, n_state, action, reward, add_info, n_add_info = storage.sample_tensors(32)
+    assert "sample_idxs" not in add_info
+    assert torch.equal(n_state[:, 0], state[:, 0] + NUM_PROCS)
+    assert torch.equal(action[:, 0], reward.view(-1))
+    # Only the transitions of the last `CAPACITY / NUM_PROCS` steps are kept.
+    assert (reward >= (60 * NUM_PROCS - CAPACITY)).all()
+
+
+def test_memmap_backend(tmpdir):
+    replay_dir = str(tmpdir.join("replay"))
+    storage = make_storage(replay_backend="memmap", replay_dir=replay_dir)
+    assert isinstance(storage.actions, np.memmap)
+    fill(storage, 10)
+    copied = storage.copy_storage()
+    assert not isinstance(copied.actions, np.memmap)
+    fill(copied, 5, start=10)
+    assert len(storage) == 20 and len(copied) == 30
+
+    # The buffer is reopened with its transitions.
+    reopened = make_storage(replay_backend="memmap", replay_dir=replay_dir)
+    assert len(reopened) == 20 and not reopened.full
+    for x, y in [(storage.obses, reopened.obses), (storage.rewards, reopened.rewards)]:
+        assert np.array_equal(x[:20], y[:20])
+    state, _, _, reward, _, _ = reopened.sample_tensors(8)
+    assert torch.equal(state[:, 0], reward.view(-1))
+    assert (reward < 20).all()
+
+    storage.args.replay_sample_chunk = 4
+    _, _, _, reward, _, _ = storage.sample_tensors(8)
+    runs = reward.view(2, 4)
+    assert ((runs[:, 1:] - runs[:, :-1]) % 20 == 1).all()
+
+
+def test_incremental_save(tmpdir):
+    save_dir = str(tmpdir.join("storage"))
+    storage = make_storage()
+    fill(storage, 20)
+    storage.save_storage(save_dir)
+    fill(storage, 10, start=20)
+    storage.save_storage(save_dir)
+    storage.wait_save()
+    with open(os.path.join(save_dir, "index.json")) as f:
+        chunks = json.load(f)["chunks"]
+    # The second chunk only has the new transitions.
+    assert [c["count"] for c in chunks] == [40, 20]
+
+    loaded = make_storage()
+    loaded.load_storage(save_dir)
+    assert (loaded.idx, loaded.full, loaded.n_inserted) == (60, False, 60)
+    for name, x in storage._named_fields().items():
+        assert np.array_equal(loaded._named_fields()[name][:60], x[:60])
+
+    # Wrapping around the buffer, the first chunk is fully overwritten.
+    fill(storage, 40, start=30)
+    storage.save_storage(save_dir)
+    storage.close()
+    with open(os.path.join(save_dir, "index.json")) as f:
+        chunks = json.load(f)["chunks"]
+    assert [c["end"] for c in chunks] == [60, 140]
+    assert not os.path.exists(os.path.join(save_dir, "chunk_40.npz"))
+    loaded.load_storage(save_dir)
+    assert (loaded.idx, loaded.full) == (storage.idx, storage.full)
+    for name, x in storage._named_fields().items():
+        assert np.array_equal(loaded._named_fields()[name], x)
+
+    # Only the chunks up to a checkpoint are loaded.
+    loaded = make_storage()
+    loaded.load_storage(save_dir, max_inserted=60)
+    assert loaded.n_inserted == 60
+
+
+def test_dedup_obs(tmpdir):
+    storage = make_storage()
+    dedup = make_storage(replay_dedup_obs=True, prioritized_replay=True)
+    assert dedup.next_obses is None
+    for start, num_steps in [(0, 13), (13, 13), (26, 39)]:
+        fill(storage, num_steps, start=start, done_every=5)
+        fill(dedup, num_steps, start=start, done_every=5)
+        # The look-ahead next observations take `NUM_PROCS` rows.
+        assert len(dedup) == min(storage.n_inserted, CAPACITY - NUM_PROCS)
+        idxs = dedup._rows(np.arange(len(dedup)))
+        for x, y in [(storage.obses, dedup.obses), (storage.rewards, dedup.rewards)]:
+            assert np.array_equal(x[idxs], y[idxs])
+        assert np.array_equal(storage.next_obses[idxs], dedup._get_next_obs(idxs))
+    # Only the terminal observations of the transitions still in the buffer.
+    assert (dedup._final_slot >= 0).sum() == len(
+        [r for r in idxs if storage.next_obses[r][0] == -1]
+    )
+
+    # The rows without a valid transition are never sampled.
+    _, n_state, _, reward, add_info, _ = dedup.sample_tensors(256)
+    assert (reward >= 65 * NUM_PROCS - (CAPACITY - NUM_PROCS)).all()
+    assert np.array_equal(
+        n_state.numpy(), storage.next_obses[add_info["sample_idxs"]]
+    )
+
+    save_dir = str(tmpdir.join("storage"))
+    dedup.save_storage(save_dir)
+    dedup.wait_save()
+    loaded = make_storage(replay_dedup_obs=True)
+    loaded.load_storage(save_dir)
+    assert len(loaded) == len(dedup)
+    assert np.array_equal(loaded._get_next_obs(idxs), dedup._get_next_obs(idxs))
+
+
+
+def test_dedup_final_slots():
+    storage = make_storage()
+    dedup = make_storage(replay_dedup_obs=True)
+    # Every transition of environment 0 is terminal, the slots of the
+    # overwritten transitions are reused.
+    fill(storage, 200, done_every=1)
+    fill(dedup, 200, done_every=1)
+    idxs = dedup._rows(np.arange(len(dedup)))
+    assert np.array_equal(storage.next_obses[idxs], dedup._get_next_obs(idxs))
+    assert len(dedup._final_obs[None]) == 64
+
+    # The terminal next observations equal to the observation that follows
+    # are dropped by the next insert.
+    obs = torch.full((NUM_PROCS, 3), 1000.0)
+    ac_info = SimpleNamespace(take_action=torch.zeros(NUM_PROCS, 2), hxs={})
+    rows = []
+    for _ in range(2):
+        rows.append(dedup._rows(len(dedup) + np.arange(NUM_PROCS)))
+        dedup.insert(
+            obs,
+            obs,
+            torch.zeros(NUM_PROCS, 1),
+            np.ones(NUM_PROCS, dtype=bool),
+            [{} for _ in range(NUM_PROCS)],
+            ac_info,
+        )
+    assert (dedup._final_slot[rows[0]] == -1).all()
+    assert (dedup._final_slot[rows[1]] >= 0).all()
+
+def test_prefetch():
+    storage = make_storage(replay_prefetch=3, prioritized_replay=True)
+    fill(storage, 10)
+    for i in range(10):
+        state, n_state, action, reward, add_info, _ = storage.sample_tensors(8)
+        assert state.shape == (8, 3)
+        assert torch.equal(n_state[:, 0], state[:, 0] + NUM_PROCS)
+        assert torch.equal(action[:, 0], reward.view(-1))
+        assert np.array_equal(reward.view(-1).numpy(), add_info["sample_idxs"])
+        storage.update_priorities(add_info["sample_idxs"], np.ones(8))
+        # The batches sampled after an insert can have the new transitions.
+        fill(storage, 1, start=10 + i)
+        assert (reward < 2 * (10 + i)).all()
+    assert len(storage._prefetcher._slots) == 4
+
+    # Another batch size restarts the sampler.
+    state = storage.sample_tensors(4)[0]
+    assert state.shape == (4, 3)
+    storage.close()
+    assert storage._prefetcher is None
+
+
+def test_packed_layout():
+    storage = make_storage()
+    packed = make_storage(replay_packed=True)
+    assert packed._packed.shape == (CAPACITY, 3 + 3 + 2 + 1 + 1 + 1)
+    assert np.shares_memory(packed.actions, packed._packed)
+    fill(storage, 60, done_every=7)
+    fill(packed, 60, done_every=7)
+    for name, x in storage._named_fields().items():
+        assert np.array_equal(packed._named_fields()[name], x)
+
+    np.random.seed(0)
+    expected = storage.sample_tensors(16)
+    np.random.seed(0)
+    batch = packed.sample_tensors(16)
+    for x, y in zip(expected[:4], batch[:4]):
+        assert torch.equal(x, y)
+    assert torch.equal(expected[5]["mask"], batch[5]["mask"])
+    # The fields of the batch are views of the same gathered rows.
+    state, _, action, reward = batch[:4]
+    assert state._base is not None and state._base is action._base
+    assert reward._base is action._base
+
+    # The copy has its own packed array.
+    copied = packed.copy_storage()
+    fill(copied, 1, start=60)
+    assert np.shares_memory(copied.rewards, copied._packed)
+    assert not np.array_equal(copied.rewards, packed.rewards)
@@ -0,0 +1,609 @@
+from functools import partial
+
+import gym
+import numpy as np
+import pytest
+import torch
+from rlf.baselines.monitor import Monitor
+from rlf.baselines.vec_env import DummyVecEnv, InfoBatch, ShmemVecEnv, ThreadVecEnv
+from rlf.baselines.vec_env.spare_reset_env import SpareResetEnv
+from rlf.rl.envs import TimeLimitMask, VecPyTorch
+from rlf.rl.utils import agg_ep_log_stats
+from rlf.storage.base_storage import BaseStorage
+
+TEST_ENV = "Pendulum-v0"
+NUM_ENVS = 3
+NUM_STEPS = 250
+
+
+def make_env(rank, seed=31):
+    env = gym.make(TEST_ENV)
+    env.seed(seed + rank)
+    return env
+
+
+def make_env_fn(rank, seed=31):
+    # A partial of a module level function so the workers started by
+    # "spawn" or "forkserver" can unpickle it.
+    return partial(make_env, rank, seed)
+
+
+def run_against_dummy(create_envs, double_buffer, num_envs=NUM_ENVS, spare_reset=False):
+    """
+    Steps `create_envs` and a `DummyVecEnv` with the same actions and checks the
+    outputs match.
+    """
+    env_fns = [make_env_fn(i) for i in range(num_envs)]
+    envs = create_envs(env_fns)
+    dummy_envs = DummyVecEnv(env_fns, spare_reset=spare_reset)
+
+    obs = envs.reset()
+    assert np.allclose(obs, dummy_envs.reset())
+    rng = np.random.RandomState(0)
+    for _ in range(NUM_STEPS):
+        prev_obs = obs
+        prev_obs_cp = np.copy(obs)
+        actions = rng.uniform(-1.0, 1.0, (num_envs, 1)).astype(np.float32)
+        obs, reward, done, infos = envs.step(actions)
+        d_obs, d_reward, d_done, d_infos = dummy_envs.step(actions)
+        assert np.allclose(obs, d_obs)
+        assert np.allclose(reward, d_reward)
+        assert (np.array(done) == d_done).all()
+        for i in range(num_envs):
+            if d_done[i]:
+                assert np.allclose(infos[i]["final_obs"], d_infos[i]["final_obs"])
+        if double_buffer:
+            # The previous observations must not be overwritten.
+            assert np.allclose(prev_obs, prev_obs_cp)
+    envs.close()
+    dummy_envs.close()
+
+
+@pytest.mark.parametrize("protocol", ["pipe", "shmem"])
+@pytest.mark.parametrize("double_buffer", [False, True])
+def test_shmem_matches_dummy(double_buffer, protocol):
+    run_against_dummy(
+        lambda env_fns: ShmemVecEnv(
+            env_fns, context="fork", double_buffer=double_buffer, protocol=protocol
+        ),
+        double_buffer,
+    )
+
+
+@pytest.mark.parametrize("num_threads", [1, 2, 4])
+@pytest.mark.parametrize("double_buffer", [False, True])
+def test_thread_matches_dummy(double_buffer, num_threads):
+    run_against_dummy(
+        lambda env_fns: ThreadVecEnv(
+            env_fns, num_threads=num_threads, double_buffer=double_buffer
+        ),
+        double_buffer,
+    )
+
+
+@pytest.mark.parametrize("double_buffer", [False, True])
+def test_vec_pytorch_obs_not_aliased(double_buffer):
+    # The runner inserts the observations of a step after the next one.
+    envs = VecPyTorch(
+        DummyVecEnv(
+            [make_env_fn(i) for i in range(NUM_ENVS)], double_buffer=double_buffer
+        ),
+        "cpu",
+    )
+    obs = envs.reset()
+    actions = torch.ones(NUM_ENVS, 1)
+    next_obs = envs.step(actions)[0]
+    assert not torch.equal(obs, next_obs)
+    next_next_obs = envs.step(actions)[0]
+    assert not torch.equal(next_obs, next_next_obs)
+    envs.close()
+
+
+def test_thread_async():
+    env_fns = [make_env_fn(i) for i in range(NUM_ENVS)]
+    envs = ThreadVecEnv(env_fns, num_threads=2)
+    dummy_envs = DummyVecEnv(env_fns)
+    envs.async_reset()
+    dummy_envs.async_reset()
+    rng = np.random.RandomState(0)
+    for _ in range(NUM_STEPS):
+        obs, reward, done, _, env_ids = envs.recv()
+        d_obs, d_reward, d_done, _, d_env_ids = dummy_envs.recv()
+        assert (env_ids == d_env_ids).all()
+        assert np.allclose(obs, d_obs)
+        assert np.allclose(reward, d_reward)
+        # Step the two halves separately.
+        actions = rng.uniform(-1.0, 1.0, (NUM_ENVS, 1)).astype(np.float32)
+        for ids in [[0], [1, 2]]:
+            envs.send(actions[ids], ids)
+            dummy_envs.send(actions[ids], ids)
+    envs.close()
+    dummy_envs.close()
+
+
+def test_shmem_zero_copy():
+    envs = ShmemVecEnv(
+        [make_env_fn(i) for i in range(NUM_ENVS)], context="fork", double_buffer=True
+    )
+    obs = envs.reset()
+    obs_tensor = torch.from_numpy(obs)
+    obs_copy = obs_tensor.clone()
+    next_obs, _, _, _ = envs.step(np.zeros((NUM_ENVS, 1), dtype=np.float32))
+    # The first buffer is not written by the next step.
+    assert torch.allclose(obs_tensor, obs_copy)
+    next_obs_tensor = torch.from_numpy(next_obs)
+    envs.step(np.zeros((NUM_ENVS, 1), dtype=np.float32))
+    # But it is written by the step after that.
+    assert not torch.allclose(obs_tensor, obs_copy)
+    assert obs_tensor.data_ptr() != next_obs_tensor.data_ptr()
+    envs.close()
+
+
+@pytest.mark.parametrize("protocol", ["pipe", "shmem"])
+@pytest.mark.parametrize("envs_per_worker", [2, 3])
+def test_shmem_envs_per_worker(envs_per_worker, protocol):
+    # 5 envs so the last worker hosts a smaller slice.
+    run_against_dummy(
+        lambda env_fns: ShmemVecEnv(
+            env_fns,
+            context="fork",
+            double_buffer=True,
+            envs_per_worker=envs_per_worker,
+            protocol=protocol,
+        ),
+        True,
+        num_envs=5,
+    )
+    envs = ShmemVecEnv(
+        [make_env_fn(i) for i in range(5)], context="fork", envs_per_worker=envs_per_worker
+    )
+    assert len(envs.procs) == (5 + envs_per_worker - 1) // envs_per_worker
+    envs.close()
+
+
+@pytest.mark.parametrize("protocol", ["pipe", "shmem"])
+@pytest.mark.parametrize("envs_per_worker", [1, 2])
+def test_shmem_async(envs_per_worker, protocol):
+    num_envs = 4
+    batch_size = 2
+    envs = ShmemVecEnv(
+        [make_env_fn(i) for i in range(num_envs)],
+        context="fork",
+        envs_per_worker=envs_per_worker,
+        batch_size=batch_size,
+        protocol=protocol,
+    )
+    # Each environment is checked against its own copy stepped sequentially.
+    ref_envs = [make_env_fn(i)() for i in range(num_envs)]
+    envs.async_reset()
+    ref_obs = [env.reset() for env in ref_envs]
+    rng = np.random.RandomState(0)
+    num_env_steps = np.zeros(num_envs, dtype=int)
+    for _ in range(NUM_STEPS):
+        obs, reward, done, infos, env_ids = envs.recv()
+        assert len(env_ids) == batch_size
+        for i, env_id in enumerate(env_ids):
+            assert np.allclose(obs[i], ref_obs[env_id])
+        actions = rng.uniform(-1.0, 1.0, (batch_size, 1)).astype(np.float32)
+        envs.send(actions, env_ids)
+        for action, env_id in zip(actions, env_ids):
+            ref_obs[env_id], ref_reward, ref_done, _ = ref_envs[env_id].step(action)
+            if ref_done:
+                ref_obs[env_id] = ref_envs[env_id].reset()
+        num_env_steps[env_ids] += 1
+    # Only the environments returned by recv are stepped.
+    assert num_env_steps.sum() == NUM_STEPS * batch_size
+    envs.close()
+
+
+def test_shmem_protocol_discrete():
+    def make_cartpole(rank):
+        def _thunk():
+            env = gym.make("CartPole-v1")
+            env.seed(rank)
+            return env
+
+        return _thunk
+
+    env_fns = [make_cartpole(i) for i in range(NUM_ENVS)]
+    envs = ShmemVecEnv(env_fns, context="fork", protocol="shmem")
+    dummy_envs = DummyVecEnv(env_fns)
+    assert np.allclose(envs.reset(), dummy_envs.reset())
+    rng = np.random.RandomState(0)
+    for _ in range(NUM_STEPS):
+        actions = rng.randint(0, 2, NUM_ENVS)
+        obs, reward, done, infos = envs.step(actions)
+        d_obs, d_reward, d_done, d_infos = dummy_envs.step(actions)
+        assert np.allclose(obs, d_obs)
+        assert np.allclose(reward, d_reward)
+        assert (done == d_done).all()
+        assert [info.keys() for info in infos] == [info.keys() for info in d_infos]
+    envs.close()
+    dummy_envs.close()
+
+
+@pytest.mark.parametrize("protocol", ["pipe", "shmem"])
+def test_shmem_info_batch(protocol):
+    def make_monitor_env(rank):
+        def _thunk():
+            env = TimeLimitMask(gym.make(TEST_ENV))
+            env.seed(31 + rank)
+            env = Monitor(env, None)
+            return env
+
+        return _thunk
+
+    env_fns = [make_monitor_env(i) for i in range(NUM_ENVS)]
+    envs = ShmemVecEnv(env_fns, context="fork", protocol=protocol)
+    dummy_envs = DummyVecEnv(env_fns)
+    envs.reset()
+    dummy_envs.reset()
+    storage = BaseStorage()
+    n_episodes = 0
+    for _ in range(NUM_STEPS):
+        actions = np.zeros((NUM_ENVS, 1), dtype=np.float32)
+        _, _, done, infos = envs.step(actions)
+        _, _, _, d_infos = dummy_envs.step(actions)
+        assert isinstance(infos, InfoBatch)
+
+        # The statistics and masks from the arrays match the ones from the
+        # info dicts.
+        stats = agg_ep_log_stats(infos, {})
+        d_stats = agg_ep_log_stats(d_infos, {})
+        assert stats.keys() == d_stats.keys()
+        for k in ["r", "l"]:
+            assert np.allclose(stats[k], d_stats[k])
+        n_episodes += len(stats["r"])
+        for x, y in zip(storage.compute_masks(done, infos), storage.compute_masks(done, d_infos)):
+            assert torch.equal(x, y)
+
+        for info, d_info in zip(infos, d_infos):
+            assert info.keys() == d_info.keys()
+            if "final_obs" in info:
+                assert np.allclose(info["final_obs"], d_info["final_obs"])
+    assert n_episodes > 0
+    envs.close()
+    dummy_envs.close()
+
+
+class LargeInfoEnv(gym.Wrapper):
+    """
+    Adds an undeclared info of several MB to each step.
+    """
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        info["frame"] = np.zeros((1024, 1024, 4), np.uint8)
+        return obs, reward, done, info
+
+
+def make_large_info_env(rank):
+    return LargeInfoEnv(make_env(rank))
+
+
+@pytest.mark.parametrize("protocol", ["pipe", "shmem"])
+def test_shmem_large_infos(protocol):
+    envs = ShmemVecEnv(
+        [partial(make_large_info_env, i) for i in range(NUM_ENVS)],
+        context="fork",
+        protocol=protocol,
+    )
+    envs.reset()
+    for _ in range(3):
+        _, _, _, infos = envs.step(np.zeros((NUM_ENVS, 1), dtype=np.float32))
+        assert all(info["frame"].shape == (1024, 1024, 4) for info in infos)
+    envs.close()
+
+
+@pytest.mark.parametrize("protocol", ["pipe", "shmem"])
+def test_shmem_spare_reset(protocol):
+    run_against_dummy(
+        lambda env_fns: ShmemVecEnv(
+            env_fns, context="fork", protocol=protocol, spare_reset=True
+        ),
+        False,
+        spare_reset=True,
+    )
+
+
+
+def test_cmd_channel_wait_any():
+    import multiprocessing as mp
+
+    from rlf.baselines.vec_env.shmem_vec_env import _CmdChannel
+
+    channel = _CmdChannel(
+        mp.get_context("fork"), 4, 4, gym.spaces.Box(-1.0, 1.0, (1,))
+    )
+    for i in [3, 1, 2]:
+        channel.send_result(i)
+    # The workers that are not waited for are returned by a later wait.
+    assert channel.wait_any([1, 2]) == 1
+    assert channel.wait_any([0, 3]) == 3
+    assert channel.wait_any([2]) == 2
+    for _ in range(3):
+        for i in range(4):
+            channel.send_result(i)
+        assert sorted(channel.wait_any([0, 1, 2, 3]) for _ in range(4)) == [0, 1, 2, 3]
+
+@pytest.mark.parametrize("use_shmem", [False, True])
+def test_spare_reset_mem_logged(use_shmem, monkeypatch):
+    from rlf.baselines import logger
+
+    logged = []
+    monkeypatch.setattr(logger, "log", lambda *args, **kwargs: logged.append(args))
+    env_fns = [make_env_fn(i) for i in range(NUM_ENVS)]
+    if use_shmem:
+        envs = ShmemVecEnv(env_fns, context="fork", spare_reset=True)
+    else:
+        envs = DummyVecEnv(env_fns, spare_reset=True)
+    # One report for all the environments.
+    assert len([x for x in logged if "Spare reset environments" in x[0]]) == 1
+    envs.close()
+
+
+def test_spare_reset_env():
+    env = SpareResetEnv(make_env_fn(0))
+    first_env = env.env
+    start_obs = [env.reset()]
+    for _ in range(2):
+        done = False
+        while not done:
+            _, _, done, _ = env.step(np.zeros(1, dtype=np.float32))
+        start_obs.append(env.reset())
+    # The episodes alternate between the two differently seeded instances.
+    assert env.env is first_env
+    assert not np.allclose(start_obs[0], start_obs[1])
+    ref_env = make_env_fn(0)()
+    assert np.allclose(start_obs[0], ref_env.reset())
+    assert np.allclose(start_obs[2], ref_env.reset())
+    env.close()
+
+
+def make_early_reset_env(allow_early_resets):
+    return Monitor(make_env(0), None, allow_early_resets=allow_early_resets)
+
+
+def test_spare_reset_env_early_reset():
+    env = SpareResetEnv(partial(make_early_reset_env, True))
+    first_env = env.env
+    env.reset()
+    env.step(np.zeros(1, dtype=np.float32))
+    # A reset in the middle of an episode does not swap the instances.
+    env.reset()
+    assert env.env is first_env
+    env.close()
+
+    # The error of the early reset is raised by that reset.
+    env = SpareResetEnv(partial(make_early_reset_env, False))
+    env.reset()
+    env.step(np.zeros(1, dtype=np.float32))
+    with pytest.raises(RuntimeError, match="before done"):
+        env.reset()
+    env.close()
+
+
+def test_shmem_share_workers():
+    train_fns = [make_env_fn(i) for i in range(NUM_ENVS)]
+    eval_fns = [make_env_fn(i, seed=100) for i in range(NUM_ENVS)]
+    train_envs = ShmemVecEnv(train_fns, context="fork")
+    eval_envs = train_envs.share_workers(eval_fns)
+    assert eval_envs.procs is train_envs.procs
+    dummy_train_envs = DummyVecEnv(train_fns)
+    dummy_eval_envs = DummyVecEnv(eval_fns)
+
+    assert np.allclose(train_envs.reset(), dummy_train_envs.reset())
+    assert np.allclose(eval_envs.reset(), dummy_eval_envs.reset())
+    rng = np.random.RandomState(0)
+    for step in range(NUM_STEPS):
+        # Alternate between the two vectorized envs, the environments of
+        # each one keep their state.
+        if step % 3 == 0:
+            envs, dummy_envs = eval_envs, dummy_eval_envs
+        else:
+            envs, dummy_envs = train_envs, dummy_train_envs
+        actions = rng.uniform(-1.0, 1.0, (NUM_ENVS, 1)).astype(np.float32)
+        obs, reward, _, _ = envs.step(actions)
+        d_obs, d_reward, _, _ = dummy_envs.step(actions)
+        assert np.allclose(obs, d_obs)
+        assert np.allclose(reward, d_reward)
+
+    eval_envs.close()
+    assert all(proc.is_alive() for proc in train_envs.procs)
+    actions = np.zeros((NUM_ENVS, 1), dtype=np.float32)
+    assert np.allclose(train_envs.step(actions)[0], dummy_train_envs.step(actions)[0])
+    train_envs.close()
+    assert not any(proc.is_alive() for proc in train_envs.procs)
+
+
+def test_shmem_forkserver():
+    env_fns = [make_env_fn(i) for i in range(NUM_ENVS)]
+    envs = ShmemVecEnv(env_fns, context="forkserver", preload=["gym"])
+    assert np.allclose(envs.reset(), DummyVecEnv(env_fns).reset())
+    envs.close()
+
+
+def test_shmem_spaces_cache():
+    # Environments created in this process, the workers run in others.
+    created = []
+
+    def make_counted_env(rank):
+        def _thunk():
+            created.append(rank)
+            return make_env_fn(rank)()
+
+        return _thunk
+
+    env_fns = [make_counted_env(i) for i in range(NUM_ENVS)]
+    key = (TEST_ENV, "test_shmem_spaces_cache")
+    for _ in range(2):
+        envs = ShmemVecEnv(env_fns, context="fork", spaces_key=key)
+        envs.close()
+    # Only the first one creates a dummy environment to get the spaces.
+    assert len(created) == 1
+
+
+def test_torch_vec_env():
+    from rlf.envs.pointmass import BatchedTorchPointMassEnvSpawnRange
+
+    horizon = 5
+    num_envs = 4
+    envs = BatchedTorchPointMassEnvSpawnRange(
+        True, horizon, "cpu", num_envs, -1, 0.1, False, 4
+    )
+    obs = envs.reset()
+    assert isinstance(obs, torch.Tensor) and obs.shape == (num_envs, 2)
+    ep_return = torch.zeros(num_envs)
+    for step in range(2 * horizon):
+        obs, reward, done, infos = envs.step(torch.zeros(num_envs, 2))
+        assert reward.shape == (num_envs, 1)
+        assert done.dtype == torch.bool
+        ep_return += reward.view(-1)
+        if (step + 1) % horizon == 0:
+            assert done.all()
+            stats = agg_ep_log_stats(infos, {})
+            assert np.allclose(stats["r"], ep_return.tolist())
+            assert stats["l"] == [horizon] * num_envs
+            assert len(stats["ep_dist_to_goal"]) == num_envs
+            assert np.allclose(infos[0]["episode"]["r"], ep_return[0].item())
+            # The environments were reset within the batch.
+            assert not torch.allclose(obs, infos.arrays["final_obs"])
+            ep_return.zero_()
+        else:
+            assert not done.any()
+            assert len(agg_ep_log_stats(infos, {})) == 0
+
+
+def test_uint8_obs_pipeline():
+    from rlf.rl.envs import VecPyTorch, VecPyTorchFrameStack
+
+    class ImageEnv(gym.Env):
+        observation_space = gym.spaces.Box(0, 255, (1, 4, 4), dtype=np.uint8)
+        action_space = gym.spaces.Discrete(2)
+
+        def reset(self):
+            self.t = 0
+            return np.full((1, 4, 4), 200, dtype=np.uint8)
+
+        def step(self, action):
+            self.t += 1
+            obs = np.full((1, 4, 4), 200 + self.t, dtype=np.uint8)
+            return obs, 0.0, self.t == 3, {}
+
+    envs = ShmemVecEnv([ImageEnv for _ in range(2)], context="fork")
+    envs = VecPyTorchFrameStack(VecPyTorch(envs, "cpu"), 2, "cpu")
+    obs = envs.reset()
+    assert obs.dtype == torch.uint8 and obs.shape == (2, 2, 4, 4)
+    obs, _, _, _ = envs.step(torch.zeros(2, 1, dtype=torch.long))
+    assert obs.dtype == torch.uint8
+    # Values above 127 are not wrapped.
+    assert (obs[:, 0] == 200).all() and (obs[:, 1] == 201).all()
+    envs.close()
+
+
+def test_uint8_low_dim_obs():
+    class CountEnv(gym.Env):
+        observation_space = gym.spaces.Box(0, 255, (3,), dtype=np.uint8)
+        action_space = gym.spaces.Discrete(2)
+
+        def reset(self):
+            return np.full((3,), 200, dtype=np.uint8)
+
+        def step(self, action):
+            return self.reset(), 0.0, False, {}
+
+    # Only the image observations are kept as uint8 for the CNN.
+    envs = VecPyTorch(DummyVecEnv([CountEnv for _ in range(2)]), "cpu")
+    obs = envs.reset()
+    assert obs.dtype == torch.float32 and (obs == 200.0).all()
+    envs.close()
+
+
+def test_stack_helper_ring_buffer():
+    from rlf.rl.utils import StackHelper
+
+    num_envs, n_stack, ob_shape = 3, 4, (2, 3)
+    helper = StackHelper(ob_shape, n_stack, "cpu", num_envs)
+    rng = np.random.RandomState(0)
+    obs = torch.as_tensor(rng.randn(num_envs, *ob_shape), dtype=torch.float32)
+    # Reference stack shifted every step.
+    ref = torch.zeros(num_envs, n_stack * ob_shape[0], *ob_shape[1:])
+    ref[:, -ob_shape[0] :] = obs
+    assert torch.allclose(helper.reset(obs), ref)
+    for _ in range(20):
+        obs = torch.as_tensor(rng.randn(num_envs, *ob_shape), dtype=torch.float32)
+        dones = rng.rand(num_envs) < 0.3
+        final_obs = rng.randn(num_envs, *ob_shape).astype(np.float32)
+        infos = [{"final_obs": final_obs[i]} if dones[i] else {} for i in range(num_envs)]
+        stacked, infos = helper.update_obs(obs, dones, infos)
+
+        ref_final = torch.cat([ref[:, ob_shape[0] :], torch.as_tensor(final_obs)], 1)
+        ref = torch.cat([ref[:, ob_shape[0] :], obs], 1)
+        ref[dones, : -ob_shape[0]] = 0
+        assert torch.allclose(stacked, ref)
+        for i in np.nonzero(dones)[0]:
+            assert torch.allclose(infos[i]["final_obs"], ref_final[i])
+
+
+def test_device_vec_normalize():
+    from rlf.baselines.vec_env.vec_normalize import VecNormalize
+    from rlf.rl.envs import VecPyTorch
+
+    np_envs = VecNormalize(DummyVecEnv([make_env_fn(i) for i in range(NUM_ENVS)]))
+    torch_envs = VecNormalize(
+        VecPyTorch(DummyVecEnv([make_env_fn(i) for i in range(NUM_ENVS)]), "cpu"),
+        device="cpu",
+        use_float64=True,
+    )
+    np_obs = np_envs.reset()
+    torch_obs = torch_envs.reset()
+    assert isinstance(torch_obs, torch.Tensor) and torch_obs.dtype == torch.float32
+    assert np.allclose(np_obs, torch_obs.numpy(), atol=1e-4)
+    for _ in range(NUM_STEPS):
+        actions = np.stack([np_envs.action_space.sample() for _ in range(NUM_ENVS)])
+        np_obs, np_rews, _, _ = np_envs.step(actions)
+        torch_obs, torch_rews, _, _ = torch_envs.step(torch.as_tensor(actions))
+        assert np.allclose(np_obs, torch_obs.numpy(), atol=1e-3)
+        assert np.allclose(np_rews, torch_rews.view(-1).numpy(), atol=1e-3)
+
+    state = torch_envs.state_dict()
+    assert state["ob_rms"][None]["mean"].dtype == torch.float64
+    np_envs.load_state_dict(state)
+    assert np.allclose(np_envs.ob_rms_dict[None].var, torch_envs.ob_rms_dict[None].var)
+
+
+def make_monitor_env(rank):
+    env = TimeLimitMask(gym.make(TEST_ENV))
+    env.seed(31 + rank)
+    return Monitor(env, None)
+
+
+@pytest.mark.parametrize("use_shmem", [False, True])
+def test_vec_monitor(use_shmem, tmp_path):
+    from rlf.baselines.monitor import load_results
+    from rlf.baselines.vec_env import VecMonitor
+
+    env_fns = [make_env_fn(i) for i in range(NUM_ENVS)]
+    if use_shmem:
+        envs = ShmemVecEnv(env_fns, context="fork")
+    else:
+        envs = DummyVecEnv(env_fns)
+    envs = VecMonitor(envs, filename=str(tmp_path), buffer_size=2)
+    monitor_envs = DummyVecEnv([partial(make_monitor_env, i) for i in range(NUM_ENVS)])
+    envs.reset()
+    monitor_envs.reset()
+    n_episodes = 0
+    for _ in range(NUM_STEPS):
+        actions = np.zeros((NUM_ENVS, 1), dtype=np.float32)
+        _, _, _, infos = envs.step(actions)
+        _, _, _, m_infos = monitor_envs.step(actions)
+        stats = agg_ep_log_stats(infos, {})
+        m_stats = agg_ep_log_stats(m_infos, {})
+        assert stats.keys() == m_stats.keys()
+        for k in ["r", "l"]:
+            assert np.allclose(stats[k], m_stats[k], atol=1e-4)
+        n_episodes += len(stats["r"])
+    assert n_episodes > 0
+    envs.close()
+    monitor_envs.close()
+    assert len(load_results(str(tmp_path))) == n_episodes